@@ -0,0 +1,24 @@
+"""
+Nala AI - Core music generation utilities shared by every entry point
+"""
+
+from .extract import StrudelExtractor, extract_strudel_code
+from .fallback import FallbackPattern, generate_fallback
+from .repair import RepairResult, repair_strudel
+from .responses import parse_fields, project_fields
+from .syntax import SyntaxIssue, ValidationResult, parse_strudel, validate_strudel
+
+__all__ = [
+    "StrudelExtractor",
+    "extract_strudel_code",
+    "FallbackPattern",
+    "generate_fallback",
+    "RepairResult",
+    "repair_strudel",
+    "parse_fields",
+    "project_fields",
+    "SyntaxIssue",
+    "ValidationResult",
+    "parse_strudel",
+    "validate_strudel",
+]
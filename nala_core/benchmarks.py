@@ -0,0 +1,281 @@
+"""
+Nala AI - Micro-benchmarks for the shared generation utilities
+
+    python -m nala_core.benchmarks extract            # default sizes
+    python -m nala_core.benchmarks extract 1000 8000  # custom sizes
+    python -m nala_core.benchmarks validate           # Strudel syntax validation
+    python -m nala_core.benchmarks prompt             # prompt build and response parse
+    python -m nala_core.benchmarks fallback 20000     # offline fallback patterns
+"""
+
+import json
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from .extract import StrudelExtractor, extract_strudel_code
+from .fallback import generate_fallback
+from .prompts import (
+    MUSIC_PROMPT, budget_music_prompt_suffix, estimate_tokens, extract_description, music_prompt_suffix,
+    parse_code_description
+)
+from .syntax import parse_strudel, validate_strudel
+
+# The regex cascade extract_strudel_code replaced (music_api_wrapper.py's
+# variant; runpod/handler.py used r'(stack\([^)]+\)...' for the second step)
+_LEGACY_PATTERNS = [
+    r'```strudel\n(.*?)\n```',
+    r'(stack\([^}]+\}[^)]*\)(?:\.[^)]+\([^)]*\))*)',
+    r'```\n(.*?)\n```',
+]
+
+
+def legacy_extract_strudel_code(ai_response: str) -> Optional[str]:
+    strudel_match = re.search(_LEGACY_PATTERNS[0], ai_response, re.DOTALL)
+    if strudel_match:
+        return strudel_match.group(1).strip()
+    stack_match = re.search(_LEGACY_PATTERNS[1], ai_response, re.DOTALL)
+    if stack_match:
+        return stack_match.group(1).strip()
+    code_match = re.search(_LEGACY_PATTERNS[2], ai_response, re.DOTALL)
+    if code_match and 'stack(' in code_match.group(1):
+        return code_match.group(1).strip()
+    return None
+
+
+def streamed_extract(ai_response: str, chunk_chars: int = 4) -> Optional[str]:
+    """Feed the response the way a token stream arrives"""
+    extractor = StrudelExtractor()
+    for start in range(0, len(ai_response), chunk_chars):
+        extractor.feed(ai_response[start:start + chunk_chars])
+    return extractor.finish()
+
+
+CODE_BLOCK = '```strudel\nstack(\n  sound("bd*2 ~ bd ~").gain(0.8),\n  sound("hh*16").gain(0.4)\n).slow(2)\n```\n'
+
+# name -> builder for an input of roughly n units
+ADVERSARIAL_INPUTS: Dict[str, Callable[[int], str]] = {
+    # Long reasoning that keeps mentioning stack( before the real answer
+    "long reasoning": lambda n: "<think>" + "maybe a stack(kick, snare) layer would work here. " * n + "</think>\n" + CODE_BLOCK,
+    # Unclosed stack( calls and no code at all: every start used to rescan the rest
+    "repeated stack(": lambda n: "stack(" * n,
+    # Truncated blocks: every ```strudel opening used to scan to the end for a close
+    "unclosed fences": lambda n: "```strudel\nstack(" * n,
+    # A method chain that never closes, backtracked link by link
+    "dangling chain": lambda n: 'stack(sound("bd")})' + ".x(" * n,
+}
+
+
+def time_call(fn: Callable[[str], Optional[str]], text: str, budget: float = 0.5) -> float:
+    """Best-of-a-few seconds per call, spending about budget seconds"""
+    best = float("inf")
+    spent = 0.0
+    runs = 0
+    while runs < 3 or (spent < budget and runs < 1000):
+        start = time.perf_counter()
+        fn(text)
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        spent += elapsed
+        runs += 1
+        if elapsed > budget:
+            break
+    return best
+
+
+def benchmark_extract(sizes: List[int]) -> None:
+    print("🔎 Strudel extraction: legacy regex cascade vs incremental extractor")
+    print(f"{'input':<18} {'n':>7} {'chars':>9} {'legacy':>11} {'extractor':>11} {'streamed':>11}")
+    for name, build in ADVERSARIAL_INPUTS.items():
+        for n in sizes:
+            text = build(n)
+            legacy = time_call(legacy_extract_strudel_code, text)
+            whole = time_call(extract_strudel_code, text)
+            streamed = time_call(streamed_extract, text)
+            print(
+                f"{name:<18} {n:>7} {len(text):>9} "
+                f"{legacy * 1000:>9.2f}ms {whole * 1000:>9.2f}ms {streamed * 1000:>9.2f}ms"
+            )
+
+    text = "Here is your beat:\n" + CODE_BLOCK + "Description: a driving beat.\n"
+    per_call = time_call(extract_strudel_code, text, budget=0.2)
+    print(f"⚡ typical response: {per_call * 1e6:.1f}µs per extraction")
+
+
+# name -> pattern, from the fallback library's size up to a long arrangement
+VALIDATION_INPUTS: Dict[str, str] = {
+    "one-liner": 'sound("bd*4").gain(0.8)',
+    "fallback": (
+        'stack(\n  sound("bd*2 ~ bd ~").gain(0.8),\n  sound("~ ~ sd ~").gain(0.7),\n'
+        '  sound("hh*16").gain(0.4),\n  note("c1 ~ f1 g1").sound("808").lpf(80)\n)'
+    ),
+    "arrangement": "stack(\n" + ",\n".join(
+        f'  note("<c{i % 4 + 1} [e{i % 4 + 1} g{i % 4 + 1}]>*2 ~ [a3 b3](3,8)").sound("piano")'
+        f'.every(4, x => x.fast(2)).lpf(sine.range(400, 2000).slow(8)).gain(0.5)'
+        for i in range(16)
+    ) + "\n).slow(2)",
+    "unclosed": 'stack(sound("bd [sd hh").gain(0.8), note("c e g"',
+}
+
+
+def benchmark_validate() -> None:
+    print("🧪 Strudel validation: full parse vs cached validate_strudel")
+    print(f"{'input':<14} {'chars':>7} {'valid':>6} {'parse':>11} {'cached':>11}")
+    for name, code in VALIDATION_INPUTS.items():
+        parsed = time_call(parse_strudel, code, budget=0.2)
+        validate_strudel(code)
+        cached = time_call(validate_strudel, code, budget=0.2)
+        valid = parse_strudel(code).valid
+        print(f"{name:<14} {len(code):>7} {str(valid):>6} {parsed * 1e6:>9.1f}µs {cached * 1e6:>9.1f}µs")
+
+
+# A request as the frontend sends it
+MUSIC_DNA = {
+    "primaryGenre": "trap",
+    "preferredMood": "dark",
+    "energyLevel": 8,
+    "complexity": 6,
+    "keywords": ["808", "rolling hats", "night drive"],
+}
+CONTEXT = {
+    "timeOfDay": "night",
+    "activity": "driving",
+    "userAgent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36",
+    "timestamp": "2026-01-01T00:00:00.000Z",
+}
+FREE_TEXT_RESPONSE = (
+    "Here is your beat:\n" + CODE_BLOCK
+    + "Description: A dark trap beat with rolling hi-hats and a heavy kick.\n\n"
+    + "Reasoning: the 808 pattern leaves space for the hats.\n"
+)
+CODE_DESCRIPTION_RESPONSE = (
+    'CODE: ```javascript\nstack(\n  sound("bd*2 ~ bd ~").gain(0.8),\n  sound("hh*16").gain(0.4)\n)\n```\n'
+    "DESCRIPTION: Dark trap beat with rolling 808s and crisp hi-hats\n"
+)
+
+
+def legacy_music_prompt_suffix(user_input: str, music_dna: Dict, context: Dict) -> str:
+    return f"""User Request: "{user_input}"
+
+Context:
+- Musical DNA: {json.dumps(music_dna, indent=2) if music_dna else 'Not provided'}
+- Context: {json.dumps(context, indent=2) if context else 'Not provided'}
+
+Now generate a unique Strudel pattern for: "{user_input}"
+
+Pattern:"""
+
+
+def legacy_parse_code_description(ai_text: str):
+    code_match = re.search(r'CODE:\s*(.*?)(?=DESCRIPTION:|$)', ai_text, re.DOTALL | re.IGNORECASE)
+    desc_match = re.search(r'DESCRIPTION:\s*(.*?)(?:\n|$)', ai_text, re.IGNORECASE)
+    code = ""
+    if code_match:
+        code = re.sub(r'```(?:javascript|js)?', '', code_match.group(1).strip()).strip()
+        code = re.sub(r'```', '', code).strip()
+    return code, desc_match.group(1).strip() if desc_match else ""
+
+
+def legacy_extract_description(ai_response: str, user_input: str) -> str:
+    text = re.sub(r'```.*?```', '', ai_response, flags=re.DOTALL)
+    for pattern in [
+        r'Description:\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+        r'This pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+        r'I created\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+        r'The pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)'
+    ]:
+        match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+        if match and len(match.group(1).strip()) > 10:
+            return match.group(1).strip()[:200]
+    return f"AI-generated musical pattern based on: {user_input}"
+
+
+def benchmark_prompt() -> None:
+    user_input = "dark trap beat for a night drive"
+    legacy = legacy_music_prompt_suffix(user_input, MUSIC_DNA, CONTEXT)
+    compact = music_prompt_suffix(user_input, MUSIC_DNA, CONTEXT)
+    budgeted = budget_music_prompt_suffix(user_input, MUSIC_DNA, CONTEXT, 2048).suffix
+    print("📝 Prompt suffix: indented JSON vs compact template vs low-value fields dropped")
+    print(f"{'variant':<10} {'chars':>7} {'~tokens':>8} {'build':>10}")
+    for name, build, text in [
+        ("legacy", lambda _: legacy_music_prompt_suffix(user_input, MUSIC_DNA, CONTEXT), legacy),
+        ("compact", lambda _: music_prompt_suffix(user_input, MUSIC_DNA, CONTEXT), compact),
+        ("budgeted", lambda _: budget_music_prompt_suffix(user_input, MUSIC_DNA, CONTEXT, 2048), budgeted),
+    ]:
+        print(f"{name:<10} {len(text):>7} {estimate_tokens(text):>8} {time_call(build, '', budget=0.2) * 1e6:>8.1f}µs")
+    print(f"   static prefix: {len(MUSIC_PROMPT.prefix)} chars, built once")
+
+    print("🧩 Response parsing: module-level re calls vs precompiled patterns")
+    print(f"{'parser':<22} {'legacy':>10} {'shared':>10}")
+    for name, old, new, text in [
+        ("CODE:/DESCRIPTION:", legacy_parse_code_description, parse_code_description, CODE_DESCRIPTION_RESPONSE),
+        ("description", lambda t: legacy_extract_description(t, "x"), lambda t: extract_description(t, "x"), FREE_TEXT_RESPONSE),
+    ]:
+        assert old(text) == new(text), name
+        print(f"{name:<22} {time_call(old, text, budget=0.2) * 1e6:>8.1f}µs {time_call(new, text, budget=0.2) * 1e6:>8.1f}µs")
+
+
+# Requests as users phrase them, some naming no genre at all
+FALLBACK_REQUESTS = [
+    "dark trap beat for a night drive", "chill lofi beat to study to", "upbeat house groove",
+    "make me some music", "sad jazz piano at 3am", "happy country song", "aggressive techno",
+    "dreamy ambient soundscape", "fast drum and bass", "boom bap hip hop beat", "something cool",
+]
+
+
+def legacy_fallback_pattern(user_input: str) -> str:
+    # The substring chain of runpod/handler.py, down to which pattern it picked
+    lower_input = user_input.lower()
+    if 'trap' in lower_input:
+        return "trap"
+    elif 'country' in lower_input or 'folk' in lower_input:
+        return "country"
+    elif 'dark' in lower_input or 'minor' in lower_input:
+        return "dark"
+    return "lo-fi"
+
+
+def benchmark_fallback(count: int) -> None:
+    requests = [
+        (FALLBACK_REQUESTS[i % len(FALLBACK_REQUESTS)], {"energyLevel": i % 10 + 1, "complexity": (i * 7) % 10 + 1})
+        for i in range(count)
+    ]
+    print(f"🎲 Fallback patterns: static substring chain vs synthesizer, {count} requests")
+
+    start = time.perf_counter()
+    legacy = {legacy_fallback_pattern(user_input) for user_input, _ in requests}
+    legacy_rate = count / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    patterns = [generate_fallback(user_input, dna) for user_input, dna in requests]
+    rate = count / (time.perf_counter() - start)
+
+    invalid = sum(not parse_strudel(pattern.code).valid for pattern in patterns)
+    print(f"{'generator':<12} {'patterns/s':>11} {'distinct':>9} {'invalid':>8}")
+    print(f"{'legacy':<12} {legacy_rate:>11.0f} {len(legacy):>9} {0:>8}")
+    print(f"{'synthesizer':<12} {rate:>11.0f} {len({pattern.code for pattern in patterns}):>9} {invalid:>8}")
+    genres = sorted({pattern.genre for pattern in patterns})
+    print(f"   genres: {', '.join(genres)}")
+
+
+def main(argv: List[str]) -> int:
+    if argv and argv[0] == "extract":
+        sizes = [int(arg) for arg in argv[1:]] or [500, 2000, 8000]
+        benchmark_extract(sizes)
+        return 0
+    if argv and argv[0] == "validate":
+        benchmark_validate()
+        return 0
+    if argv and argv[0] == "prompt":
+        benchmark_prompt()
+        return 0
+    if argv and argv[0] == "fallback":
+        benchmark_fallback(int(argv[1]) if len(argv) > 1 else 20000)
+        return 0
+    print(__doc__.strip())
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
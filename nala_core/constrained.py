@@ -0,0 +1,179 @@
+"""
+Nala AI - Constrained decoding for Strudel output
+The JSON schema for Ollama's structured outputs, and an incremental grammar
+check that lets a token-level logits processor keep generated code on the
+Strudel grammar
+"""
+
+import json
+from typing import List, Optional, Tuple
+
+from .syntax import validate_strudel
+
+# Ollama `format` schema: the model can only answer with these two fields
+STRUDEL_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "code": {
+            "type": "string",
+            "description": "The Strudel pattern, e.g. stack(sound(\"bd*4\"), sound(\"hh*8\"))",
+        },
+        "description": {
+            "type": "string",
+            "description": "One or two sentences about the pattern",
+        },
+    },
+    "required": ["code", "description"],
+}
+
+STRUCTURED_OUTPUT_INSTRUCTION = (
+    'Respond only with a JSON object: {"code": "<the Strudel pattern>", '
+    '"description": "<a brief description of it>"}\n'
+)
+
+# Where grammar-constrained generation starts: inside a ```strudel block
+CODE_BLOCK_OPENING = "```strudel\n"
+
+_WORD_CHARS = frozenset("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$")
+_OPERATORS = frozenset(".,:;=+-*/%?!<>&|")
+_OPENERS = {"(": ")", "[": "]", "{": "}"}
+_CLOSERS = frozenset(")]}")
+_QUOTES = frozenset("\"'`")
+_FENCE_LENGTH = 3
+
+
+def parse_structured_response(text: str) -> Optional[Tuple[str, str]]:
+    """(code, description) from a JSON-formatted response, or None if it is not one"""
+    start = text.find("{")
+    if start == -1:
+        return None
+    try:
+        data, _ = json.JSONDecoder().raw_decode(text, start)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    code = data.get("code")
+    if not isinstance(code, str) or not code.strip():
+        return None
+    description = data.get("description")
+    return code.strip(), description.strip() if isinstance(description, str) else ""
+
+
+class StrudelGrammar:
+    """Character-level state of generated Strudel code, fed as it is decoded.
+
+    Enforces what can be checked on a prefix: balanced and matching
+    brackets, single-line string literals, the characters the JavaScript
+    subset uses, and no two names or values side by side (which rules out
+    prose) except across a newline between top-level statements. A closing
+    ``` fence is only accepted at the top level and only once the code so
+    far passes validate_strudel, after which the code is complete.
+
+    accepts() answers for a candidate token without changing the state, so a
+    logits processor can test the most likely tokens at every step.
+    """
+
+    __slots__ = ("stack", "quote", "escape", "previous", "gap", "fence", "complete", "code")
+
+    def __init__(self):
+        self.stack: List[str] = []
+        self.quote: Optional[str] = None
+        self.escape = False
+        # "start", "name" (inside a name or number), "value" (after a string
+        # or closing bracket) or "operator"
+        self.previous = "start"
+        self.gap = ""  # whitespace since the previous token: "", "space" or "newline"
+        self.fence = 0
+        self.complete = False
+        self.code: List[str] = []
+
+    def copy(self) -> "StrudelGrammar":
+        other = StrudelGrammar.__new__(StrudelGrammar)
+        other.stack = list(self.stack)
+        other.quote = self.quote
+        other.escape = self.escape
+        other.previous = self.previous
+        other.gap = self.gap
+        other.fence = self.fence
+        other.complete = self.complete
+        other.code = self.code
+        return other
+
+    def accepts(self, text: str) -> bool:
+        """Whether text can follow what has been fed so far"""
+        return self.copy()._advance(text)
+
+    def feed(self, text: str) -> bool:
+        """Advance over text; False (leaving the state undefined) if it breaks the grammar"""
+        accepted = self._advance(text)
+        self.code.append(text)
+        return accepted
+
+    @property
+    def text(self) -> str:
+        return "".join(self.code)
+
+    def _advance(self, text: str) -> bool:
+        for index, char in enumerate(text):
+            if self.complete:
+                if not char.isspace():
+                    return False
+            elif self.fence:
+                if char != "`":
+                    return False
+                self.fence += 1
+                self.complete = self.fence == _FENCE_LENGTH
+            elif self.quote is not None:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == self.quote:
+                    self.quote = None
+                    self.previous = "value"
+                    self.gap = ""
+                elif char == "\n" and self.quote != "`":
+                    return False
+            elif char.isspace():
+                if char == "\n":
+                    self.gap = "newline"
+                elif not self.gap:
+                    self.gap = "space"
+            elif char == "`" and not self.stack:
+                # The closing fence of the ```strudel block
+                if self.previous not in ("name", "value"):
+                    return False
+                if not validate_strudel((self.text + text[:index]).strip()).valid:
+                    return False
+                self.fence = 1
+            elif char in _WORD_CHARS or char in _QUOTES:
+                continues_name = self.previous == "name" and not self.gap and char in _WORD_CHARS
+                if self.previous in ("name", "value") and not continues_name:
+                    # Two values in a row: only as a new statement on a new line
+                    if self.stack or self.gap != "newline":
+                        return False
+                if char in _QUOTES:
+                    self.quote = char
+                else:
+                    self.previous = "name"
+                self.gap = ""
+            elif char in _OPENERS:
+                if self.previous == "start":
+                    return False
+                self.stack.append(_OPENERS[char])
+                self.previous = "operator"
+                self.gap = ""
+            elif char in _CLOSERS:
+                if not self.stack or self.stack.pop() != char:
+                    return False
+                self.previous = "value"
+                self.gap = ""
+            elif char in _OPERATORS:
+                if self.previous == "start" or (char == "," and not self.stack):
+                    return False
+                self.previous = "operator"
+                self.gap = ""
+            else:
+                return False
+        return True
@@ -0,0 +1,283 @@
+"""
+Nala AI - Incremental Strudel code extraction
+A single-pass state machine over the model's output that finds the Strudel
+code while the text is still streaming in
+"""
+
+import re
+from typing import Optional
+
+_FENCE = b"```"
+_CLOSE_FENCE = b"\n```"
+_STACK_CALL = b"stack("
+_THINK_OPEN = b"<think>"
+_THINK_CLOSE = b"</think>"
+
+# Fence info strings whose blocks count as code when they contain stack(
+_UNTAGGED = {b"", b"js", b"javascript"}
+
+_LEADING_SPACE = re.compile(rb"\s*")
+# Characters that matter inside a call: parentheses and string delimiters
+_CALL_TOKEN = re.compile(rb"[()\"'`]")
+# Where a string literal can end; plain JS strings cannot span lines
+_STRING_END = {
+    ord('"'): re.compile(rb'["\\\n]'),
+    ord("'"): re.compile(rb"['\\\n]"),
+    ord("`"): re.compile(rb"[`\\]"),
+}
+# A chained call after a closing parenthesis, e.g. `.slow(2)`
+_CHAIN_LINK = re.compile(rb"\s*\.\s*[A-Za-z_$][\w$]*\s*\(")
+# Longest stretch of whitespace/partial `.name` to wait through for a chain link
+_CHAIN_LOOKAHEAD = 256
+
+
+class StrudelExtractor:
+    """Incremental, linear-time extraction of Strudel code from model output.
+
+    Text is fed in chunks of any size; every byte is looked at a bounded
+    number of times and the scanners jump between interesting characters with
+    precompiled searches, so adversarial outputs cannot cause backtracking.
+
+    Candidates, in order of preference:
+      1. the first ```strudel fenced block, reported by feed() as soon as its
+         closing fence arrives
+      2. the first bare stack(...) call (with any .method(...) chain) that
+         has balanced parentheses outside string literals and contains at
+         least one string
+      3. the first untagged (or js) fenced block that contains stack(
+
+    A leading <think> section is skipped so a draft inside the reasoning is
+    not mistaken for the answer; if the reasoning never closes it is scanned
+    after all when the stream ends.
+    """
+
+    def __init__(self, skip_think: bool = True):
+        self._buf = bytearray()
+        self._finished = False
+
+        self.code: Optional[str] = None
+        self.code_end: Optional[int] = None
+        self._expression: Optional[str] = None
+        self._untagged: Optional[str] = None
+
+        # Offset where the answer starts (after </think>), None while undecided
+        self._answer_start: Optional[int] = None if skip_think else 0
+        self._think_scan = 0
+
+        # Fence scanner
+        self._fence_pos = 0
+        self._info_start: Optional[int] = None
+        self._body_start: Optional[int] = None
+        self._fence_tag = b""
+
+        # stack(...) scanner
+        self._expr_pos = 0
+        self._expr_start: Optional[int] = None
+        self._depth = 0
+        self._quote: Optional[int] = None
+        self._has_string = False
+
+    @property
+    def text(self) -> str:
+        """Everything fed so far"""
+        return self._buf.decode("utf-8", errors="replace")
+
+    def text_since_code(self, max_chars: int) -> str:
+        """Up to max_chars of the text following the ```strudel block"""
+        if self.code_end is None:
+            return ""
+        tail = self._buf[self.code_end:self.code_end + 4 * max_chars]
+        return tail.decode("utf-8", errors="ignore")[:max_chars]
+
+    def feed(self, chunk: str) -> Optional[str]:
+        """Add a chunk of text; returns the code the first time its ```strudel block closes"""
+        self._buf += chunk.encode("utf-8")
+        if self.code is not None:
+            return None
+        if self._answer_start is None and not self._find_answer_start():
+            return None
+
+        self._scan_fences()
+        if self.code is not None:
+            return self.code
+        if self._expression is None:
+            self._scan_expression()
+        return None
+
+    def finish(self) -> Optional[str]:
+        """End of stream: the best code found, or None"""
+        if not self._finished:
+            self._finished = True
+            if self._answer_start is None:
+                # The reasoning never closed; the code may be inside it
+                self._answer_start = 0
+            if self.code is None:
+                self._scan_fences()
+            if self.code is None and self._expression is None:
+                self._scan_expression()
+        return self.code or self._expression or self._untagged
+
+    def _find_answer_start(self) -> bool:
+        """Skip a leading <think> section; False while still inside it"""
+        buf = self._buf
+        start = _LEADING_SPACE.match(buf).end()
+        head = bytes(buf[start:start + len(_THINK_OPEN)])
+        if len(head) < len(_THINK_OPEN) and _THINK_OPEN.startswith(head):
+            return False
+        if head != _THINK_OPEN:
+            self._answer_start = 0
+            return True
+
+        close = buf.find(_THINK_CLOSE, max(self._think_scan, start))
+        if close == -1:
+            self._think_scan = max(self._think_scan, len(buf) - len(_THINK_CLOSE) + 1)
+            return False
+        self._answer_start = close + len(_THINK_CLOSE)
+        self._fence_pos = self._expr_pos = self._answer_start
+        return True
+
+    def _scan_fences(self) -> None:
+        buf = self._buf
+        while self.code is None:
+            if self._body_start is None:
+                if self._info_start is None:
+                    opening = buf.find(_FENCE, self._fence_pos)
+                    if opening == -1:
+                        self._fence_pos = max(self._fence_pos, len(buf) - len(_FENCE) + 1)
+                        return
+                    self._info_start = self._fence_pos = opening + len(_FENCE)
+
+                newline = buf.find(b"\n", self._fence_pos)
+                if newline == -1:
+                    self._fence_pos = len(buf)
+                    return
+                self._fence_tag = bytes(buf[self._info_start:newline]).strip().lower()
+                self._info_start = None
+                self._body_start = newline + 1
+                # Search for the closing fence from the info line's newline,
+                # so an empty block closes straight away
+                self._fence_pos = newline
+
+            close = buf.find(_CLOSE_FENCE, self._fence_pos)
+            if close == -1:
+                self._fence_pos = max(self._fence_pos, len(buf) - len(_CLOSE_FENCE) + 1)
+                return
+
+            body = bytes(buf[self._body_start:close])
+            if self._fence_tag == b"strudel" and body.strip():
+                self.code = body.decode("utf-8", errors="replace").strip()
+                self.code_end = close + len(_CLOSE_FENCE)
+            elif self._fence_tag in _UNTAGGED and self._untagged is None and _STACK_CALL in body:
+                self._untagged = body.decode("utf-8", errors="replace").strip()
+            self._body_start = None
+            self._fence_pos = close + len(_CLOSE_FENCE)
+
+    def _scan_expression(self) -> None:
+        buf = self._buf
+        while self._expression is None:
+            if self._expr_start is None:
+                start = buf.find(_STACK_CALL, self._expr_pos)
+                if start == -1:
+                    self._expr_pos = max(self._expr_pos, len(buf) - len(_STACK_CALL) + 1)
+                    return
+                self._expr_pos = start + len(_STACK_CALL)
+                # Part of a longer identifier, e.g. `mystack(`
+                if start > 0 and (chr(buf[start - 1]).isalnum() or buf[start - 1] in b"_$"):
+                    continue
+                self._expr_start = start
+                self._depth = 1
+                self._has_string = False
+
+            if self._depth > 0:
+                if not self._scan_call():
+                    return
+                continue
+
+            # A call just closed; it may continue with .method(...)
+            link = _CHAIN_LINK.match(buf, self._expr_pos)
+            if link:
+                self._depth = 1
+                self._expr_pos = link.end()
+                continue
+            if not self._finished and len(buf) - self._expr_pos < _CHAIN_LOOKAHEAD and self._could_chain():
+                return
+
+            if self._has_string:
+                self._expression = bytes(buf[self._expr_start:self._expr_pos]).decode("utf-8", errors="replace").strip()
+            self._expr_start = None
+
+    def _could_chain(self) -> bool:
+        """Whether the text after the closing parenthesis may still become a chain link"""
+        rest = bytes(self._buf[self._expr_pos:]).lstrip()
+        if not rest:
+            return True
+        if rest[:1] != b".":
+            return False
+        name = rest[1:].lstrip()
+        return re.fullmatch(rb"[A-Za-z_$]?[\w$]*\s*", name) is not None
+
+    def _scan_call(self) -> bool:
+        """Advance through the open call; False when more input is needed"""
+        buf = self._buf
+        while True:
+            if self._quote is not None:
+                match = _STRING_END[self._quote].search(buf, self._expr_pos)
+                if match is None:
+                    self._expr_pos = len(buf)
+                    return False
+                position = match.start()
+                char = buf[position]
+                if char == 0x5C:  # backslash escape
+                    if position + 1 >= len(buf):
+                        self._expr_pos = position
+                        return False
+                    self._expr_pos = position + 2
+                    continue
+                if char == 0x0A:
+                    # A newline inside a quoted string: this was prose, not code
+                    return self._abandon_call(position)
+                self._quote = None
+                self._has_string = True
+                self._expr_pos = position + 1
+                continue
+
+            match = _CALL_TOKEN.search(buf, self._expr_pos)
+            if match is None:
+                self._expr_pos = len(buf)
+                return False
+            position = match.start()
+            char = buf[position]
+
+            if char == 0x60:  # backtick: template string, or a fence ending the code
+                ticks = bytes(buf[position:position + len(_FENCE)])
+                if ticks == _FENCE:
+                    return self._abandon_call(position)
+                if not self._finished and len(ticks) < len(_FENCE) and ticks == b"`" * len(ticks):
+                    self._expr_pos = position
+                    return False
+                self._quote = char
+            elif char in (0x22, 0x27):
+                self._quote = char
+            elif char == 0x28:
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._expr_pos = position + 1
+                    return True
+            self._expr_pos = position + 1
+
+    def _abandon_call(self, position: int) -> bool:
+        """Give up on the current stack( and resume the search at position"""
+        self._expr_start = None
+        self._quote = None
+        self._depth = 0
+        self._expr_pos = position
+        return True
+
+
+def extract_strudel_code(ai_response: str) -> Optional[str]:
+    """Extract Strudel code from a complete AI response"""
+    extractor = StrudelExtractor()
+    extractor.feed(ai_response)
+    return extractor.finish()
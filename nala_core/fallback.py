@@ -0,0 +1,414 @@
+"""
+Nala AI - Offline fallback pattern synthesizer
+Composes a Strudel pattern from an indexed library of rhythm and melody
+fragments per genre, without a model: fast enough to answer every request
+while the GPU is down, and varied enough that users do not all get one loop
+"""
+
+import random
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+DEFAULT_GENRE = "lo-fi"
+
+
+@dataclass(frozen=True)
+class GenreLibrary:
+    label: str
+    # Drum fragments by density: sparse, medium and busy
+    kicks: Tuple[Tuple[str, ...], ...]
+    snares: Tuple[Tuple[str, ...], ...]
+    hats: Tuple[Tuple[str, ...], ...]
+    # Melodic fragments are scale degrees, pitched by .scale() at composition
+    bass: Tuple[str, ...]
+    bass_sounds: Tuple[str, ...]
+    chords: Tuple[str, ...]
+    chord_sounds: Tuple[str, ...]
+    melodies: Tuple[str, ...]
+    lead_sounds: Tuple[str, ...]
+    # Whole layers added on top at random
+    textures: Tuple[str, ...]
+    roots: Tuple[str, ...]
+    slow: Tuple[float, float]  # slow() factor at the highest and the lowest energy
+    mood: str  # when neither the request nor MusicDNA names one
+
+
+@dataclass(frozen=True)
+class Mood:
+    modes: Tuple[str, ...]
+    energy_shift: int
+    brightness: float  # scales filter cutoffs
+    lead_effects: Tuple[str, ...]
+    adjectives: Tuple[str, ...]
+
+
+GENRES: Dict[str, GenreLibrary] = {
+    "lo-fi": GenreLibrary(
+        label="lo-fi",
+        kicks=(("bd ~ ~ ~", "bd ~ ~ bd"), ("bd ~ ~ bd", "bd ~ [~ bd] ~", "bd ~ bd ~"), ("bd ~ [bd bd] ~", "bd [~ bd] ~ bd")),
+        snares=(("~ ~ sd ~",), ("~ sd ~ sd", "~ ~ sd ~", "~ sd ~ [sd ~]"), ("~ sd ~ sd", "~ sd ~ [~ sd]")),
+        hats=(("hh*4", "~ hh ~ hh"), ("hh*4", "hh*8", "[hh hh] hh [hh hh] hh"), ("hh*8", "hh*8?", "[hh hh hh] hh*2")),
+        bass=("0 ~ 3 4", "0 ~ ~ 4 ~ 3 ~ ~", "<0 3> ~ 4 ~", "0 [~ 2] 3 ~"),
+        bass_sounds=("sawtooth", "triangle"),
+        chords=("<[0,2,4,6] [3,5,7,9]>", "<[0,2,4] [5,7,9] [3,5,7] [4,6,8]>", "<[1,3,5,7] [4,6,8,10]>"),
+        chord_sounds=("piano", "superpiano"),
+        melodies=("~ 4 ~ [2 1]", "<7 6 4 2>*2", "~ ~ 2 ~ 4 ~ ~ 1", "[0 2] ~ 4 ~"),
+        lead_sounds=("kalimba", "bell", "piano"),
+        textures=('sound("vinyl").gain(0.1)', 'sound("tape").gain(0.08)'),
+        roots=("C", "D", "Eb", "F", "G", "A", "Bb"),
+        slow=(1.5, 2.2),
+        mood="chill",
+    ),
+    "trap": GenreLibrary(
+        label="trap",
+        kicks=(("bd ~ ~ ~ ~ ~ bd ~",), ("bd*2 ~ bd ~", "bd ~ ~ bd ~ ~ bd ~", "bd ~ [~ bd] ~"), ("bd*2 [~ bd] bd ~", "bd bd [~ bd] [bd bd]")),
+        snares=(("~ ~ sd ~",), ("~ ~ sd ~", "~ ~ cp ~"), ("~ ~ [sd cp] ~", "~ ~ sd [~ sd]")),
+        hats=(("hh*8",), ("hh*16", "hh*8 [hh*3]", "[hh*2 hh*4] hh*8"), ("hh*16", "[hh*4 hh*6] hh*16", "hh*32?")),
+        bass=("0 ~ ~ 0 ~ ~ 3 ~", "0 ~ 3 4", "<0 -2> ~ ~ 0 ~ 3 ~ ~"),
+        bass_sounds=("808",),
+        chords=("<[0,2,4] [5,7,9]>", "<[0,2,4] [-2,0,2]>"),
+        chord_sounds=("pad", "supersaw"),
+        melodies=("0 ~ 3 ~ 2 ~ 0 ~", "<4 3 2 0>*2", "~ 7 ~ 6 ~ 4 ~ ~", "[0 3] ~ [2 0] ~"),
+        lead_sounds=("bell", "pluck", "sine"),
+        textures=('sound("~ ~ ~ oh").gain(0.2)',),
+        roots=("C", "C#", "D", "F", "F#", "G", "A"),
+        slow=(1.2, 1.8),
+        mood="dark",
+    ),
+    "house": GenreLibrary(
+        label="house",
+        kicks=(("bd*4",), ("bd*4",), ("bd*4", "bd*4 [~ bd]")),
+        snares=(("~ cp ~ cp",), ("~ cp ~ cp", "~ sd ~ sd"), ("~ cp ~ [cp cp]", "~ [sd cp] ~ cp")),
+        hats=(("~ hh ~ hh",), ("[~ hh]*4", "hh*8", "[~ oh]*4"), ("hh*16", "[hh oh]*4", "hh*8 [~ oh]")),
+        bass=("[~ 0]*4", "0 [~ 0] 4 [~ 3]", "[~ 0] [~ 2] [~ 4] [~ 3]"),
+        bass_sounds=("sawtooth", "bass"),
+        chords=("<[0,2,4,6] [3,5,7,9]>", "[~ [0,2,4]]*2", "<[0,2,4] [4,6,8]>"),
+        chord_sounds=("piano", "supersaw"),
+        melodies=("0 2 4 7", "[0 4] [2 7] [4 9] [2 7]", "<0 2 4 2>*4", "~ 7 4 ~"),
+        lead_sounds=("pluck", "piano", "square"),
+        textures=('sound("~ ~ ~ sh").gain(0.2)', 'sound("[~ rim]*2").gain(0.3)'),
+        roots=("C", "D", "E", "F", "G", "A"),
+        slow=(0.9, 1.3),
+        mood="energetic",
+    ),
+    "techno": GenreLibrary(
+        label="techno",
+        kicks=(("bd*4",), ("bd*4", "bd*4 [~ bd]"), ("bd*4", "[bd bd] bd*3")),
+        snares=(("~ ~ cp ~",), ("~ cp ~ cp", "~ ~ cp ~"), ("~ cp ~ [cp ~ cp]", "~ [cp rim] ~ cp")),
+        hats=(("[~ hh]*4",), ("hh*16", "[~ hh]*4", "hh(5,8)"), ("hh*16", "hh(11,16)", "[hh hh oh hh]*4")),
+        bass=("0*8", "[0 ~ 0 0]*2", "0(3,8)", "0 ~ <0 1> ~"),
+        bass_sounds=("sawtooth", "square"),
+        chords=("[~ [0,2,4]]*2", "<[0,3,7] ~>"),
+        chord_sounds=("supersaw", "pad"),
+        melodies=("0(3,8)", "0 ~ 3 ~ 0 ~ 7 ~", "<0 3 5 7>*4"),
+        lead_sounds=("square", "sawtooth"),
+        textures=('sound("noise").gain(0.05).hpf(6000)', 'sound("rd*4").gain(0.2)'),
+        roots=("C", "D", "E", "F", "G", "A"),
+        slow=(0.8, 1.1),
+        mood="aggressive",
+    ),
+    "jazz": GenreLibrary(
+        label="jazz",
+        kicks=(("bd ~ ~ ~",), ("bd ~ ~ bd", "bd ~ [~ bd] ~"), ("bd [~ bd] ~ bd", "bd ~ bd [~ bd]")),
+        snares=(("~ ~ ~ rim",), ("~ sd ~ sd", "~ rim ~ [rim ~]"), ("~ sd [~ sd] sd", "[~ sd] sd ~ [sd sd]")),
+        hats=(("rd ~ rd rd",), ("rd [rd rd] rd [rd rd]", "hh ~ hh ~"), ("rd [rd rd] rd [rd rd]", "[rd rd rd]*4")),
+        bass=("0 2 4 5", "0 4 2 6", "<0 3> 2 <4 5> 6", "0 1 2 4"),
+        bass_sounds=("bass", "jvbass"),
+        chords=("<[1,3,5,7] [4,6,8,10] [0,2,4,6] [0,2,4,6]>", "<[0,2,4,6] [5,7,9,11] [1,3,5,7] [4,6,8,10]>"),
+        chord_sounds=("piano", "superpiano"),
+        melodies=("[0 2 4 6] ~ [7 6] 4", "~ [4 3] 2 [0 ~]", "<[7 6 4 2] [3 4 6 8]>", "4 ~ [6 4] 2"),
+        lead_sounds=("piano", "superpiano", "jazz"),
+        textures=('sound("~ ~ ~ cr").gain(0.15)',),
+        roots=("C", "Db", "Eb", "F", "G", "Ab", "Bb"),
+        slow=(1.4, 2.0),
+        mood="chill",
+    ),
+    "country": GenreLibrary(
+        label="country",
+        kicks=(("bd ~ bd ~",), ("bd ~ bd ~", "bd ~ bd bd"), ("bd bd ~ bd", "bd [~ bd] bd ~")),
+        snares=(("~ sd ~ sd",), ("~ sd ~ sd", "~ rim ~ sd"), ("~ sd ~ [sd sd]", "~ sd [~ sd] sd")),
+        hats=(("hh ~ hh ~",), ("hh*8", "[hh hh] ~ [hh hh] ~"), ("hh*8", "sh*8")),
+        bass=("0 4 0 4", "0 ~ 4 ~ 3 ~ 4 ~", "<0 3> 4 <0 3> 4"),
+        bass_sounds=("bass", "triangle"),
+        chords=("<[0,2,4] [4,6,8] [5,7,9] [3,5,7]>", "<[0,2,4] [3,5,7] [4,6,8] [0,2,4]>"),
+        chord_sounds=("guitar",),
+        melodies=("0 2 4 2", "[4 2] 0 [2 4] 5", "<0 2 4 5>*2", "4 ~ 2 [0 2]"),
+        lead_sounds=("guitar", "pluck", "violin"),
+        textures=('sound("~ ~ ~ cb").gain(0.15)',),
+        roots=("C", "D", "E", "G", "A"),
+        slow=(1.3, 1.9),
+        mood="happy",
+    ),
+    "hip-hop": GenreLibrary(
+        label="hip-hop",
+        kicks=(("bd ~ ~ ~",), ("bd ~ [~ bd] ~", "bd ~ ~ bd ~ bd ~ ~"), ("bd [~ bd] [~ bd] ~", "bd ~ bd [~ bd]")),
+        snares=(("~ ~ sd ~",), ("~ sd ~ sd", "~ sd ~ [~ sd]"), ("~ sd ~ [sd sd]", "~ [sd cp] ~ sd")),
+        hats=(("hh*4",), ("hh*8", "[hh hh] [hh oh]"), ("hh*8", "hh*16?")),
+        bass=("0 ~ ~ 3", "0 ~ 3 ~ ~ 4 ~ ~", "<0 -2> ~ 3 ~"),
+        bass_sounds=("bass", "sine"),
+        chords=("<[0,2,4,6] [3,5,7,9]>", "<[0,2,4] [5,7,9]>"),
+        chord_sounds=("piano", "superpiano", "pad"),
+        melodies=("~ 4 [3 2] ~", "<0 2 4 3>*2", "7 ~ ~ 4 ~ ~ 2 ~"),
+        lead_sounds=("bell", "piano", "arpy"),
+        textures=('sound("vinyl").gain(0.1)', 'sound("~ [~ cp] ~ ~").gain(0.3)'),
+        roots=("C", "D", "Eb", "F", "G", "A"),
+        slow=(1.4, 2.0),
+        mood="chill",
+    ),
+    "ambient": GenreLibrary(
+        label="ambient",
+        kicks=(("bd ~ ~ ~ ~ ~ ~ ~",), ("bd ~ ~ ~",), ("bd ~ ~ bd",)),
+        snares=(("~ ~ ~ ~ ~ ~ ~ rim",), ("~ ~ ~ rim",), ("~ ~ rim ~",)),
+        hats=(("~ ~ ~ hh",), ("hh ~ ~ hh", "~ hh ~ ~"), ("hh*4", "[~ hh]*2")),
+        bass=("<0 -3>", "<0 3 -2 4>", "0 ~ ~ ~"),
+        bass_sounds=("sine", "triangle"),
+        chords=("<[0,2,4,6] [3,5,7,9]>", "<[0,4,7] [5,9,12]>", "<[0,2,4] [-2,0,2] [3,5,7]>"),
+        chord_sounds=("pad", "superpiano"),
+        melodies=("<4 ~ 2 ~ 7 ~>", "~ 7 ~ ~ 9 ~ ~ ~", "<0 2 4 7 4 2>"),
+        lead_sounds=("bell", "kalimba", "sine"),
+        textures=('sound("wind").gain(0.1)', 'sound("space").gain(0.15).room(0.9)', 'sound("vinyl").gain(0.05)'),
+        roots=("C", "D", "E", "F", "G", "A", "B"),
+        slow=(2.0, 4.0),
+        mood="dreamy",
+    ),
+    "drum-and-bass": GenreLibrary(
+        label="drum and bass",
+        kicks=(("bd ~ ~ ~ ~ ~ bd ~",), ("bd ~ ~ ~ ~ [~ bd] ~ ~", "bd ~ ~ bd ~ ~ ~ ~"), ("bd ~ [~ bd] ~ ~ bd ~ ~", "bd ~ ~ [bd bd] ~ ~ bd ~")),
+        snares=(("~ ~ sd ~",), ("~ sd ~ sd", "~ ~ sd ~ ~ ~ sd ~"), ("~ sd ~ [~ sd]", "~ sd [~ sd] sd")),
+        hats=(("hh*8",), ("hh*8", "[hh hh oh hh]*2"), ("hh*16", "hh*16?")),
+        bass=("0 ~ ~ 0 ~ ~ 3 ~", "<0 -2> ~ 0 ~", "0 ~ [~ 0] ~ 3 ~ ~ ~"),
+        bass_sounds=("reese", "sawtooth", "sub"),
+        chords=("<[0,2,4] [5,7,9]>", "<[0,2,4,6] [3,5,7,9]>"),
+        chord_sounds=("pad", "supersaw"),
+        melodies=("0 ~ 4 ~ 7 ~ 4 ~", "<7 6 4 3>*2", "~ [4 7] ~ 2"),
+        lead_sounds=("pluck", "bell", "square"),
+        textures=('sound("amen").gain(0.3).hpf(400)', 'sound("breaks152").gain(0.25).hpf(300)'),
+        roots=("C", "D", "E", "F", "G", "A"),
+        slow=(0.6, 0.9),
+        mood="energetic",
+    ),
+}
+
+MOODS: Dict[str, Mood] = {
+    "chill": Mood(("dorian", "major", "minor"), -1, 0.8, (".room(0.4)", ".delay(0.25)", ".lpf(2000)"), ("Chill", "Laid-back", "Mellow")),
+    "dark": Mood(("minor", "phrygian"), 0, 0.6, (".room(0.7)", ".lpf(1200)", ".delay(0.3).room(0.5)"), ("Dark", "Brooding", "Moody")),
+    "happy": Mood(("major", "lydian", "mixolydian"), 1, 1.2, (".delay(0.125)", ".room(0.2)", ""), ("Bright", "Upbeat", "Sunny")),
+    "sad": Mood(("minor", "dorian"), -2, 0.7, (".room(0.6)", ".delay(0.375).room(0.4)"), ("Melancholic", "Wistful", "Blue")),
+    "dreamy": Mood(("lydian", "major"), -2, 0.9, (".room(0.9)", ".delay(0.5).room(0.7)"), ("Dreamy", "Floating", "Hazy")),
+    "energetic": Mood(("mixolydian", "minor", "major"), 2, 1.3, (".delay(0.125)", "", ".room(0.2)"), ("Driving", "Energetic", "Punchy")),
+    "aggressive": Mood(("phrygian", "minor"), 3, 1.1, (".distort(0.3)", ".shape(0.4)", ".crush(6)"), ("Aggressive", "Hard-hitting", "Relentless")),
+}
+
+# Words in a request (or in MusicDNA) that name a genre or a mood
+KEYWORDS: Dict[str, Tuple[str, str]] = {
+    **{word: ("genre", "lo-fi") for word in ("lo-fi", "lofi", "lo fi", "chillhop", "study beat", "study beats")},
+    **{word: ("genre", "trap") for word in ("trap", "drill", "808", "808s")},
+    **{word: ("genre", "house") for word in ("house", "deep house", "edm", "dance", "disco", "garage")},
+    **{word: ("genre", "techno") for word in ("techno", "rave", "industrial", "acid")},
+    **{word: ("genre", "jazz") for word in ("jazz", "jazzy", "swing", "bebop", "bossa", "bossa nova")},
+    **{word: ("genre", "country") for word in ("country", "folk", "bluegrass", "western", "acoustic")},
+    **{word: ("genre", "hip-hop") for word in ("hip-hop", "hip hop", "hiphop", "boom bap", "rap")},
+    **{word: ("genre", "ambient") for word in ("ambient", "drone", "meditation", "sleep", "soundscape")},
+    **{word: ("genre", "drum-and-bass") for word in (
+        "drum-and-bass", "drum and bass", "drum n bass", "drum & bass", "dnb", "d&b", "jungle", "breakbeat", "liquid"
+    )},
+    **{word: ("mood", "chill") for word in ("chill", "relaxed", "relaxing", "calm", "mellow", "smooth", "cozy")},
+    **{word: ("mood", "dark") for word in ("dark", "minor", "moody", "evil", "sinister", "night", "spooky")},
+    **{word: ("mood", "happy") for word in ("happy", "bright", "uplifting", "sunny", "cheerful", "major", "fun")},
+    **{word: ("mood", "sad") for word in ("sad", "melancholy", "melancholic", "emotional", "rainy", "lonely")},
+    **{word: ("mood", "dreamy") for word in ("dreamy", "ethereal", "floating", "spacey", "spacy", "hazy")},
+    **{word: ("mood", "energetic") for word in ("energetic", "upbeat", "hype", "party", "fast", "driving", "workout")},
+    **{word: ("mood", "aggressive") for word in ("aggressive", "hard", "heavy", "intense", "angry", "brutal")},
+}
+
+
+class KeywordIndex:
+    """Aho-Corasick automaton finding every keyword in a text in one pass.
+
+    Keywords only match as whole words ("rap" is not found in "trap").
+    """
+
+    def __init__(self, keywords: Mapping[str, Any]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        # Per state: (keyword length, value) of every keyword ending there
+        self._out: List[Tuple[Tuple[int, Any], ...]] = [()]
+
+        for keyword, value in keywords.items():
+            state = 0
+            for char in keyword.lower():
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._out[state] += ((len(keyword), value),)
+
+        # Breadth first, so a state's failure link is final before its children's
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, child in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._out[child] += self._out[self._fail[child]]
+                queue.append(child)
+
+    def find(self, text: str) -> List[Tuple[int, Any]]:
+        """(start offset, value) of each whole-word keyword in text, in order of where they end"""
+        text = text.lower()
+        goto, fail, out = self._goto, self._fail, self._out
+        found = []
+        state = 0
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, value in out[state]:
+                start = end - length
+                if (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum()):
+                    found.append((start, value))
+        return found
+
+
+KEYWORD_INDEX = KeywordIndex(KEYWORDS)
+
+
+@lru_cache(maxsize=4096)
+def match_keywords(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """The genre and the mood text asks for (the most mentioned, then the first), or None"""
+    counts: Dict[Tuple[str, str], List[int]] = {}
+    for start, key in KEYWORD_INDEX.find(text):
+        count_and_first = counts.setdefault(key, [0, start])
+        count_and_first[0] += 1
+        count_and_first[1] = min(count_and_first[1], start)
+
+    def best(kind: str) -> Optional[str]:
+        candidates = [(-count, first, value) for (key_kind, value), (count, first) in counts.items() if key_kind == kind]
+        return min(candidates)[2] if candidates else None
+
+    return best("genre"), best("mood")
+
+
+@dataclass(frozen=True)
+class FallbackPattern:
+    code: str
+    description: str
+    genre: str
+    mood: str
+    seed: int  # the same seed and inputs compose the same pattern again
+
+
+_seeds = random.Random()
+
+
+def _level(value: int, rng: random.Random) -> int:
+    """Density level 0-2 for an energy of 1-10, nudged up or down now and then"""
+    level = 0 if value <= 3 else 1 if value <= 7 else 2
+    nudge = rng.random()
+    if nudge < 0.15:
+        return max(level - 1, 0)
+    if nudge > 0.85:
+        return min(level + 1, 2)
+    return level
+
+
+def _number(value: float) -> str:
+    return f"{round(value, 2):g}"
+
+
+def _clamp(value: Any, default: int) -> int:
+    try:
+        return min(max(int(value), 1), 10)
+    except (TypeError, ValueError):
+        return default
+
+
+def _dna(music_dna: Any) -> Mapping[str, Any]:
+    if music_dna is None:
+        return {}
+    if isinstance(music_dna, Mapping):
+        return music_dna
+    # A pydantic MusicDNA model
+    return music_dna.model_dump()
+
+
+def generate_fallback(user_input: str, music_dna: Any = None, seed: Optional[int] = None) -> FallbackPattern:
+    """Compose a fallback pattern for a request.
+
+    Genre and mood come from the request text, then from MusicDNA's
+    primaryGenre, preferredMood and keywords; energyLevel sets drum density,
+    loudness, filter cutoffs and tempo, and complexity the number of melodic
+    layers and variations. Without a seed every call composes a different
+    pattern; the seed used is returned so a pattern can be reproduced.
+    """
+    dna = _dna(music_dna)
+    if seed is None:
+        seed = _seeds.getrandbits(32)
+    rng = random.Random(seed)
+
+    genre, mood = match_keywords(user_input or "")
+    keywords: Iterable[Any] = dna.get("keywords") or ()
+    dna_genre, dna_mood = match_keywords(" ".join(
+        str(part) for part in (dna.get("primaryGenre"), dna.get("preferredMood"), *keywords) if part
+    ))
+    genre = genre or dna_genre or DEFAULT_GENRE
+    library = GENRES[genre]
+    mood = mood or dna_mood or library.mood
+    feel = MOODS[mood]
+    energy = min(max(_clamp(dna.get("energyLevel"), 5) + feel.energy_shift, 1), 10)
+    complexity = _clamp(dna.get("complexity"), 5)
+
+    level = _level(energy, rng)
+    loudness = 1 + 0.04 * (energy - 5)
+    root = rng.choice(library.roots)
+    mode = rng.choice(feel.modes)
+    cutoff = (250 + 50 * energy) * feel.brightness
+
+    hats = f'sound("{rng.choice(library.hats[level])}").gain({_number(0.35 * loudness)})'
+    if complexity >= 6 and rng.random() < 0.5:
+        hats += rng.choice((".every(4, x => x.fast(2))", ".sometimesBy(0.2, x => x.speed(2))", ".pan(sine.slow(4))"))
+    layers = [
+        f'sound("{rng.choice(library.kicks[level])}").gain({_number(0.8 * loudness)})',
+        f'sound("{rng.choice(library.snares[level])}").gain({_number(0.6 * loudness)})',
+        hats,
+    ]
+    parts = ["drums"]
+
+    bass = (
+        f'n("{rng.choice(library.bass)}").scale("{root}2:{mode}").sound("{rng.choice(library.bass_sounds)}")'
+        f'.lpf({round(cutoff, -1):g}).gain({_number(0.6 * loudness)})'
+    )
+    chords = (
+        f'n("{rng.choice(library.chords)}").scale("{root}3:{mode}").sound("{rng.choice(library.chord_sounds)}")'
+        f'.room(0.5).gain({_number(0.3 * loudness)})'
+    )
+    melody = (
+        f'n("{rng.choice(library.melodies)}").scale("{root}4:{mode}").sound("{rng.choice(library.lead_sounds)}")'
+        f'{rng.choice(feel.lead_effects)}.gain({_number(0.35 * loudness)})'
+    )
+    if complexity >= 8 and rng.random() < 0.5:
+        melody += rng.choice((".off(0.125, x => x.add(2))", ".jux(rev)", ".every(3, x => x.rev())"))
+    melodic = [("bass", bass), ("chords", chords), ("melody", melody)]
+    # One melodic layer at complexity 1-3, two at 4-6, all three from 7
+    count = 1 + (complexity >= 4) + (complexity >= 7)
+    for name, layer in (melodic[index] for index in sorted(rng.sample(range(3), count))):
+        layers.append(layer)
+        parts.append(name)
+
+    if library.textures and rng.random() < (0.9 if genre == "lo-fi" else 0.4):
+        layers.append(rng.choice(library.textures))
+        parts.append("texture")
+
+    slowest, fastest = library.slow[1], library.slow[0]
+    slow = slowest - (slowest - fastest) * (energy - 1) / 9 + rng.uniform(-0.1, 0.1)
+    code = "stack(\n  " + ",\n  ".join(layers) + f"\n).slow({max(round(slow, 1), 0.5):g})"
+
+    description = (
+        f"{rng.choice(feel.adjectives)} {library.label} pattern in {root} {mode} "
+        f"with {', '.join(parts[:-1])} and {parts[-1]}"
+    )
+    return FallbackPattern(code=code, description=description, genre=genre, mood=mood, seed=seed)
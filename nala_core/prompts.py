@@ -0,0 +1,318 @@
+"""
+Nala AI - Prompt templates and response parsing shared by every entry point
+The static prompt prefixes are built once; only the compact request-specific
+suffix is rendered per request. Response patterns are compiled at import.
+"""
+
+import json
+import re
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Response parsing
+
+# CODE:/DESCRIPTION: responses (STRUDEL_PROMPT)
+CODE_SECTION = re.compile(r'CODE:\s*(.*?)(?=DESCRIPTION:|$)', re.DOTALL | re.IGNORECASE)
+DESCRIPTION_LINE = re.compile(r'DESCRIPTION:\s*(.*?)(?:\n|$)', re.IGNORECASE)
+CODE_FENCE = re.compile(r'```(?:javascript|js)?')
+
+# Free-text responses (MUSIC_PROMPT)
+CODE_BLOCK = re.compile(r'```.*?```', re.DOTALL)
+DESCRIPTION_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE | re.DOTALL)
+    for pattern in (
+        r'Description:\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+        r'This pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+        r'I created\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+        r'The pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)',
+    )
+]
+DESCRIPTION_KEYWORDS = ('pattern', 'music', 'create', 'generate', 'beat', 'rhythm')
+
+
+def parse_code_description(ai_text: str) -> Tuple[str, str]:
+    """Code (without markdown fences) and description of a CODE:/DESCRIPTION: response; empty when missing"""
+    code_match = CODE_SECTION.search(ai_text)
+    desc_match = DESCRIPTION_LINE.search(ai_text)
+    code = CODE_FENCE.sub('', code_match.group(1)).strip() if code_match else ""
+    description = desc_match.group(1).strip() if desc_match else ""
+    return code, description
+
+
+def extract_description(ai_response: str, user_input: str) -> str:
+    """Extract description from a free-text AI response"""
+
+    # Remove code blocks
+    text = CODE_BLOCK.sub('', ai_response)
+
+    # Look for description patterns
+    for pattern in DESCRIPTION_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            desc = match.group(1).strip()
+            if len(desc) > 10:  # Ensure it's a meaningful description
+                return desc[:200] + ('...' if len(desc) > 200 else '')
+
+    # Fallback: use first meaningful sentence
+    for sentence in text.split('.'):
+        sentence = sentence.strip()
+        if len(sentence) > 20 and any(word in sentence.lower() for word in DESCRIPTION_KEYWORDS):
+            return sentence + '.'
+
+    return f"AI-generated musical pattern based on: {user_input}"
+
+
+# Prompt templates
+
+def compact_json(value: Any) -> str:
+    """JSON without indentation or spaces after separators: the same content in fewer prompt tokens"""
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+class PromptTemplate:
+    """A static prefix followed by a request-specific suffix.
+
+    The prefix never changes, so it is kept first: the model server can
+    reuse its KV cache across requests. The suffix is a str.format template
+    rendered per request.
+    """
+
+    def __init__(self, prefix: str, suffix: str):
+        self.prefix = prefix
+        self.suffix = suffix
+
+    def render_suffix(self, **fields: Any) -> str:
+        return self.suffix.format_map(fields)
+
+    def render(self, **fields: Any) -> str:
+        return self.prefix + self.render_suffix(**fields)
+
+
+_MUSIC_PREFIX = """You are Nala, an expert AI music producer and composer with deep knowledge of electronic music, rhythm programming, and the Strudel live coding language.
+
+Your task is to generate a unique Strudel pattern that perfectly matches the user's request.
+
+IMPORTANT GUIDELINES:
+1. Analyze the user's musical intent, genre preferences, and emotional context
+2. Use proper Strudel syntax with functions like: stack(), sound(), note(), gain(), lpf(), hpf(), room(), delay(), slow(), fast()
+3. Create rhythmic patterns using drum sounds: "bd" (kick), "sd" (snare), "hh" (hihat), "oh" (open hihat), "cp" (clap)
+4. Use musical notation for melodies: "c4", "d4", "e4", etc., or chord names like "Cmaj7", "Dm"
+5. Apply appropriate effects and filters based on the requested style
+6. Make each pattern unique and creative while staying true to the genre
+7. Consider tempo, energy level, and complexity based on the request
+8. Always wrap your Strudel code in triple backticks with 'strudel' language tag
+
+EXAMPLE STRUDEL PATTERNS:
+
+Trap:
+```strudel
+stack(
+  sound("bd*2 ~ bd ~").gain(0.8),
+  sound("~ ~ sd ~").gain(0.7),
+  sound("hh*16").gain(0.4),
+  sound("808").note("c1 ~ f1 g1").lpf(80)
+)
+```
+
+Lo-Fi:
+```strudel
+stack(
+  sound("bd ~ ~ ~").gain(0.6),
+  sound("~ ~ sd ~").gain(0.5),
+  sound("hh*4").gain(0.3),
+  note("c2 ~ f1 g1").sound("sawtooth").lpf(400),
+  sound("vinyl").gain(0.1)
+)
+```
+
+House:
+```strudel
+stack(
+  sound("bd*4").gain(0.8),
+  sound("~ ~ sd ~").gain(0.6),
+  sound("hh*8").gain(0.4),
+  note("c3 ~ e3 g3").sound("pluck").delay(0.25).lpf(2000)
+)
+```
+
+Respond with:
+1. The Strudel code wrapped in ```strudel and ```
+2. A brief description of what you created and why it fits the request
+3. Any reasoning about musical choices you made
+
+"""
+
+# Free-text prompt: a ```strudel block plus a description (RunPod handler and music_api_wrapper)
+MUSIC_PROMPT = PromptTemplate(_MUSIC_PREFIX, """User Request: "{user_input}"
+
+Context:
+- Musical DNA: {music_dna}
+- Context: {context}
+
+Now generate a unique Strudel pattern for: "{user_input}"
+
+Pattern:""")
+
+
+def music_prompt_suffix(user_input: str, music_dna: Optional[Dict] = None, context: Optional[Dict] = None) -> str:
+    """Request-specific part of MUSIC_PROMPT"""
+    return MUSIC_PROMPT.render_suffix(
+        user_input=user_input,
+        music_dna=compact_json(music_dna) if music_dna else 'Not provided',
+        context=compact_json(context) if context else 'Not provided',
+    )
+
+
+# Prompt budgeting
+
+# Request fields that cost tokens without telling the model anything musical
+LOW_VALUE_FIELDS = frozenset({
+    "userAgent", "timestamp", "sessionId", "requestId", "userId", "ip", "referrer",
+    "screenSize", "viewport", "locale", "timezone",
+})
+# What is left of MusicDNA when even the compacted version does not fit
+ESSENTIAL_DNA_FIELDS = ("primaryGenre", "preferredMood", "energyLevel")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token) for when no tokenizer is at hand"""
+    return (len(text) + 3) // 4
+
+
+def compact_fields(data: Optional[Dict], name: str) -> Tuple[Optional[Dict], List[str]]:
+    """data without low-value and empty fields, and the dotted names of what was dropped"""
+    if not data:
+        return None, []
+    kept = {}
+    dropped = []
+    for key, value in data.items():
+        if key in LOW_VALUE_FIELDS or value is None or value == "" or value == [] or value == {}:
+            dropped.append(f"{name}.{key}")
+        else:
+            kept[key] = value
+    return kept or None, dropped
+
+
+@dataclass(frozen=True)
+class BudgetedPrompt:
+    suffix: str
+    tokens: int
+    dropped: Tuple[str, ...]  # fields left out to save tokens (or to fit)
+    clipped: bool  # whether the user request itself had to be shortened
+
+
+def budget_music_prompt_suffix(
+    user_input: str,
+    music_dna: Optional[Dict],
+    context: Optional[Dict],
+    max_tokens: int,
+    count_tokens: Callable[[str], int] = estimate_tokens,
+) -> BudgetedPrompt:
+    """The richest MUSIC_PROMPT suffix that fits in max_tokens.
+
+    Low-value fields (userAgent, timestamps, empty values) are always
+    dropped. If the suffix is still too long, MusicDNA is cut down to its
+    essentials, then the context goes, then MusicDNA. The user request and the
+    closing instruction are never dropped; only when they alone exceed the
+    budget is the request shortened. Nothing is cut from the end, where
+    the instruction sits.
+    """
+    dna, dropped_dna = compact_fields(music_dna, "musicDNA")
+    ctx, dropped_context = compact_fields(context, "context")
+    dropped = dropped_dna + dropped_context
+    essential_dna = {key: dna[key] for key in ESSENTIAL_DNA_FIELDS if key in dna} or None if dna else None
+
+    candidates = [(dna, ctx, [])]
+    if dna and essential_dna != dna:
+        candidates.append((essential_dna, ctx, ["musicDNA (non-essential)"]))
+    if ctx:
+        candidates.append((essential_dna, None, candidates[-1][2] + ["context"]))
+    if essential_dna:
+        candidates.append((None, None, ["context"] * bool(ctx) + ["musicDNA"]))
+
+    for candidate_dna, candidate_context, reduced in candidates:
+        suffix = music_prompt_suffix(user_input, candidate_dna, candidate_context)
+        tokens = count_tokens(suffix)
+        if tokens <= max_tokens:
+            return BudgetedPrompt(suffix, tokens, tuple(dropped + reduced), False)
+
+    # Even the bare request is too long: keep as much of its start as fits
+    low, high = 0, len(user_input)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(music_prompt_suffix(user_input[:middle] + "…")) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    suffix = music_prompt_suffix(user_input[:low] + "…")
+    return BudgetedPrompt(suffix, count_tokens(suffix), tuple(dropped + reduced), True)
+
+
+_STRUDEL_PREFIX = """You are Nala AI, an expert music generation system specializing in Strudel.js code patterns. 
+
+STRUDEL.JS REQUIREMENTS:
+1. Generate ONLY valid Strudel.js code using stack(), sound(), note(), and effects
+2. Use appropriate sound sources: bd (kick), sd (snare), hh (hi-hat), 808 (bass)
+3. Include rhythm, melody, and harmonic elements
+4. Apply effects like reverb(), delay(), lpf(), hpf(), gain()
+5. Match the requested genre style and mood
+
+RESPONSE FORMAT (REQUIRED):
+CODE: [your strudel code here]
+DESCRIPTION: [brief description of the pattern]
+
+EXAMPLE for trap:
+CODE: stack(
+  sound("bd*2 ~ bd ~").gain(0.8),
+  sound("~ ~ sd ~").gain(0.7).delay(0.1),
+  sound("hh*16").gain(0.4).hpf(8000),
+  note("c1 ~ f1 g1").sound("808").lpf(80).gain(0.9)
+)
+DESCRIPTION: Dark trap beat with rolling 808s and crisp hi-hats
+
+"""
+
+# CODE:/DESCRIPTION: prompt with genre guidance (music_api and music_api_fixed)
+STRUDEL_PROMPT = PromptTemplate(_STRUDEL_PREFIX, """USER REQUEST: "{user_input}"
+
+MUSICAL CONTEXT:
+- Genre: {genre}
+- Mood: {mood}
+- Energy Level: {energy}/10
+- Time: {time_of_day}
+- Activity: {activity}
+
+GENRE GUIDANCE for {genre_upper}:
+- Match the {genre} genre style with {mood} mood
+- Typical patterns: {patterns}
+- Common effects: {effects}
+- Energy level: {genre_energy}
+
+Now generate a Strudel.js pattern for: "{user_input}"
+""")
+
+
+def strudel_prompt_suffix(
+    user_input: str,
+    genre: str,
+    mood: str,
+    energy: int,
+    time_of_day: str,
+    activity: str,
+    patterns: Iterable[str],
+    effects: Iterable[str],
+    genre_energy: str,
+) -> str:
+    """Request-specific part of STRUDEL_PROMPT"""
+    return STRUDEL_PROMPT.render_suffix(
+        user_input=user_input,
+        genre=genre,
+        genre_upper=genre.upper(),
+        mood=mood,
+        energy=energy,
+        time_of_day=time_of_day,
+        activity=activity,
+        patterns=', '.join(patterns),
+        effects=', '.join(effects),
+        genre_energy=genre_energy,
+    )
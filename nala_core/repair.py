@@ -0,0 +1,274 @@
+"""
+Nala AI - Deterministic repair of near-valid Strudel patterns
+Fixes the mistakes models make most often so a pattern that almost parses
+does not cost a fallback or another generation
+"""
+
+import difflib
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from .syntax import (
+    _MINI_TOKEN, _TOKEN, NESTING_TOO_DEEP, PLAIN_STRING_FUNCTIONS, Call, Literal, Operation, ValidationResult, _Parser, validate_strudel
+)
+
+# Sounds every Strudel install knows, plus the ones our prompts and fallbacks use
+KNOWN_SOUNDS = {
+    # Drums (dirt-samples and the drum machine banks)
+    "bd", "sd", "sn", "hh", "oh", "cp", "rim", "lt", "mt", "ht", "cb", "cr", "rd",
+    "perc", "tabla", "808", "808bd", "808sd", "808hc", "808oh", "808lt", "808mt",
+    "808ht", "808cy", "909", "amen", "breaks125", "breaks152", "jungle", "hc", "ho",
+    "sh", "tb", "misc", "fx", "click", "clak", "noise", "noise2",
+    # Synths
+    "sine", "sawtooth", "saw", "square", "triangle", "tri", "white", "pink", "brown",
+    "supersaw", "pulse", "sbd", "zzfx",
+    # Instruments and textures
+    "piano", "bass", "bass1", "bass2", "bass3", "jvbass", "pad", "pluck", "guitar",
+    "vinyl", "bell", "kalimba", "jazz", "casio", "metal", "east", "crow", "wind",
+    "space", "arpy", "superpiano", "reese", "sub", "tape", "violin", "cello", "synth",
+}
+
+# Words models use for drum parts, mapped to the sample that plays them
+SOUND_ALIASES = {
+    "kick": "bd", "kickdrum": "bd", "bassdrum": "bd", "snare": "sd", "snaredrum": "sd",
+    "hihat": "hh", "hat": "hh", "hats": "hh", "closedhat": "hh", "openhat": "oh",
+    "clap": "cp", "handclap": "cp", "ride": "rd", "crash": "cr", "cymbal": "cr",
+    "tom": "mt", "rimshot": "rim", "cowbell": "cb", "shaker": "sh",
+}
+
+SOUND_FUNCTIONS = {"sound", "s"}
+
+# Allowed values for numeric effect parameters
+VALUE_RANGES = {
+    "gain": (0.0, 1.5),
+    "lpf": (20.0, 20000.0),
+    "cutoff": (20.0, 20000.0),
+    "hpf": (20.0, 20000.0),
+}
+
+_FENCE_LINE = re.compile(r"^[ \t]*```[\w-]*[ \t]*$\n?", re.MULTILINE)
+# An info string left on its own line after the backticks were stripped
+_FENCE_TAG_LINE = re.compile(r"\A\s*(?:strudel|javascript|js)[ \t]*\n")
+_THINK = re.compile(r"<think>.*?</think>|</?think>", re.DOTALL)
+_TRAILING_LINK = re.compile(r"[\s.,]+\Z")
+
+_CLOSERS = {"(": ")", "[": "]", "{": "}"}
+_MINI_CLOSERS = {"[": "]", "<": ">", "{": "}"}
+
+
+@dataclass(frozen=True)
+class RepairResult:
+    code: str
+    fixes: Tuple[str, ...]
+    validation: ValidationResult
+    was_valid: bool  # whether the code parsed before any repair
+
+    @property
+    def valid(self) -> bool:
+        return self.validation.valid
+
+
+def repair_strudel(code: str) -> RepairResult:
+    """Repair a generated pattern as far as deterministic rules allow.
+
+    Text-level fixes come first (markdown fences, <think> remnants, dangling
+    chain links, unbalanced brackets and strings) so the code parses; then
+    fixes on the parsed calls: brackets inside mini-notation, unknown sample
+    names mapped to the nearest known sound, out-of-range gain/lpf values
+    clamped. Valid patterns are never rewritten: a sample name we do not
+    know may well be one the user loaded. Code nested deeper than the parser
+    follows is returned unchanged, and invalid.
+    """
+    fixes: List[str] = []
+    validation = validate_strudel(code)
+    if validation.valid or _too_deep(validation):
+        return RepairResult(code, (), validation, validation.valid)
+
+    repaired = _fix_calls(_balance_brackets(_clean_text(code, fixes), fixes), fixes)
+    repaired_validation = validate_strudel(repaired)
+    if _too_deep(repaired_validation):
+        # Closing brackets only showed how deep it goes
+        return RepairResult(code, (), validation, False)
+    return RepairResult(repaired, tuple(fixes), repaired_validation, False)
+
+
+def _too_deep(validation: ValidationResult) -> bool:
+    return any(NESTING_TOO_DEEP in issue.message for issue in validation.errors)
+
+
+def _clean_text(code: str, fixes: List[str]) -> str:
+    cleaned = _THINK.sub("", code)
+    if cleaned != code:
+        fixes.append("removed <think> remnants")
+    code = cleaned
+
+    cleaned = _FENCE_TAG_LINE.sub("", _FENCE_LINE.sub("", code)).replace("```", "")
+    if cleaned != code:
+        fixes.append("removed markdown fences")
+    code = cleaned.strip()
+
+    cleaned = _TRAILING_LINK.sub("", code)
+    if cleaned != code.rstrip():
+        fixes.append("removed a dangling chain link")
+    return cleaned
+
+
+def _balance_brackets(code: str, fixes: List[str]) -> str:
+    """Close unterminated strings, drop stray closers and close open brackets"""
+    while True:
+        unterminated = None
+        open_brackets: List[str] = []
+        stray: List[int] = []
+        for match in _TOKEN.finditer(code):
+            text = match.group()
+            if match.lastgroup == "invalid" and text in "\"'`":
+                unterminated = match.start()
+                break
+            if match.lastgroup != "punct":
+                continue
+            if text in _CLOSERS:
+                open_brackets.append(text)
+            elif text in ")]}":
+                if open_brackets and _CLOSERS[open_brackets[-1]] == text:
+                    open_brackets.pop()
+                else:
+                    stray.append(match.start())
+
+        if unterminated is None:
+            break
+        end = _string_end(code, unterminated)
+        code = code[:end] + code[unterminated] + code[end:]
+        fixes.append(f"closed an unterminated {code[unterminated]} string")
+
+    for position in reversed(stray):
+        fixes.append(f"removed a stray '{code[position]}'")
+        code = code[:position] + code[position + 1:]
+    if open_brackets:
+        closing = "".join(_CLOSERS[bracket] for bracket in reversed(open_brackets))
+        fixes.append(f"closed {len(open_brackets)} unbalanced bracket(s) with '{closing}'")
+        code = code.rstrip().rstrip(",") + closing
+    return code
+
+
+def _string_end(code: str, start: int) -> int:
+    """Where an unterminated string starting at start most likely ended.
+
+    Before the first ')' on its line that closes the enclosing call, or else
+    at the end of the line (before any trailing punctuation).
+    """
+    line_end = code.find("\n", start)
+    if line_end == -1:
+        line_end = len(code)
+    depth = 0
+    for position in range(start + 1, line_end):
+        if code[position] == "(":
+            depth += 1
+        elif code[position] == ")":
+            if depth == 0:
+                return position
+            depth -= 1
+    while line_end > start + 1 and code[line_end - 1] in "),; \t":
+        line_end -= 1
+    return line_end
+
+
+def _fix_calls(code: str, fixes: List[str]) -> str:
+    parser = _Parser(code)
+    if parser.parse() is None:
+        return code
+
+    edits: List[Tuple[int, int, str]] = []
+    for call in parser.calls:
+        if call.name in VALUE_RANGES and call.args:
+            edit = _clamp(code, call, fixes)
+            if edit:
+                edits.append(edit)
+        for arg in call.args:
+            if isinstance(arg, Literal) and arg.kind == "string" and arg.quote in "\"`" and call.name not in PLAIN_STRING_FUNCTIONS:
+                text = _fix_mini_brackets(arg.value, fixes)
+                if call.name in SOUND_FUNCTIONS:
+                    text = _map_sounds(text, fixes)
+                if text != arg.value:
+                    edits.append((arg.position + 1, arg.position + 1 + len(arg.value), text))
+
+    for start, end, replacement in sorted(edits, reverse=True):
+        code = code[:start] + replacement + code[end:]
+    return code
+
+
+def _clamp(code: str, call: Call, fixes: List[str]) -> Optional[Tuple[int, int, str]]:
+    arg = call.args[0]
+    negative = isinstance(arg, Operation) and arg.operator == "-" and isinstance(arg.operands[0], Literal)
+    literal = arg.operands[0] if negative else arg
+    if not isinstance(literal, Literal) or literal.kind != "number":
+        return None
+
+    value = -literal.value if negative else literal.value
+    low, high = VALUE_RANGES[call.name]
+    clamped = min(max(value, low), high)
+    if clamped == value:
+        return None
+
+    start = arg.position if negative else literal.position
+    end = _TOKEN.match(code, literal.position).end()
+    text = f"{clamped:g}"
+    fixes.append(f"clamped {call.name}({code[start:end]}) to {text}")
+    return start, end, text
+
+
+def _fix_mini_brackets(text: str, fixes: List[str]) -> str:
+    open_brackets: List[str] = []
+    stray: List[int] = []
+    for match in _MINI_TOKEN.finditer(text):
+        char = match.group()
+        if match.lastgroup != "op":
+            continue
+        if char in _MINI_CLOSERS:
+            open_brackets.append(char)
+        elif char in "]>}":
+            if open_brackets and _MINI_CLOSERS[open_brackets[-1]] == char:
+                open_brackets.pop()
+            else:
+                stray.append(match.start())
+
+    for position in reversed(stray):
+        fixes.append(f"removed a stray '{text[position]}' from \"{text}\"")
+        text = text[:position] + text[position + 1:]
+    if open_brackets:
+        closing = "".join(_MINI_CLOSERS[bracket] for bracket in reversed(open_brackets))
+        fixes.append(f"closed '{closing}' in \"{text}\"")
+        text = text.rstrip() + closing
+    return text
+
+
+def _map_sounds(text: str, fixes: List[str]) -> str:
+    edits = []
+    for match in _MINI_TOKEN.finditer(text):
+        if match.lastgroup != "word":
+            continue
+        name = match.group().split(":", 1)[0]
+        if name in KNOWN_SOUNDS or name.startswith("gm_") or name.lstrip("-").replace(".", "", 1).isdigit():
+            continue
+        known = nearest_sound(name)
+        if known:
+            fixes.append(f"mapped sound {name!r} to {known!r}")
+            edits.append((match.start(), match.start() + len(name), known))
+
+    for start, end, replacement in reversed(edits):
+        text = text[:start] + replacement + text[end:]
+    return text
+
+
+def nearest_sound(name: str) -> Optional[str]:
+    """The known sound closest to name, or None when nothing is close"""
+    lowered = name.lower()
+    if lowered in KNOWN_SOUNDS:
+        return lowered
+    alias = SOUND_ALIASES.get(lowered) or SOUND_ALIASES.get(lowered.rstrip("s"))
+    if alias:
+        return alias
+    matches = difflib.get_close_matches(lowered, KNOWN_SOUNDS | SOUND_ALIASES.keys(), n=1, cutoff=0.7)
+    if not matches:
+        return None
+    return SOUND_ALIASES.get(matches[0], matches[0])
@@ -0,0 +1,42 @@
+"""
+Field projection for API and job responses
+Callers name the fields they want ("code", "metadata.genre") instead of
+receiving every field, raw model output included
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+
+def parse_fields(fields: Union[str, Iterable[str], None]) -> List[str]:
+    """Field names from a list or a comma-separated string; empty for all fields"""
+    if not fields:
+        return []
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    return [name.strip() for name in fields if name and name.strip()]
+
+
+def project_fields(response: Dict[str, Any], fields: Union[str, Iterable[str], None], required: Iterable[str] = ()) -> Dict[str, Any]:
+    """The requested fields of response, plus the required ones; all of it when no fields are named.
+
+    A dotted name ("metadata.genre") selects inside a nested dict. Names the
+    response does not have are left out rather than rejected.
+    """
+    names = parse_fields(fields)
+    if not names:
+        return response
+
+    projected: Dict[str, Any] = {}
+    for name in [*required, *names]:
+        source: Optional[Any] = response
+        *parents, leaf = name.split(".")
+        for parent in parents:
+            source = source.get(parent) if isinstance(source, dict) else None
+        if not (isinstance(source, dict) and leaf in source):
+            continue
+        # Only a field that exists gets its parents created
+        target = projected
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        target[leaf] = source[leaf]
+    return projected
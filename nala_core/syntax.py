@@ -0,0 +1,606 @@
+"""
+Nala AI - Strudel syntax validation
+A small recursive-descent parser for the JavaScript method-chain subset that
+Strudel patterns are written in, plus the mini-notation inside pattern strings
+"""
+
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# Functions that make sound on their own; a pattern needs at least one
+SOUND_SOURCES = {"sound", "s", "note", "n", "chord", "freq"}
+
+KNOWN_FUNCTIONS = SOUND_SOURCES | {
+    # Pattern constructors
+    "stack", "cat", "seq", "sequence", "fastcat", "slowcat", "timeCat", "timecat",
+    "polymeter", "polyrhythm", "arrange", "silence", "pure", "mini", "run", "irand",
+    "rand", "perlin", "sine", "cosine", "saw", "square", "tri", "choose", "chooseCycles",
+    "samples", "setcps", "setCps", "setcpm", "hush", "register",
+    # Time
+    "slow", "fast", "hurry", "early", "late", "rev", "palindrome", "iter", "iterBack",
+    "ply", "chop", "striate", "slice", "splice", "loopAt", "fit", "segment", "range",
+    "every", "firstOf", "lastOf", "when", "sometimes", "sometimesBy", "often", "rarely",
+    "almostNever", "almostAlways", "someCycles", "someCyclesBy", "degrade", "degradeBy",
+    "undegradeBy", "jux", "juxBy", "off", "superimpose", "layer", "echo", "stut",
+    "struct", "mask", "euclid", "euclidRot", "euclidLegato", "inside", "outside",
+    "swing", "swingBy", "brak", "linger", "zoom", "compress", "clip", "legato",
+    "mul", "add", "sub", "div", "set", "apply", "color", "pianoroll", "punchcard",
+    "scope", "spiral", "velocity", "orbit", "cpm",
+    # Tonal
+    "scale", "transpose", "scaleTranspose", "voicing", "voicings", "arp", "rootNotes",
+    "octave", "dict", "mode", "anchor",
+    # Sound and effects
+    "bank", "gain", "postgain", "amp", "pan", "speed", "unit", "begin", "end", "cut",
+    "lpf", "cutoff", "ctf", "lpq", "resonance", "hpf", "hcutoff", "hpq", "bpf",
+    "bandf", "bpq", "vowel", "room", "size", "roomsize", "dry", "delay",
+    "delaytime", "delayfeedback", "delayfb", "crush", "coarse", "shape", "distort",
+    "attack", "decay", "sustain", "release", "adsr", "hold", "tremolo", "phaser",
+    "leslie", "lpenv", "hpenv", "bpenv", "fm", "fmh", "vib", "vibrato", "detune",
+    "penv", "squiz", "waveloss", "compressor", "duck", "analyze",
+}
+
+# Calls whose string arguments are plain strings rather than mini-notation
+PLAIN_STRING_FUNCTIONS = {"samples", "register", "color"}
+
+_TOKEN = re.compile(r"""
+    (?P<space>[ \t\r\n]+|//[^\n]*|/\*.*?\*/)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_$][\w$]*)
+  | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*'|`(?:[^`\\]|\\.)*`)
+  | (?P<arrow>=>)
+  | (?P<punct>[()\[\]{},.:;=+\-*/%?!<>&|])
+  | (?P<invalid>.)
+""", re.VERBOSE | re.DOTALL)
+
+# End tokens appended after the real ones, so lookahead never runs off the list
+_END_PADDING = 4
+
+# Deepest nesting either parser follows before reporting an error; far past
+# any real pattern, well short of Python's recursion limit
+MAX_NESTING = 100
+NESTING_TOO_DEEP = f"Nesting too deep (more than {MAX_NESTING} levels)"
+
+_MINI_TOKEN = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<word>-?[A-Za-z0-9#^'$][\w#^'$.:-]*|-?\.\d+)
+  | (?P<op>[\[\]<>{}(),|*/!@?%~_.:-])
+""", re.VERBOSE)
+
+_MINI_CLOSERS = {"[": "]", "<": ">", "{": "}", "(": ")"}
+
+
+@dataclass(frozen=True)
+class SyntaxIssue:
+    """A problem found in a pattern, located by offset, line and column"""
+
+    kind: str  # "syntax", "mini_notation" or "semantic"
+    message: str
+    offset: int
+    line: int
+    column: int
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "message": self.message,
+            "line": self.line,
+            "column": self.column,
+        }
+
+
+# AST
+
+@dataclass
+class Literal:
+    kind: str  # "number" or "string"
+    value: Union[float, str]
+    position: int
+    quote: str = ""
+
+
+@dataclass
+class Name:
+    name: str
+    position: int
+
+
+@dataclass
+class Call:
+    name: str
+    args: List[Any]
+    target: Optional[Any]  # receiver of a method call, None for a plain function
+    position: int
+
+
+@dataclass
+class Member:
+    name: str
+    target: Any
+    position: int
+
+
+@dataclass
+class Collection:
+    kind: str  # "array" or "object"
+    items: List[Any]
+    position: int
+
+
+@dataclass
+class Arrow:
+    params: List[str]
+    body: Any
+    position: int
+
+
+@dataclass
+class Operation:
+    operator: str
+    operands: List[Any]
+    position: int
+
+
+@dataclass
+class Binding:
+    kind: str  # "assign" or "label"
+    name: str
+    value: Any
+    position: int
+
+
+@dataclass
+class Program:
+    statements: List[Any] = field(default_factory=list)
+
+
+@dataclass(frozen=True)
+class ValidationResult:
+    valid: bool
+    errors: Tuple[SyntaxIssue, ...]
+    warnings: Tuple[SyntaxIssue, ...]
+    ast: Optional[Program]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "valid": self.valid,
+            "errors": [issue.to_dict() for issue in self.errors],
+            "warnings": [issue.to_dict() for issue in self.warnings],
+        }
+
+
+class _StopParsing(Exception):
+    pass
+
+
+class _Parser:
+    """Recursive-descent parser over the method-chain subset of JavaScript.
+
+    Statements are expressions (optionally `const x = ...` bindings or
+    `$:`-style labels) separated by semicolons or newlines; expressions are
+    literals, names, calls, member chains, arrays, objects, arrow functions
+    and arithmetic. The first syntax error stops parsing.
+    """
+
+    def __init__(self, code: str):
+        self.code = code
+        self.errors: List[SyntaxIssue] = []
+        self.calls: List[Call] = []
+        self.bound_names = set()
+        self.tokens = self._tokenize()
+        self.index = 0
+        self.depth = 0
+
+    # Issues
+
+    def issue(self, kind: str, message: str, offset: int) -> SyntaxIssue:
+        line = self.code.count("\n", 0, offset) + 1
+        column = offset - (self.code.rfind("\n", 0, offset) + 1) + 1
+        return SyntaxIssue(kind, message, offset, line, column)
+
+    def fail(self, message: str, offset: int) -> None:
+        self.errors.append(self.issue("syntax", message, offset))
+        raise _StopParsing()
+
+    # Tokens
+
+    def _tokenize(self) -> List[Tuple[str, str, int]]:
+        tokens = []
+        for match in _TOKEN.finditer(self.code):
+            kind = match.lastgroup
+            if kind == "space":
+                continue
+            if kind == "invalid":
+                char = match.group()
+                if char in "\"'`":
+                    self.errors.append(self.issue("syntax", f"Unterminated {char} string", match.start()))
+                else:
+                    self.errors.append(self.issue("syntax", f"Unexpected character {char!r}", match.start()))
+                break
+            tokens.append((kind, match.group(), match.start()))
+        tokens.extend([("end", "", len(self.code))] * _END_PADDING)
+        return tokens
+
+    def peek(self, ahead: int = 0) -> Tuple[str, str, int]:
+        return self.tokens[self.index + ahead]
+
+    def advance(self) -> Tuple[str, str, int]:
+        token = self.tokens[self.index]
+        if token[0] != "end":
+            self.index += 1
+        return token
+
+    def accept(self, value: str) -> bool:
+        kind, text, _ = self.tokens[self.index]
+        if text == value and kind in ("punct", "arrow"):
+            self.index += 1
+            return True
+        return False
+
+    def newline_before(self, position: int) -> bool:
+        """Whether a line break separates the last token consumed from the one at position"""
+        _, text, start = self.tokens[self.index - 1]
+        return "\n" in self.code[start + len(text):position]
+
+    def expect(self, value: str, context: str) -> int:
+        kind, text, position = self.peek()
+        if text != value or kind not in ("punct", "arrow"):
+            found = "end of pattern" if kind == "end" else repr(text)
+            self.fail(f"Expected '{value}' {context}, found {found}", position)
+        self.index += 1
+        return position
+
+    # Grammar
+
+    def parse(self) -> Optional[Program]:
+        if self.errors:
+            return None
+        program = Program()
+        try:
+            while self.peek()[0] != "end":
+                if self.accept(";"):
+                    continue
+                program.statements.append(self.statement())
+                kind, text, position = self.peek()
+                if kind != "end" and text != ";" and not self.newline_before(position):
+                    self.fail(f"Expected ';' or a new line before {text!r}", position)
+        except _StopParsing:
+            return None
+        return program
+
+    def statement(self) -> Any:
+        kind, text, position = self.peek()
+        if kind == "name" and text in ("const", "let", "var"):
+            self.advance()
+            name_kind, name, _ = self.advance()
+            if name_kind != "name":
+                self.fail("Expected a name after " + text, position)
+            self.expect("=", f"after {text} {name}")
+            self.bound_names.add(name)
+            return Binding("assign", name, self.expression(), position)
+        if kind == "name" and self.peek(1)[1] == ":" and self.peek(1)[0] == "punct":
+            self.index += 2
+            return Binding("label", text, self.expression(), position)
+        return self.expression()
+
+    def expression(self) -> Any:
+        left = self.unary()
+        while self.peek()[0] == "punct" and self.peek()[1] in "+-*/%":
+            _, operator, position = self.advance()
+            left = Operation(operator, [left, self.unary()], position)
+        return left
+
+    def unary(self) -> Any:
+        # Every nested expression passes through here
+        kind, text, position = self.peek()
+        if self.depth >= MAX_NESTING:
+            self.fail(NESTING_TOO_DEEP, position)
+        self.depth += 1
+        try:
+            if kind == "punct" and text in "-+!":
+                self.advance()
+                return Operation(text, [self.unary()], position)
+            return self.postfix(self.primary())
+        finally:
+            self.depth -= 1
+
+    def postfix(self, node: Any) -> Any:
+        while True:
+            kind, text, position = self.peek()
+            if kind != "punct":
+                return node
+            if text == ".":
+                self.advance()
+                name_kind, name, name_position = self.advance()
+                if name_kind != "name":
+                    self.fail("Expected a method name after '.'", name_position)
+                if self.accept("("):
+                    node = self.finish_call(name, node, name_position)
+                else:
+                    node = Member(name, node, name_position)
+            elif text == "(":
+                self.advance()
+                callee = node.name if isinstance(node, (Name, Member)) else ""
+                target = node.target if isinstance(node, Member) else None
+                node = self.finish_call(callee, target, position)
+            elif text == "[":
+                self.advance()
+                index = self.expression()
+                self.expect("]", "to close the index")
+                node = Operation("[]", [node, index], position)
+            else:
+                return node
+
+    def finish_call(self, name: str, target: Any, position: int) -> Call:
+        args = self.arguments(")", f"to close {name or 'the'}(...) call")
+        call = Call(name, args, target, position)
+        self.calls.append(call)
+        return call
+
+    def arguments(self, closer: str, context: str) -> List[Any]:
+        items = []
+        while not self.accept(closer):
+            if self.peek()[0] == "end":
+                self.fail(f"Expected '{closer}' {context}, found end of pattern", self.peek()[2])
+            items.append(self.expression())
+            if not self.accept(","):
+                self.expect(closer, context)
+                break
+        return items
+
+    def primary(self) -> Any:
+        kind, text, position = self.advance()
+        if kind == "number":
+            return Literal("number", float(text), position)
+        if kind == "string":
+            return Literal("string", text[1:-1], position, quote=text[0])
+        if kind == "name":
+            if self.accept("=>"):
+                self.bound_names.add(text)
+                return Arrow([text], self.arrow_body(), position)
+            return Name(text, position)
+        if kind == "punct" and text == "(":
+            params = self.arrow_params()
+            if params is not None:
+                self.bound_names.update(params)
+                return Arrow(params, self.arrow_body(), position)
+            inner = self.expression()
+            self.expect(")", "to close the parenthesis")
+            return inner
+        if kind == "punct" and text == "[":
+            return Collection("array", self.arguments("]", "to close the array"), position)
+        if kind == "punct" and text == "{":
+            return Collection("object", self.object_entries(), position)
+        found = "end of pattern" if kind == "end" else repr(text)
+        self.fail(f"Unexpected {found}", position)
+
+    def arrow_params(self) -> Optional[List[str]]:
+        """Parameters of `(a, b) => ...` if that is what follows, consuming them"""
+        ahead = 0
+        params = []
+        while True:
+            kind, text, _ = self.peek(ahead)
+            if kind == "punct" and text == ")" and not params:
+                break
+            if kind != "name":
+                return None
+            params.append(text)
+            kind, text, _ = self.peek(ahead + 1)
+            ahead += 2
+            if text == ")":
+                ahead -= 1
+                break
+            if text != ",":
+                return None
+        if self.peek(ahead + 1)[0] != "arrow":
+            return None
+        self.index += ahead + 2
+        return params
+
+    def arrow_body(self) -> Any:
+        if self.peek()[1] == "{" and self.peek()[0] == "punct":
+            self.fail("Arrow function bodies in braces are not supported", self.peek()[2])
+        return self.expression()
+
+    def object_entries(self) -> List[Any]:
+        entries = []
+        while not self.accept("}"):
+            kind, key, position = self.advance()
+            if kind not in ("name", "string", "number"):
+                self.fail("Expected an object key", position)
+            self.expect(":", "after the object key")
+            entries.append(Binding("assign", key, self.expression(), position))
+            if not self.accept(","):
+                self.expect("}", "to close the object")
+                break
+        return entries
+
+
+class _MiniParser:
+    """Parser for Strudel mini-notation ("bd*2 [~ sd] <hh oh>(3,8)")"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.tokens: List[Tuple[str, str, int]] = []
+        self.index = 0
+        self.depth = 0
+        self.error: Optional[Tuple[str, int]] = None
+
+    def parse(self) -> Optional[Tuple[str, int]]:
+        """Returns (message, offset in the string) for the first problem, or None"""
+        try:
+            self._tokenize()
+            self.sequence(None)
+        except _StopParsing:
+            pass
+        return self.error
+
+    def fail(self, message: str, offset: int) -> None:
+        self.error = (message, offset)
+        raise _StopParsing()
+
+    def _tokenize(self) -> None:
+        position = 0
+        while position < len(self.text):
+            match = _MINI_TOKEN.match(self.text, position)
+            if match is None:
+                self.fail(f"Unexpected character {self.text[position]!r}", position)
+            if match.lastgroup != "space":
+                self.tokens.append((match.lastgroup, match.group(), position))
+            position = match.end()
+        self.tokens.append(("end", "", len(self.text)))
+
+    def peek(self) -> Tuple[str, str, int]:
+        return self.tokens[self.index]
+
+    def advance(self) -> Tuple[str, str, int]:
+        token = self.tokens[self.index]
+        if token[0] != "end":
+            self.index += 1
+        return token
+
+    def sequence(self, closer: Optional[str], opener_position: int = 0) -> int:
+        """Terms up to closer, with , | and . separators; returns the number of terms"""
+        if self.depth >= MAX_NESTING:
+            self.fail(NESTING_TOO_DEEP, opener_position)
+        self.depth += 1
+        try:
+            return self._sequence(closer, opener_position)
+        finally:
+            self.depth -= 1
+
+    def _sequence(self, closer: Optional[str], opener_position: int) -> int:
+        terms = 0
+        while True:
+            kind, text, position = self.peek()
+            if kind == "end":
+                if closer is not None:
+                    self.fail(f"Missing '{closer}'", opener_position)
+                return terms
+            if kind == "op" and text == closer:
+                self.advance()
+                return terms
+            if kind == "op" and text in ",|.":
+                self.advance()
+                continue
+            if kind == "op" and text in "]>})":
+                self.fail(f"Unexpected '{text}'", position)
+            self.term()
+            terms += 1
+
+    def term(self) -> None:
+        kind, text, position = self.advance()
+        if kind == "op" and text in "[<{":
+            if not self.sequence(_MINI_CLOSERS[text], position):
+                self.fail(f"Empty '{text}{_MINI_CLOSERS[text]}' group", position)
+            if text == "{" and self.peek()[1] == "%":
+                self.advance()
+                self.number("after '%'")
+        elif kind == "op" and text in "~-_!":
+            pass
+        elif kind != "word":
+            self.fail(f"Unexpected '{text}'", position)
+        self.modifiers()
+
+    def modifiers(self) -> None:
+        while True:
+            kind, text, position = self.peek()
+            if kind != "op":
+                return
+            if text in "*/":
+                self.advance()
+                factor_kind, factor, factor_position = self.peek()
+                if factor_kind == "op" and factor in "[<":
+                    self.advance()
+                    self.sequence(_MINI_CLOSERS[factor], factor_position)
+                elif factor_kind == "word":
+                    self.advance()
+                else:
+                    self.fail(f"Expected a number after '{text}'", position)
+            elif text == "@":
+                self.advance()
+                self.number("after '@'")
+            elif text in "!?":
+                self.advance()
+                if self.peek()[0] == "word" and self.peek()[1][:1].isdigit():
+                    self.advance()
+            elif text == ":":
+                self.advance()
+                if self.advance()[0] != "word":
+                    self.fail("Expected a sample index after ':'", position)
+            elif text == "(":
+                self.advance()
+                parts = self.euclid_args(position)
+                if parts not in (2, 3):
+                    self.fail("Euclidean rhythms take 2 or 3 arguments, e.g. (3,8)", position)
+            else:
+                return
+
+    def euclid_args(self, opener_position: int) -> int:
+        parts = 1
+        while True:
+            kind, text, position = self.advance()
+            if kind == "end":
+                self.fail("Missing ')'", opener_position)
+            if kind == "op" and text == ")":
+                return parts
+            if kind == "op" and text == ",":
+                parts += 1
+            elif kind == "op" and text in "[<":
+                self.sequence(_MINI_CLOSERS[text], position)
+            elif kind != "word" and not (kind == "op" and text in "~-"):
+                self.fail(f"Unexpected '{text}' in euclidean rhythm", position)
+
+    def number(self, context: str) -> None:
+        kind, text, position = self.advance()
+        if kind != "word":
+            self.fail(f"Expected a number {context}", position)
+
+
+@lru_cache(maxsize=4096)
+def _mini_notation_problem(text: str) -> Optional[Tuple[str, int]]:
+    return _MiniParser(text).parse()
+
+
+def parse_strudel(code: str) -> ValidationResult:
+    """Parse a pattern into an AST and check it; see validate_strudel"""
+    parser = _Parser(code)
+    if not code.strip():
+        return ValidationResult(False, (parser.issue("syntax", "Empty pattern", 0),), (), None)
+    program = parser.parse()
+    errors = list(parser.errors)
+    warnings = []
+
+    if program is not None:
+        for call in parser.calls:
+            if call.name in PLAIN_STRING_FUNCTIONS:
+                continue
+            for arg in call.args:
+                if isinstance(arg, Literal) and arg.kind == "string" and arg.quote in "\"`":
+                    problem = _mini_notation_problem(arg.value)
+                    if problem:
+                        message, offset = problem
+                        errors.append(parser.issue(
+                            "mini_notation", f"{message} in \"{arg.value}\"", arg.position + 1 + offset
+                        ))
+
+        for call in parser.calls:
+            if call.name and call.name not in KNOWN_FUNCTIONS and call.name not in parser.bound_names:
+                warnings.append(parser.issue("semantic", f"Unknown function {call.name}()", call.position))
+
+        if not any(call.name in SOUND_SOURCES for call in parser.calls):
+            errors.append(parser.issue("semantic", "No sound source: use sound(), s(), note() or n()", 0))
+
+    return ValidationResult(not errors, tuple(errors), tuple(warnings), program)
+
+
+@lru_cache(maxsize=1024)
+def validate_strudel(code: str) -> ValidationResult:
+    """Validate a Strudel pattern.
+
+    Results are cached by code, so re-validating a cached or fallback
+    pattern is a dictionary lookup. The result (and its AST) is shared
+    between callers and must not be modified.
+    """
+    return parse_strudel(code)
@@ -0,0 +1,206 @@
+"""
+Nala AI - Admission control in front of Ollama
+Limits concurrent generations, queues the overflow by priority lane and
+rejects early when the queue cannot be drained before the caller's deadline
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+# Lower number = served first
+DEFAULT_LANES = {"interactive": 0, "bulk": 1}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted before its deadline"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class AdmissionTicket:
+    """A granted slot that is released exactly once"""
+
+    def __init__(self, controller: "AdmissionController", granted_at: float):
+        self._controller = controller
+        self._granted_at = granted_at
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._controller.release(self._granted_at)
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "lane", "future", "enqueued_at")
+
+    def __init__(self, priority: int, seq: int, lane: str, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.lane = lane
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionController:
+    """Concurrency limiter with a bounded priority queue.
+
+    The expected wait for a newcomer is estimated from the number of
+    requests ahead of it in the queue and an EWMA of how long a slot is held;
+    if that exceeds the caller's deadline it is rejected immediately with a
+    Retry-After hint instead of timing out later.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 2,
+        max_queue: int = 32,
+        lanes: Optional[Dict[str, int]] = None,
+        initial_service_time: float = 10.0,
+        ewma_alpha: float = 0.2,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.lanes = lanes or dict(DEFAULT_LANES)
+        self.service_time = initial_service_time
+        self.ewma_alpha = ewma_alpha
+
+        self.active = 0
+        self._queue: List[_Waiter] = []
+        self._queued = 0
+        self._seq = itertools.count()
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.lane_depth: Dict[str, int] = {lane: 0 for lane in self.lanes}
+
+    def estimated_wait(self, lane: str) -> float:
+        """Seconds a new request in this lane would likely wait for a slot"""
+        if self.active < self.max_concurrency and not self._queued:
+            return 0.0
+        priority = self.lanes[lane]
+        ahead = sum(
+            1 for waiter in self._queue
+            if not waiter.future.done() and waiter.priority <= priority
+        )
+        return (ahead // self.max_concurrency + 1) * self.service_time
+
+    async def acquire(self, lane: str = "interactive", deadline: Optional[float] = None) -> float:
+        """Wait for a generation slot; returns the monotonic time it was granted.
+
+        deadline is the number of seconds the caller is willing to wait.
+        """
+        if lane not in self.lanes:
+            raise ValueError(f"Unknown admission lane: {lane}")
+
+        if self.active < self.max_concurrency and not self._queued:
+            self.active += 1
+            self._record_admission(0.0)
+            return time.monotonic()
+
+        if self._queued >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected("Generation queue is full", self.estimated_wait(lane))
+
+        expected = self.estimated_wait(lane)
+        if deadline is not None and expected > deadline:
+            self.rejected += 1
+            raise AdmissionRejected("Estimated queue wait exceeds deadline", expected)
+
+        waiter = _Waiter(self.lanes[lane], next(self._seq), lane, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, waiter)
+        self._queued += 1
+        self.lane_depth[lane] += 1
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout=deadline)
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            self.timed_out += 1
+            raise AdmissionRejected("Timed out waiting for a generation slot", self.estimated_wait(lane))
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+        waited = time.monotonic() - waiter.enqueued_at
+        self._record_admission(waited)
+        return time.monotonic()
+
+    def release(self, granted_at: Optional[float] = None) -> None:
+        """Give a slot back, handing it straight to the next waiter if any"""
+        if granted_at is not None:
+            held = time.monotonic() - granted_at
+            self.service_time += self.ewma_alpha * (held - self.service_time)
+
+        while self._queue:
+            waiter = heapq.heappop(self._queue)
+            if waiter.future.done():
+                continue
+            self._dequeued(waiter)
+            # The slot passes to the waiter without ever becoming free
+            waiter.future.set_result(None)
+            return
+
+        self.active -= 1
+
+    async def ticket(self, lane: str = "interactive", deadline: Optional[float] = None) -> AdmissionTicket:
+        """Acquire a slot whose release is handed to someone else, e.g. a response stream"""
+        return AdmissionTicket(self, await self.acquire(lane, deadline))
+
+    @asynccontextmanager
+    async def admit(self, lane: str = "interactive", deadline: Optional[float] = None) -> AsyncIterator[None]:
+        granted_at = await self.acquire(lane, deadline)
+        try:
+            yield
+        finally:
+            self.release(granted_at)
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        if waiter.future.done() and not waiter.future.cancelled():
+            # Granted a slot just as we gave up on it; pass it on
+            self.release()
+            return
+        waiter.future.cancel()
+        self._dequeued(waiter)
+
+    def _dequeued(self, waiter: _Waiter) -> None:
+        self._queued -= 1
+        self.lane_depth[waiter.lane] -= 1
+
+    def _record_admission(self, waited: float) -> None:
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self._queued,
+            "max_queue": self.max_queue,
+            "lane_depth": dict(self.lane_depth),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_seconds": round(self.total_wait / self.admitted, 4) if self.admitted else 0.0,
+            "max_wait_seconds": round(self.max_wait, 4),
+            "service_time_seconds": round(self.service_time, 4),
+        }
@@ -0,0 +1,365 @@
+"""
+Nala AI - Routing across several Ollama backends
+Power-of-two-choices on in-flight requests weighted by EWMA latency, with
+passive ejection of failing backends, affinity for already-loaded models,
+and hedging and timeouts driven by recent latency percentiles
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set, TypeVar
+
+import httpx
+
+from deadlines import DeadlineExceeded, budget
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def parse_backend_urls(value: str) -> List[str]:
+    """Base URLs from a comma-separated list of URLs or host:port pairs"""
+    urls = []
+    for item in value.split(","):
+        item = item.strip().rstrip("/")
+        if item:
+            urls.append(item if "://" in item else f"http://{item}")
+    return urls
+
+
+def model_key(name: str) -> str:
+    """Model names as Ollama lists them ("llama3" is "llama3:latest")"""
+    return name if ":" in name else f"{name}:latest"
+
+
+def request_kind(path: str, payload: Dict[str, Any]) -> str:
+    """Latency window for a request: its endpoint, plus its num_predict rounded up to a power of two.
+
+    An 8-token warmup and a full generation take very different times; in
+    one window, a run of short requests would make the next long one look stuck.
+    """
+    limit = (payload.get("options") or {}).get("num_predict")
+    if not isinstance(limit, int) or limit <= 0:
+        return path
+    return f"{path}:{1 << (limit - 1).bit_length()}"
+
+
+class StuckRequest(httpx.TimeoutException):
+    """An attempt abandoned for running far past its kind's recent p99"""
+
+
+def is_backend_failure(exc: BaseException) -> bool:
+    """Whether an error counts against the backend: anything but a 4xx or the caller running out of time"""
+    if isinstance(exc, DeadlineExceeded):
+        return False
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status is None or status >= 500
+
+
+class LatencyWindow:
+    """Durations of the most recent requests, for percentiles"""
+
+    __slots__ = ("samples",)
+
+    def __init__(self, size: int = 512):
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def observe(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, quantile: float) -> Optional[float]:
+        return _percentile(sorted(self.samples), quantile)
+
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self.samples)
+        return {
+            "count": len(ordered),
+            **{f"p{round(quantile * 100)}": _percentile(ordered, quantile, 3) for quantile in (0.5, 0.95, 0.99)},
+        }
+
+
+def _percentile(ordered: List[float], quantile: float, digits: Optional[int] = None) -> Optional[float]:
+    if not ordered:
+        return None
+    value = ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+    return value if digits is None else round(value, digits)
+
+
+class Backend:
+    __slots__ = ("url", "in_flight", "latency", "requests", "errors", "failures", "ejections", "ejected_until", "models")
+
+    def __init__(self, url: str, initial_latency: float):
+        self.url = url
+        self.in_flight = 0
+        self.latency = initial_latency  # EWMA of request time, seconds
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0  # consecutive
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Models loaded on the backend, None until known (from /api/ps or a load)
+        self.models: Optional[Set[str]] = None
+
+    def may_have(self, model: str) -> bool:
+        return self.models is None or model_key(model) in self.models
+
+    @property
+    def load(self) -> float:
+        """Expected time to serve one more request"""
+        return (self.in_flight + 1) * self.latency
+
+    def stats(self, now: float) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "in_flight": self.in_flight,
+            "ewma_latency": round(self.latency, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "ejected_for": round(max(0.0, self.ejected_until - now), 1),
+            "models": sorted(self.models) if self.models is not None else None,
+        }
+
+
+class BackendPool:
+    """Pick an Ollama backend per request and learn from how it went.
+
+    Among the backends that are not ejected (leaving out those known not to
+    have the model loaded, unless that is all of them), two are drawn at random and the one
+    with the lower (in_flight + 1) * EWMA latency wins. failure_threshold
+    consecutive failures eject a backend for ejection_seconds, doubling on
+    each ejection in a row; after that it gets traffic again, but a single
+    further failure ejects it again until it has served a request. If every
+    backend is ejected, the one due back soonest is used rather than none.
+
+    request() also keeps a window of recent durations per kind of request
+    (see request_kind): once it has min_samples, an attempt running past the
+    hedge_quantile of them can be hedged on another backend, and one running
+    past stuck_factor times their p99 is abandoned as stuck, with
+    StuckRequest, which does not count against the backend.
+    """
+
+    def __init__(
+        self,
+        urls: Iterable[str],
+        ewma_alpha: float = 0.3,
+        initial_latency: float = 1.0,
+        failure_threshold: int = 3,
+        ejection_seconds: float = 30.0,
+        max_ejection_seconds: float = 300.0,
+        is_failure: Callable[[BaseException], bool] = is_backend_failure,
+        hedge_quantile: float = 0.95,
+        stuck_factor: float = 3.0,
+        min_samples: int = 20,
+        rng: Optional[random.Random] = None,
+    ):
+        self.backends = [Backend(url, initial_latency) for url in urls]
+        if not self.backends:
+            raise ValueError("BackendPool needs at least one backend URL")
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.max_ejection_seconds = max_ejection_seconds
+        self.is_failure = is_failure
+        self.hedge_quantile = hedge_quantile
+        self.stuck_factor = stuck_factor
+        self.min_samples = min_samples
+        self.latencies: Dict[str, LatencyWindow] = {}
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.deadlines_exceeded = 0
+        self._random = rng or random.Random()
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def pick(self, model: Optional[str] = None, exclude: Iterable[Backend] = ()) -> Backend:
+        now = time.monotonic()
+        eligible = [backend for backend in self.backends if backend not in exclude] or self.backends
+        candidates = [backend for backend in eligible if backend.ejected_until <= now]
+        if not candidates:
+            return min(eligible, key=lambda backend: backend.ejected_until)
+
+        if model:
+            # Loading a model takes far longer than waiting behind a request or two
+            warm = [backend for backend in candidates if backend.may_have(model)]
+            if warm:
+                candidates = warm
+        if len(candidates) == 1:
+            return candidates[0]
+        first, second = self._random.sample(candidates, 2)
+        return first if first.load <= second.load else second
+
+    @asynccontextmanager
+    async def acquire(self, model: Optional[str] = None, exclude: Iterable[Backend] = ()) -> AsyncIterator[Backend]:
+        """A backend for one request; its outcome and duration are recorded on exit"""
+        backend = self.pick(model, exclude)
+        backend.in_flight += 1
+        backend.requests += 1
+        start = time.monotonic()
+        succeeded = None
+        try:
+            yield backend
+            succeeded = True
+        except (GeneratorExit, StuckRequest):
+            # Neither a success nor a failure: a stream closed early by its
+            # reader took less time than a whole request, and slow is not
+            # broken. The slot is freed without touching the EWMA latency or
+            # the failure count, so routing and ejection stay honest.
+            raise
+        except Exception as exc:
+            succeeded = not self.is_failure(exc)
+            raise
+        finally:
+            backend.in_flight -= 1
+            if succeeded:
+                self._succeeded(backend, model, time.monotonic() - start)
+            elif succeeded is not None:
+                self._failed(backend)
+
+    def latency(self, kind: str) -> LatencyWindow:
+        window = self.latencies.get(kind)
+        if window is None:
+            window = self.latencies[kind] = LatencyWindow()
+        return window
+
+    def hedge_delay(self, kind: str) -> Optional[float]:
+        """How long an attempt runs before it is hedged, or None if it is not (yet)"""
+        window = self.latency(kind)
+        if len(self.backends) < 2 or len(window) < self.min_samples:
+            return None
+        return window.percentile(self.hedge_quantile)
+
+    def attempt_timeout(self, kind: str, timeout: float) -> float:
+        """timeout, cut to stuck_factor times the p99 of recent requests of this kind"""
+        window = self.latency(kind)
+        if self.stuck_factor and len(window) >= self.min_samples:
+            return min(timeout, self.stuck_factor * window.percentile(0.99))
+        return timeout
+
+    async def request(
+        self,
+        model: Optional[str],
+        send: Callable[[Backend, float], Awaitable[T]],
+        timeout: float,
+        kind: str,
+        hedge: bool = False,
+    ) -> T:
+        """send(backend, timeout) on a backend from the pool, within the current request deadline.
+
+        A backend that cannot be reached is swapped for another. With hedge,
+        an attempt still running after hedge_delay() gets a duplicate on
+        another backend; the first to succeed wins and the other is
+        cancelled, which makes Ollama stop generating for it.
+        """
+        tried: List[Backend] = []
+        delay = self.hedge_delay(kind) if hedge else None
+        if delay is None:
+            return await self._attempt(model, send, timeout, kind, tried)
+
+        attempts = [asyncio.ensure_future(self._attempt(model, send, timeout, kind, tried))]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done:
+                self.hedged += 1
+                logger.info(f"🪞 Hedging a {kind} request still running after {delay:.2f}s")
+                attempts.append(asyncio.ensure_future(self._attempt(model, send, timeout, kind, tried)))
+
+            pending = set(attempts)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not attempts[0]:
+                            self.hedge_wins += 1
+                        return attempt.result()
+            # Every attempt failed
+            raise attempts[0].exception()
+        finally:
+            for attempt in attempts:
+                if not attempt.done():
+                    attempt.cancel()
+
+    async def _attempt(self, model: Optional[str], send: Callable[[Backend, float], Awaitable[T]], timeout: float, kind: str, tried: List[Backend]) -> T:
+        while True:
+            limit = self.attempt_timeout(kind, timeout)
+            try:
+                attempt_timeout = budget(limit)
+            except DeadlineExceeded:
+                self.deadlines_exceeded += 1
+                raise
+            try:
+                async with self.acquire(model, exclude=tried) as backend:
+                    tried.append(backend)
+                    start = time.monotonic()
+                    try:
+                        result = await send(backend, attempt_timeout)
+                    except httpx.TimeoutException as e:
+                        if attempt_timeout < limit:
+                            self.deadlines_exceeded += 1
+                            raise DeadlineExceeded(f"request deadline passed waiting on {backend.url}") from e
+                        if limit < timeout:
+                            logger.warning(f"⏱️ Abandoned a stuck {kind} request on {backend.url} after {limit:.1f}s")
+                            raise StuckRequest(f"no response from {backend.url} after {limit:.1f}s") from e
+                        raise
+                    self.latency(kind).observe(time.monotonic() - start)
+                    return result
+            except httpx.ConnectError:
+                if len(tried) >= len(self.backends):
+                    raise
+                logger.warning(f"🔀 Ollama backend {backend.url} unreachable, trying another")
+
+    def _succeeded(self, backend: Backend, model: Optional[str], elapsed: float) -> None:
+        if backend.ejections:
+            logger.info(f"✅ Ollama backend {backend.url} is serving again")
+        backend.latency += self.ewma_alpha * (elapsed - backend.latency)
+        backend.failures = 0
+        backend.ejections = 0
+        if model and backend.models is not None:
+            backend.models.add(model_key(model))
+
+    def _failed(self, backend: Backend) -> None:
+        backend.errors += 1
+        backend.failures += 1
+        if backend.failures >= self.failure_threshold:
+            seconds = min(self.ejection_seconds * 2 ** backend.ejections, self.max_ejection_seconds)
+            backend.ejections += 1
+            backend.ejected_until = time.monotonic() + seconds
+            # It may have been restarted by the time it is back
+            backend.models = None
+            logger.warning(f"🚫 Ejected Ollama backend {backend.url} for {seconds:.0f}s after {backend.failures} failure(s)")
+
+    async def refresh_models(self, get: Callable[..., Awaitable[Any]]) -> None:
+        """Learn which models each reachable backend has loaded from Ollama's /api/ps.
+
+        get is an httpx-style client.get; unreachable backends are left as they are.
+        """
+        async def refresh(backend: Backend) -> None:
+            try:
+                response = await get(f"{backend.url}/api/ps", timeout=5.0)
+                response.raise_for_status()
+                backend.models = {model_key(model["name"]) for model in response.json().get("models", [])}
+            except Exception:
+                pass
+
+        await asyncio.gather(*(refresh(backend) for backend in self.backends))
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "backends": [backend.stats(now) for backend in self.backends],
+            "available": sum(backend.ejected_until <= now for backend in self.backends),
+            "latency": {kind: window.stats() for kind, window in self.latencies.items()},
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "deadlines_exceeded": self.deadlines_exceeded,
+        }
@@ -0,0 +1,56 @@
+"""
+Nala AI - Request deadlines
+The time an incoming request has left, carried through every upstream call
+it makes so nothing keeps waiting on Ollama after the caller has given up
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional
+
+# Seconds the caller will wait; the RunPod handler sends it to the music APIs
+DEADLINE_HEADER = "X-Request-Timeout"
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before an upstream call finished"""
+
+
+def parse_timeout(value: Any, default: float) -> float:
+    """Seconds from a DEADLINE_HEADER value or job field, at most default"""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return default
+    return min(seconds, default) if seconds > 0 else default
+
+
+@contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """Run the block under a deadline seconds from now, or the enclosing one if that is sooner"""
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None outside of one"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def budget(timeout: float) -> float:
+    """timeout, cut to the time left before the current deadline"""
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("request deadline passed")
+    return min(timeout, left)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Nala AI - Startup diagnostics for the Ollama deployment
+Reports import-time budgets and checks Ollama without building any of the apps
+
+    python diagnostics.py                      # all modules
+    python diagnostics.py music_api_wrapper    # just one
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import Any, Dict, List, Tuple
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", os.getenv("DEEPSEEK_MODEL", "deepseek-r1:8b"))
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+MODULES = ["music_api_wrapper", "music_api", "handler"]
+
+
+def import_timings(module: str) -> Tuple[int, List[Tuple[int, str]]]:
+    """Cumulative import time of a module and of each of its direct imports, in microseconds.
+
+    Parsed from python -X importtime output ("import time: self | cumulative |
+    name", with the name indented two spaces per nesting level), run in a
+    fresh interpreter so nothing is already cached.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=HERE,
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))},
+        capture_output=True,
+        text=True,
+    )
+    total = 0
+    children = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth == 0 and name == module:
+            total = int(parts[1])
+        elif depth == 1:
+            children.append((int(parts[1]), name))
+    return total, sorted(children, reverse=True)
+
+
+def ollama_get(path: str) -> Dict[str, Any]:
+    with urllib.request.urlopen(f"{OLLAMA_URL}{path}", timeout=5) as response:
+        return json.loads(response.read())
+
+
+def check_ollama() -> bool:
+    """Is Ollama up, is the model pulled, and is it loaded (and pinned) in memory?"""
+    start = time.perf_counter()
+    try:
+        pulled = [model["name"] for model in ollama_get("/api/tags").get("models", [])]
+    except Exception as e:
+        print(f"❌ Ollama not reachable at {OLLAMA_URL}: {e}")
+        return False
+    print(f"✅ Ollama reachable at {OLLAMA_URL} ({(time.perf_counter() - start) * 1000:.0f}ms)")
+
+    if OLLAMA_MODEL not in pulled:
+        print(f"❌ {OLLAMA_MODEL} not pulled (available: {', '.join(pulled) or 'none'})")
+        return False
+    print(f"✅ {OLLAMA_MODEL} pulled")
+
+    try:
+        loaded = {model["name"]: model for model in ollama_get("/api/ps").get("models", [])}
+    except Exception:
+        loaded = {}
+    if OLLAMA_MODEL in loaded:
+        print(f"✅ {OLLAMA_MODEL} loaded, expires {loaded[OLLAMA_MODEL].get('expires_at', 'never')}")
+    else:
+        print(f"⚠️ {OLLAMA_MODEL} not loaded yet; the first request will pay for the load")
+    return True
+
+
+def main() -> int:
+    modules = sys.argv[1:] or MODULES
+    for module in modules:
+        total, children = import_timings(module)
+        if not total:
+            print(f"❌ import {module} failed")
+            continue
+        print(f"📦 import {module}: {total / 1000:.1f}ms")
+        for microseconds, name in children[:8]:
+            print(f"   {microseconds / 1000:8.1f}ms  {name}")
+
+    return 0 if check_ollama() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Nala AI - Fake Ollama server for offline load tests
+Answers /api/generate and /api/chat (streaming or not) with a canned Strudel
+pattern at a configurable prefill latency and token rate, with optional
+injected errors and stalls, and reports durations the way Ollama does
+
+    python fake_ollama.py                                # "fast" profile on :11434
+    python fake_ollama.py --profile gpu --port 11435
+    python fake_ollama.py --profile fast --error-rate 0.1
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, fields, replace
+from typing import Any, AsyncIterator, Dict, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass(frozen=True)
+class Profile:
+    prefill_seconds: float  # time to first token
+    tokens_per_second: float
+    jitter: float = 0.0  # +/- fraction applied to both
+    parallel: int = 4  # generations at once, like OLLAMA_NUM_PARALLEL; the rest queue
+    error_rate: float = 0.0  # requests answered with a 500
+    stall_rate: float = 0.0  # requests that hang for stall_seconds first
+    stall_seconds: float = 30.0
+
+
+PROFILES = {
+    # Next to no model time: what is left is the API's own overhead
+    "fast": Profile(prefill_seconds=0.005, tokens_per_second=2000),
+    # deepseek-r1:8b on an RTX 4090, roughly
+    "gpu": Profile(prefill_seconds=0.15, tokens_per_second=40, jitter=0.1),
+    "slow": Profile(prefill_seconds=1.0, tokens_per_second=10, jitter=0.2, parallel=1),
+    # Exercises retries, ejection, hedging and fallbacks
+    "flaky": Profile(prefill_seconds=0.005, tokens_per_second=2000, error_rate=0.1, stall_rate=0.02, stall_seconds=10),
+}
+
+MODEL = "deepseek-r1:8b"
+PATTERN = 'stack(\n  sound("bd*2 ~ bd ~").gain(0.8),\n  sound("~ ~ sd ~").gain(0.7),\n  sound("hh*16").gain(0.4)\n)'
+DESCRIPTION = "A dark trap beat with rolling hi-hats and a heavy kick"
+REASONING = "<think>" + "The user wants something dark, so a sparse kick under fast hats. " * 4 + "</think>\n"
+
+
+def response_text(prompt: str, structured: bool) -> str:
+    """What the model would answer, in the format the prompt asks for"""
+    if structured:
+        return json.dumps({"code": PATTERN, "description": DESCRIPTION})
+    if "CODE:" in prompt:
+        return f"{REASONING}CODE: ```javascript\n{PATTERN}\n```\nDESCRIPTION: {DESCRIPTION}\n"
+    return f"{REASONING}Here is your beat:\n```strudel\n{PATTERN}\n```\nDescription: {DESCRIPTION}.\n\nThe kick leaves room for the hats.\n"
+
+
+def tokenize(text: str) -> List[str]:
+    # About four characters per token
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+def create_app(profile: Profile, seed: int = 0) -> FastAPI:
+    app = FastAPI(title="Fake Ollama")
+    rng = random.Random(seed)
+    slots = asyncio.Semaphore(profile.parallel)
+    stats = {"requests": 0, "errors": 0, "stalls": 0, "in_flight": 0}
+
+    def jittered(value: float) -> float:
+        return value * (1 + rng.uniform(-profile.jitter, profile.jitter))
+
+    def body(key: str, text: str) -> Dict[str, Any]:
+        return {key: text} if key == "response" else {"message": {"role": "assistant", "content": text}}
+
+    async def generate(key: str, request: Request):
+        payload = await request.json()
+        if not payload.get("prompt") and not payload.get("messages"):
+            # Only loads the model
+            return {"model": payload.get("model", MODEL), "done": True, "done_reason": "load"}
+        stats["requests"] += 1
+        if rng.random() < profile.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(status_code=500, content={"error": "injected failure"})
+        stall = profile.stall_seconds if rng.random() < profile.stall_rate else 0.0
+        stats["stalls"] += bool(stall)
+
+        prompt = payload.get("prompt") or json.dumps(payload.get("messages", []))
+        tokens = tokenize(response_text(prompt, bool(payload.get("format"))))
+        limit = payload.get("options", {}).get("num_predict")
+        if limit and limit > 0:
+            tokens = tokens[:limit]
+        prefill = jittered(profile.prefill_seconds) + stall
+        per_token = 1 / jittered(profile.tokens_per_second)
+
+        def done(started: float, decode_started: float) -> Dict[str, Any]:
+            now = time.perf_counter()
+            return {
+                "model": payload.get("model", MODEL),
+                "done": True,
+                "done_reason": "length" if limit and len(tokens) == limit else "stop",
+                "total_duration": int((now - started) * 1e9),
+                "load_duration": 0,
+                "prompt_eval_count": len(tokenize(prompt)),
+                "prompt_eval_duration": int((decode_started - started) * 1e9),
+                "eval_count": len(tokens),
+                "eval_duration": int((now - decode_started) * 1e9),
+            }
+
+        if not payload.get("stream", True):
+            async with slots:
+                stats["in_flight"] += 1
+                try:
+                    started = time.perf_counter()
+                    await asyncio.sleep(prefill)
+                    decode_started = time.perf_counter()
+                    await asyncio.sleep(per_token * len(tokens))
+                    return {**body(key, "".join(tokens)), **done(started, decode_started)}
+                finally:
+                    stats["in_flight"] -= 1
+
+        async def stream() -> AsyncIterator[str]:
+            async with slots:
+                stats["in_flight"] += 1
+                try:
+                    started = time.perf_counter()
+                    await asyncio.sleep(prefill)
+                    decode_started = time.perf_counter()
+                    for token in tokens:
+                        yield json.dumps({**body(key, token), "done": False}) + "\n"
+                        await asyncio.sleep(per_token)
+                    yield json.dumps({**body(key, ""), **done(started, decode_started)}) + "\n"
+                finally:
+                    stats["in_flight"] -= 1
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": MODEL}]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": [{"name": MODEL, "expires_at": "never"}]}
+
+    @app.post("/api/generate")
+    async def api_generate(request: Request):
+        return await generate("response", request)
+
+    @app.post("/api/chat")
+    async def api_chat(request: Request):
+        return await generate("message", request)
+
+    @app.get("/stats")
+    async def fake_stats():
+        return {"profile": profile.__dict__, **stats}
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="fast")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--seed", type=int, default=0)
+    # Any profile field can be overridden, e.g. --tokens-per-second 80
+    for field in fields(Profile):
+        parser.add_argument(f"--{field.name.replace('_', '-')}", type=field.type)
+    args = parser.parse_args()
+
+    overrides = {field.name: getattr(args, field.name) for field in fields(Profile) if getattr(args, field.name) is not None}
+    profile = replace(PROFILES[args.profile], **overrides)
+
+    import uvicorn
+
+    uvicorn.run(create_app(profile, args.seed), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,39 +3,149 @@ Nala AI - RunPod Handler for Ollama + DeepSeek R1
 Bridges RunPod serverless with local Ollama instance
 """
 
-import runpod
+import os
+import sys
 import json
 import asyncio
+import time
 import httpx
 import traceback
-from typing import Dict, Any, Optional
+from typing import Awaitable, Callable, Dict, Any, Optional
+
+# nala_core sits at the repository root: Docker images copy it next to this
+# file, and a checkout run without PYTHONPATH finds it one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nala_core import validate_strudel
+from nala_core.fallback import generate_fallback as compose_fallback
+
+from deadlines import DEADLINE_HEADER, parse_timeout
+from structured_logging import REQUEST_ID_HEADER
 
 # Configuration
-MUSIC_API_URL = "http://localhost:8000"
-OLLAMA_URL = "http://localhost:11434"
+MUSIC_API_URL = os.getenv("MUSIC_API_URL", "http://localhost:8000")
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+HANDLER_CONCURRENCY = int(os.getenv("HANDLER_CONCURRENCY", "4"))
+HEALTH_POLL_INTERVAL = float(os.getenv("HEALTH_POLL_INTERVAL", "10"))
+HEALTH_MAX_STALENESS = float(os.getenv("HEALTH_MAX_STALENESS", "30"))
+READY_TIMEOUT = float(os.getenv("READY_TIMEOUT", "300"))
+# Default time budget per job (a job's "timeout" can shorten it); the music API
+# gets it as X-Request-Timeout and answers with a fallback before it runs out
+MUSIC_JOB_TIMEOUT = float(os.getenv("MUSIC_JOB_TIMEOUT", "60"))
+CHAT_JOB_TIMEOUT = float(os.getenv("CHAT_JOB_TIMEOUT", "300"))
+# Extra time the HTTP call gets on top of the budget, for that answer to arrive
+DEADLINE_GRACE_SECONDS = float(os.getenv("DEADLINE_GRACE_SECONDS", "5"))
+
+def api_headers(timeout: float, request_id: Optional[str]) -> Dict[str, str]:
+    """Headers for a music API call: the job's time budget, and its ID for the API's logs"""
+    headers = {DEADLINE_HEADER: f"{timeout:.1f}"}
+    if request_id:
+        headers[REQUEST_ID_HEADER] = request_id
+    return headers
+
+class HealthMonitor:
+    """Last-known service health, refreshed by a background poller.
+    
+    Jobs read the cached state instead of probing the services themselves.
+    Only when the state is older than max_staleness (or was marked stale
+    after a failed call) does a job wait for a fresh check, and concurrent
+    jobs share that one check.
+    """
+    
+    def __init__(self, check: Callable[[], Awaitable[bool]], interval: float = HEALTH_POLL_INTERVAL, max_staleness: float = HEALTH_MAX_STALENESS):
+        self._check = check
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self.healthy = False
+        self.checked_at: Optional[float] = None
+        self._poller: Optional[asyncio.Task] = None
+        self._refreshing: Optional[asyncio.Task] = None
+    
+    @property
+    def fresh(self) -> bool:
+        return self.checked_at is not None and time.monotonic() - self.checked_at <= self.max_staleness
+    
+    def start(self) -> None:
+        """Start polling on the running loop if not already doing so"""
+        loop = asyncio.get_running_loop()
+        if self._poller is None or self._poller.done() or self._poller.get_loop() is not loop:
+            self._refreshing = None
+            self._poller = loop.create_task(self._poll())
+    
+    async def _poll(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.interval)
+    
+    async def refresh(self) -> bool:
+        """Run a health check now, joining one already in progress"""
+        if self._refreshing is None or self._refreshing.done():
+            self._refreshing = asyncio.get_running_loop().create_task(self._run_check())
+        return await asyncio.shield(self._refreshing)
+    
+    async def _run_check(self) -> bool:
+        healthy = await self._check()
+        if healthy != self.healthy:
+            print(f"🩺 Services {'healthy' if healthy else 'unhealthy'}")
+        self.healthy = healthy
+        self.checked_at = time.monotonic()
+        return healthy
+    
+    async def is_healthy(self) -> bool:
+        """Cached health, only waiting for a check when the state is stale"""
+        self.start()
+        if self.fresh:
+            return self.healthy
+        return await self.refresh()
+    
+    def mark_stale(self) -> None:
+        """Force the next job to re-check, e.g. after a failed generation"""
+        self.checked_at = None
 
 class RunPodOllamaHandler:
     def __init__(self):
-        self.client = httpx.AsyncClient(timeout=300.0)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Keep-alive client to the music API, bound to the running event loop.
+        
+        RunPod runs async handlers on one persistent loop, so this is created
+        once and its pooled connections are reused across jobs; it is only
+        rebuilt if the loop ever changes.
+        """
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client.is_closed or self._client_loop is not loop:
+            self._client = httpx.AsyncClient(
+                base_url=MUSIC_API_URL,
+                timeout=max(MUSIC_JOB_TIMEOUT, CHAT_JOB_TIMEOUT) + DEADLINE_GRACE_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=HANDLER_CONCURRENCY * 2,
+                    max_keepalive_connections=HANDLER_CONCURRENCY,
+                    keepalive_expiry=120.0
+                )
+            )
+            self._client_loop = loop
+        return self._client
     
     async def health_check(self) -> bool:
-        """Check if services are healthy"""
+        """Check if services are healthy.
+        
+        The music API's /health already probes Ollama and reports it in
+        its status, so one round trip covers both services.
+        """
         try:
-            # Check music API
-            music_response = await self.client.get(f"{MUSIC_API_URL}/health")
-            music_healthy = music_response.status_code == 200
-            
-            # Check Ollama directly
-            ollama_response = await self.client.get(f"{OLLAMA_URL}/api/tags")
-            ollama_healthy = ollama_response.status_code == 200
-            
-            return music_healthy and ollama_healthy
+            music_response = await self.client.get("/health", timeout=5.0)
+            if music_response.status_code != 200:
+                return False
+            return music_response.json().get("status") == "healthy"
             
         except Exception as e:
             print(f"❌ Health check failed: {e}")
             return False
     
-    async def generate_music(self, job_input: Dict[str, Any]) -> Dict[str, Any]:
+    async def generate_music(self, job_input: Dict[str, Any], request_id: Optional[str] = None) -> Dict[str, Any]:
         """Generate music using the music API wrapper"""
         
         try:
@@ -50,10 +160,13 @@ class RunPodOllamaHandler:
             
             print(f"🎵 Sending request to music API: {request_data['userInput']}")
             
-            # Call music API
+            # Call music API, passing on how long the job may take
+            timeout = parse_timeout(job_input.get("timeout"), MUSIC_JOB_TIMEOUT)
             response = await self.client.post(
-                f"{MUSIC_API_URL}/generate-music",
-                json=request_data
+                "/generate-music",
+                json=request_data,
+                headers=api_headers(timeout, request_id),
+                timeout=timeout + DEADLINE_GRACE_SECONDS
             )
             
             if response.status_code == 200:
@@ -72,6 +185,7 @@ class RunPodOllamaHandler:
                 }
             else:
                 print(f"❌ Music API error: {response.status_code}")
+                health_monitor.mark_stale()
                 return {
                     "success": False,
                     "error": f"Music API error: {response.status_code}",
@@ -81,13 +195,14 @@ class RunPodOllamaHandler:
         except Exception as e:
             print(f"❌ Error calling music API: {e}")
             traceback.print_exc()
+            health_monitor.mark_stale()
             return {
                 "success": False,
                 "error": str(e),
                 "fallback": True
             }
     
-    async def chat_completion(self, job_input: Dict[str, Any]) -> Dict[str, Any]:
+    async def chat_completion(self, job_input: Dict[str, Any], request_id: Optional[str] = None) -> Dict[str, Any]:
         """Handle OpenAI-style chat completion requests"""
         
         try:
@@ -108,9 +223,12 @@ class RunPodOllamaHandler:
             print(f"💬 Chat completion request")
             
             # Call OpenAI-compatible endpoint
+            timeout = parse_timeout(job_input.get("timeout"), CHAT_JOB_TIMEOUT)
             response = await self.client.post(
-                f"{MUSIC_API_URL}/v1/chat/completions",
-                json=request_data
+                "/v1/chat/completions",
+                json=request_data,
+                headers=api_headers(timeout, request_id),
+                timeout=timeout + DEADLINE_GRACE_SECONDS
             )
             
             if response.status_code == 200:
@@ -119,6 +237,7 @@ class RunPodOllamaHandler:
                 return result
             else:
                 print(f"❌ Chat API error: {response.status_code}")
+                health_monitor.mark_stale()
                 return {
                     "error": f"Chat API error: {response.status_code}"
                 }
@@ -126,54 +245,53 @@ class RunPodOllamaHandler:
         except Exception as e:
             print(f"❌ Error in chat completion: {e}")
             traceback.print_exc()
+            health_monitor.mark_stale()
             return {
                 "error": str(e)
             }
 
 # Global handler instance
 handler_instance = RunPodOllamaHandler()
+health_monitor = HealthMonitor(handler_instance.health_check)
 
-def generate_fallback(user_input: str) -> Dict[str, Any]:
+def fast_path(job_input: Dict[str, Any], user_input: str) -> Optional[Dict[str, Any]]:
+    """Result for jobs that need neither Ollama nor the music API, or None"""
+    mode = job_input.get("mode")
+    
+    if mode == "validate":
+        code = job_input.get("strudel_code", job_input.get("code", ""))
+        return {"output": {"strudel_code": code, **validate_strudel(code).to_dict()}}
+    
+    if mode == "fallback":
+        return {"output": generate_fallback(user_input or "create music", job_input.get("musicDNA"), job_input.get("seed"))}
+    
+    if not user_input:
+        return {
+            "error": "No user input provided",
+            "output": generate_fallback("create music", job_input.get("musicDNA"))
+        }
+    
+    return None
+
+def generate_fallback(user_input: str, music_dna: Optional[Dict[str, Any]] = None, seed: Optional[int] = None) -> Dict[str, Any]:
     """Generate fallback response when all else fails"""
     
-    lower_input = user_input.lower()
-    
-    # Simple genre detection
-    if 'trap' in lower_input:
-        code = '''stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4)
-)'''
-        desc = "Basic trap pattern (system fallback)"
-    elif 'house' in lower_input:
-        code = '''stack(
-  sound("bd*4").gain(0.8),
-  sound("~ ~ sd ~").gain(0.6),
-  sound("hh*8").gain(0.4)
-)'''
-        desc = "Basic house pattern (system fallback)"
-    else:
-        code = '''stack(
-  sound("bd ~ ~ ~").gain(0.6),
-  sound("~ ~ sd ~").gain(0.5),
-  sound("hh*4").gain(0.3)
-)'''
-        desc = "Basic lo-fi pattern (system fallback)"
+    pattern = compose_fallback(user_input, music_dna, seed)
     
     return {
         "success": True,
-        "code": code,
-        "description": desc,
+        "code": pattern.code,
+        "description": f"{pattern.description} (system fallback)",
         "metadata": {
             "source": "system_fallback",
             "timestamp": "unknown",
-            "genre": "unknown"
+            "genre": pattern.genre,
+            "seed": pattern.seed
         }
     }
 
 async def async_handler(job: Dict[str, Any]) -> Dict[str, Any]:
-    """Async handler function"""
+    """Async handler function, run by RunPod on its persistent event loop"""
     
     try:
         print("🚀 Processing RunPod request...")
@@ -181,29 +299,28 @@ async def async_handler(job: Dict[str, Any]) -> Dict[str, Any]:
         job_input = job.get("input", {})
         user_input = job_input.get("userInput", job_input.get("prompt", ""))
         
-        if not user_input:
-            return {
-                "error": "No user input provided",
-                "output": generate_fallback("create music")
-            }
+        # Validation, explicit fallbacks and empty input skip the health check
+        quick = fast_path(job_input, user_input)
+        if quick is not None:
+            return quick
         
         print(f"📝 User input: {user_input}")
         
-        # Check if services are healthy
-        if not await handler_instance.health_check():
+        # Check if services are healthy (cached by the background monitor)
+        if not await health_monitor.is_healthy():
             print("⚠️ Services not healthy, using fallback")
             return {
-                "output": generate_fallback(user_input)
+                "output": generate_fallback(user_input, job_input.get("musicDNA"))
             }
         
         # Determine request type
         if job_input.get("type") == "chat" or "messages" in job_input:
             # Handle as chat completion
-            result = await handler_instance.chat_completion(job_input)
+            result = await handler_instance.chat_completion(job_input, job.get("id"))
             return {"output": result}
         else:
             # Handle as music generation
-            result = await handler_instance.generate_music(job_input)
+            result = await handler_instance.generate_music(job_input, job.get("id"))
             
             if result["success"]:
                 return {
@@ -216,7 +333,7 @@ async def async_handler(job: Dict[str, Any]) -> Dict[str, Any]:
                 }
             else:
                 # Use fallback on failure
-                fallback = generate_fallback(user_input)
+                fallback = generate_fallback(user_input, job_input.get("musicDNA"))
                 return {
                     "output": {
                         **fallback,
@@ -238,9 +355,24 @@ async def async_handler(job: Dict[str, Any]) -> Dict[str, Any]:
             }
         }
 
-def handler(job: Dict[str, Any]) -> Dict[str, Any]:
-    """Synchronous wrapper for async handler"""
-    return asyncio.run(async_handler(job))
+def wait_until_ready(timeout: float = READY_TIMEOUT) -> bool:
+    """Block until the music API has finished its warmup, so no job lands on a cold model"""
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            if httpx.get(f"{MUSIC_API_URL}/ready", timeout=5.0).status_code == 200:
+                print(f"✅ Music API warmed up after {time.monotonic() - start:.1f}s")
+                return True
+        except httpx.HTTPError:
+            pass
+        time.sleep(2)
+    
+    print(f"⚠️ Music API not ready after {timeout:.0f}s, starting anyway (jobs fall back until it is)")
+    return False
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Let several jobs share the loop and the pooled music API connections"""
+    return HANDLER_CONCURRENCY
 
 # Start the RunPod serverless handler
 if __name__ == "__main__":
@@ -248,4 +380,12 @@ if __name__ == "__main__":
     print("🔗 Connecting to music API at:", MUSIC_API_URL)
     print("🤖 Connecting to Ollama at:", OLLAMA_URL)
     
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    # Only the serverless worker needs the RunPod SDK, which is slow to import
+    import runpod
+    
+    wait_until_ready()
+    
+    runpod.serverless.start({
+        "handler": async_handler,
+        "concurrency_modifier": concurrency_modifier
+    })
\ No newline at end of file
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+"""
+Nala AI - Load tests for the music APIs
+Drives /generate-music, /api/generate-music and /v1/chat/completions at a
+fixed concurrency or request rate and reports throughput, latency
+percentiles, fallback and error rates, optionally against a baseline
+
+    python loadtest.py offline                            # fake Ollama + both APIs, all scenarios
+    python loadtest.py offline --profile gpu --rps 2      # open loop at 2 requests/s
+    python loadtest.py offline --baseline loadtest_baseline.json
+    python loadtest.py offline --save-baseline loadtest_baseline.json
+    python loadtest.py run wrapper-music --url http://localhost:8000 --concurrency 8
+
+Exits 1 when a scenario regressed against the baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+
+PROMPTS = [
+    "create a dark trap beat with heavy 808s",
+    "chill lo-fi beat for studying",
+    "upbeat house track for a sunrise set",
+    "country folk song with acoustic guitar",
+    "jazzy groove with a walking bass",
+]
+MUSIC_DNA = {"primaryGenre": "trap", "preferredMood": "dark", "energyLevel": 8}
+
+
+def music_request(i: int) -> Dict[str, Any]:
+    # Distinct inputs, so neither the response cache nor single-flight hides the load
+    return {"userInput": f"{PROMPTS[i % len(PROMPTS)]} (take {i})", "musicDNA": MUSIC_DNA, "context": {"timeOfDay": "night"}}
+
+
+def chat_request(i: int) -> Dict[str, Any]:
+    return {
+        "model": "deepseek-r1:8b",
+        "messages": [{"role": "user", "content": f"Write a Strudel pattern: {PROMPTS[i % len(PROMPTS)]} (take {i})"}],
+        "max_tokens": 200,
+    }
+
+
+def music_fallback(body: Dict[str, Any]) -> bool:
+    metadata = body.get("metadata", {})
+    # music_api.py says "fallback", music_api_wrapper.py "fallback_used"
+    return bool(metadata.get("fallback") or metadata.get("fallback_used"))
+
+
+@dataclass(frozen=True)
+class Scenario:
+    api: str  # which app serves it: "music_api" or "wrapper"
+    path: str
+    build: Callable[[int], Dict[str, Any]]
+    is_fallback: Callable[[Dict[str, Any]], bool] = lambda body: False
+
+
+SCENARIOS = {
+    "music-api": Scenario("music_api", "/generate-music", music_request, music_fallback),
+    "wrapper-music": Scenario("wrapper", "/api/generate-music", music_request, music_fallback),
+    "chat": Scenario("wrapper", "/v1/chat/completions", chat_request),
+}
+
+
+@dataclass
+class Result:
+    requests: int = 0
+    errors: int = 0  # exceptions and 5xx
+    rejected: int = 0  # 429 from admission control
+    fallbacks: int = 0
+    latencies: List[float] = field(default_factory=list)  # answered requests
+    elapsed: float = 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        answered = len(ordered)
+        return {
+            "requests": self.requests,
+            "throughput": round(answered / self.elapsed, 2) if self.elapsed else 0.0,
+            **{f"p{round(q * 100)}": percentile(ordered, q) for q in (0.5, 0.95, 0.99)},
+            "fallback_rate": round(self.fallbacks / answered, 4) if answered else 0.0,
+            "error_rate": round(self.errors / self.requests, 4) if self.requests else 0.0,
+            "rejected_rate": round(self.rejected / self.requests, 4) if self.requests else 0.0,
+        }
+
+
+def percentile(ordered: List[float], quantile: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(quantile * len(ordered)))], 4)
+
+
+async def send(client: httpx.AsyncClient, url: str, scenario: Scenario, i: int, result: Result, started: float) -> None:
+    """One request; latency runs from started, so an open loop counts time spent queued behind slow ones"""
+    result.requests += 1
+    try:
+        response = await client.post(url + scenario.path, json=scenario.build(i))
+    except httpx.HTTPError:
+        result.errors += 1
+        return
+    if response.status_code == 429:
+        result.rejected += 1
+        return
+    if response.status_code >= 400:
+        result.errors += 1
+        return
+    result.latencies.append(time.perf_counter() - started)
+    result.fallbacks += scenario.is_fallback(response.json())
+
+
+async def drive(url: str, scenario: Scenario, duration: float, concurrency: int = 0, rps: float = 0.0, timeout: float = 120.0) -> Result:
+    """Closed loop with concurrency workers each sending back to back, or open loop at rps"""
+    result = Result()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=max(concurrency, 32))
+    # trust_env=False: no proxies, this must work offline
+    async with httpx.AsyncClient(timeout=timeout, limits=limits, trust_env=False) as client:
+        start = time.perf_counter()
+        if rps:
+            tasks = []
+            for i in range(max(1, int(rps * duration))):
+                scheduled = start + i / rps
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+                tasks.append(asyncio.ensure_future(send(client, url, scenario, i, result, scheduled)))
+            await asyncio.gather(*tasks)
+        else:
+            counter = iter(range(sys.maxsize))
+
+            async def worker() -> None:
+                while time.perf_counter() - start < duration:
+                    await send(client, url, scenario, next(counter), result, time.perf_counter())
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        result.elapsed = time.perf_counter() - start
+    return result
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, rate_tolerance: float, latency_slack: float) -> List[str]:
+    """What got worse than the baseline: latency or throughput beyond tolerance, rates beyond rate_tolerance"""
+    regressions = []
+    for name in ("p50", "p95", "p99"):
+        old, new = baseline.get(name), current.get(name)
+        if old is not None and new is not None and new > old * (1 + tolerance) + latency_slack:
+            regressions.append(f"{name} {old * 1000:.1f}ms -> {new * 1000:.1f}ms")
+    if baseline.get("throughput") and current["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"throughput {baseline['throughput']}/s -> {current['throughput']}/s")
+    for name in ("fallback_rate", "error_rate", "rejected_rate"):
+        if current[name] > baseline.get(name, 0.0) + rate_tolerance:
+            regressions.append(f"{name} {baseline.get(name, 0.0):.2%} -> {current[name]:.2%}")
+    return regressions
+
+
+def print_summaries(summaries: Dict[str, Dict[str, Any]]) -> None:
+    def ms(value: Optional[float]) -> str:
+        return f"{value * 1000:.1f}ms" if value is not None else "-"
+
+    print(f"{'scenario':<15} {'reqs':>6} {'req/s':>8} {'p50':>10} {'p95':>10} {'p99':>10} {'fallback':>9} {'errors':>7} {'429':>6}")
+    for name, summary in summaries.items():
+        print(
+            f"{name:<15} {summary['requests']:>6} {summary['throughput']:>8.2f} "
+            f"{ms(summary['p50']):>10} {ms(summary['p95']):>10} {ms(summary['p99']):>10} "
+            f"{summary['fallback_rate']:>9.1%} {summary['error_rate']:>7.1%} {summary['rejected_rate']:>6.1%}"
+        )
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 60.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=1.0, trust_env=False).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout:.0f}s")
+
+
+@contextmanager
+def offline_stack(profile: str, fake_args: List[str], api_env: Dict[str, str]) -> Iterator[Dict[str, str]]:
+    """A fake Ollama and both music APIs in front of it, on free local ports; yields api -> base URL"""
+    fake_port, music_port, wrapper_port = free_port(), free_port(), free_port()
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])),
+        "OLLAMA_BACKENDS": f"127.0.0.1:{fake_port}",
+        "OLLAMA_MODEL": "deepseek-r1:8b",
+        # Every request should reach the model
+        "CACHE_ENABLED": "false",
+        **api_env,
+    }
+    log_path = os.path.join(tempfile.gettempdir(), "nala-loadtest.log")
+    logs = open(log_path, "w")
+    commands = [
+        ([sys.executable, "fake_ollama.py", "--profile", profile, "--port", str(fake_port), *fake_args], f"http://127.0.0.1:{fake_port}/api/tags"),
+        ([sys.executable, "music_api.py"], f"http://127.0.0.1:{music_port}/ready"),
+        ([sys.executable, "music_api_wrapper.py"], f"http://127.0.0.1:{wrapper_port}/ready"),
+    ]
+    ports = [fake_port, music_port, wrapper_port]
+    processes = []
+    try:
+        for (command, ready_url), port in zip(commands, ports):
+            processes.append(subprocess.Popen(command, cwd=HERE, env={**env, "API_PORT": str(port)}, stdout=logs, stderr=subprocess.STDOUT))
+            try:
+                wait_ready(ready_url)
+            except RuntimeError:
+                print(f"❌ {os.path.basename(command[1])} did not come up, see {log_path}")
+                raise
+        yield {"music_api": f"http://127.0.0.1:{music_port}", "wrapper": f"http://127.0.0.1:{wrapper_port}"}
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        logs.close()
+
+
+def run_scenarios(urls: Dict[str, str], names: List[str], args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    summaries = {}
+    for name in names:
+        scenario = SCENARIOS[name]
+        load = f"{args.rps} req/s" if args.rps else f"concurrency {args.concurrency}"
+        print(f"🔥 {name}: {scenario.path} for {args.duration:.0f}s at {load}")
+        result = asyncio.run(drive(urls[scenario.api], scenario, args.duration, args.concurrency, args.rps, args.timeout))
+        summaries[name] = result.summary()
+    return summaries
+
+
+def check_baseline(summaries: Dict[str, Dict[str, Any]], args: argparse.Namespace) -> int:
+    if args.save_baseline:
+        settings = {key: getattr(args, key, None) for key in ("profile", "duration", "concurrency", "rps")}
+        with open(args.save_baseline, "w") as f:
+            json.dump({"settings": settings, "scenarios": summaries}, f, indent=2)
+            f.write("\n")
+        print(f"💾 Baseline saved to {args.save_baseline}")
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failed = False
+    for name, summary in summaries.items():
+        if name not in baseline["scenarios"]:
+            print(f"⚠️ {name}: not in the baseline")
+            continue
+        regressions = compare(summary, baseline["scenarios"][name], args.tolerance, args.rate_tolerance, args.latency_slack)
+        if regressions:
+            failed = True
+            print(f"❌ {name} regressed: {'; '.join(regressions)}")
+        else:
+            print(f"✅ {name} within {args.tolerance:.0%} of the baseline")
+    return 1 if failed else 0
+
+
+def main(argv: List[str]) -> int:
+    parser = argparse.ArgumentParser(description="Load tests for the Nala AI music APIs", epilog="See the module docstring for examples.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    offline = commands.add_parser("offline", help="start a fake Ollama and both APIs, then run the scenarios")
+    offline.add_argument("scenarios", nargs="*", help=f"any of {', '.join(SCENARIOS)} (default: all)")
+    offline.add_argument("--profile", default="fast", help="fake_ollama.py profile (fast, gpu, slow, flaky)")
+    offline.add_argument("--fake-arg", action="append", default=[], help="extra fake_ollama.py argument, e.g. --fake-arg=--error-rate=0.1")
+    offline.add_argument("--api-env", action="append", default=[], help="NAME=value for both APIs, e.g. HEDGE_REQUESTS=true")
+    run = commands.add_parser("run", help="run one scenario against an API that is already up")
+    run.add_argument("scenario", choices=list(SCENARIOS))
+    run.add_argument("--url", default="http://localhost:8000")
+    for command in (offline, run):
+        command.add_argument("--duration", type=float, default=10.0, help="seconds per scenario")
+        command.add_argument("--concurrency", type=int, default=4, help="closed-loop workers")
+        command.add_argument("--rps", type=float, default=0.0, help="open-loop request rate instead of workers")
+        command.add_argument("--timeout", type=float, default=120.0, help="per-request timeout")
+        command.add_argument("--baseline", help="fail on a regression against this baseline")
+        command.add_argument("--save-baseline", help="write the results as a new baseline")
+        command.add_argument("--tolerance", type=float, default=0.25, help="allowed relative latency/throughput change")
+        command.add_argument("--rate-tolerance", type=float, default=0.02, help="allowed absolute fallback/error rate increase")
+        command.add_argument("--latency-slack", type=float, default=0.005, help="seconds of latency noise always allowed")
+    args = parser.parse_args(argv)
+    unknown = set(getattr(args, "scenarios", [])) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+
+    if args.command == "run":
+        urls = {SCENARIOS[args.scenario].api: args.url.rstrip("/")}
+        summaries = run_scenarios(urls, [args.scenario], args)
+    else:
+        api_env = dict(item.split("=", 1) for item in args.api_env)
+        with offline_stack(args.profile, args.fake_arg, api_env) as urls:
+            summaries = run_scenarios(urls, args.scenarios or list(SCENARIOS), args)
+
+    print_summaries(summaries)
+    return check_baseline(summaries, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
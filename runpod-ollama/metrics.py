@@ -0,0 +1,134 @@
+"""
+Nala AI - Prometheus metrics for the music APIs
+Where a generation's time goes stage by stage, how fast the model prefills
+and decodes, and why requests end up with a fallback pattern
+"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import httpx
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+from admission import AdmissionRejected
+from deadlines import DeadlineExceeded
+
+# Seconds: from a cache hit or a regex pass to a cold model load
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# Tokens per second: decoding runs at tens, prefill at hundreds to thousands
+THROUGHPUT_BUCKETS = (1, 5, 10, 20, 30, 40, 60, 80, 100, 150, 250, 500, 1000, 2500, 5000)
+
+STAGE_SECONDS = Histogram(
+    "nala_stage_seconds",
+    "Time spent in each stage of a generation",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_SECONDS = Histogram(
+    "nala_request_seconds",
+    "Total time to answer a request, by where the answer came from (ai, cache, fallback, rejected, error)",
+    ["endpoint", "source"],
+    buckets=LATENCY_BUCKETS,
+)
+FALLBACKS = Counter(
+    "nala_fallbacks_total",
+    "Fallback patterns served instead of a generated one, by reason",
+    ["endpoint", "reason"],
+)
+REPAIRS = Counter(
+    "nala_pattern_repairs_total",
+    "Invalid generated patterns, by whether the repair pass made them valid (repaired, unrepaired)",
+    ["outcome"],
+)
+TOKENS = Counter("nala_ollama_tokens_total", "Tokens Ollama processed", ["phase"])
+TOKENS_PER_SECOND = Histogram(
+    "nala_ollama_tokens_per_second",
+    "Ollama throughput per generation",
+    ["phase"],
+    buckets=THROUGHPUT_BUCKETS,
+)
+
+# Ollama response fields (durations in nanoseconds) behind each stage
+OLLAMA_STAGES = {
+    "load": ("load_duration", None),
+    "prefill": ("prompt_eval_duration", "prompt_eval_count"),
+    "decode": ("eval_duration", "eval_count"),
+}
+# Tokens are counted by what they are rather than by stage
+TOKEN_PHASES = {"prefill": "prompt", "decode": "completion"}
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Record how long the block takes as stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def observe_ollama(result: Dict[str, Any], elapsed: Optional[float] = None) -> None:
+    """Stage times and token throughput from an Ollama response.
+
+    Load, prefill and decode come from Ollama's own *_duration fields, which
+    are only on a finished (done) response. Given the wall-clock elapsed
+    seconds of the call, the time Ollama does not account for is recorded as
+    "ollama_queue": waiting for Ollama's scheduler, plus the network.
+    """
+    for stage, (duration_field, count_field) in OLLAMA_STAGES.items():
+        duration = result.get(duration_field)
+        if not duration:
+            continue
+        seconds = duration / 1e9
+        observe_stage(stage, seconds)
+        count = result.get(count_field) if count_field else None
+        if count:
+            phase = TOKEN_PHASES[stage]
+            TOKENS.labels(phase).inc(count)
+            TOKENS_PER_SECOND.labels(phase).observe(count / seconds)
+
+    total = result.get("total_duration")
+    if elapsed is not None and total:
+        observe_stage("ollama_queue", max(0.0, elapsed - total / 1e9))
+
+
+def observe_request(endpoint: str, seconds: float, reason: Optional[str] = None, cached: bool = False,
+                    error: Optional[BaseException] = None) -> None:
+    """Total latency of one request, with the reason when it got a fallback pattern.
+
+    A request that raised instead of getting any pattern passes its `error`.
+    """
+    if error is not None:
+        source = "rejected" if isinstance(error, AdmissionRejected) else "error"
+    elif reason:
+        FALLBACKS.labels(endpoint, reason).inc()
+        source = "fallback"
+    else:
+        source = "cache" if cached else "ai"
+    REQUEST_SECONDS.labels(endpoint, source).observe(seconds)
+
+
+def observe_repair(repaired: bool) -> None:
+    """Outcome of repairing one invalid pattern"""
+    REPAIRS.labels("repaired" if repaired else "unrepaired").inc()
+
+
+def fallback_reason(error: BaseException) -> str:
+    """Fallback reason for a generation that raised: "timeout" or "error" """
+    if isinstance(error, (DeadlineExceeded, httpx.TimeoutException, asyncio.TimeoutError)):
+        return "timeout"
+    # The APIs turn Ollama timeouts into 504s
+    return "timeout" if getattr(error, "status_code", None) == 504 else "error"
+
+
+def metrics_response() -> Response:
+    """Everything above in the Prometheus text format"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -5,27 +5,75 @@ Optimized for Strudel.js pattern generation
 """
 
 import os
+import sys
 import json
-import re
 import asyncio
 import logging
+import time
 from typing import Dict, List, Optional, Any
 from datetime import datetime
 
 import httpx
-import uvicorn
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Header, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# nala_core sits at the repository root: Docker images copy it next to this
+# file, and a checkout run without PYTHONPATH finds it one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nala_core import generate_fallback, repair_strudel, validate_strudel
+from nala_core.constrained import STRUCTURED_OUTPUT_INSTRUCTION, STRUDEL_RESPONSE_SCHEMA, parse_structured_response
+from nala_core.prompts import STRUDEL_PROMPT, estimate_tokens, parse_code_description, strudel_prompt_suffix
+
+from admission import AdmissionController, AdmissionRejected
+from compression import CompressionMiddleware
+from backend_pool import Backend, BackendPool, StuckRequest, model_key, parse_backend_urls, request_kind
+from deadlines import DeadlineExceeded, budget, deadline, parse_timeout, remaining
+from metrics import fallback_reason, metrics_response, observe_ollama, observe_repair, observe_request, observe_stage, timed
+from response_cache import ResponseCache, make_cache_key, vary_pattern
+from single_flight import SingleFlight
+from structured_logging import RequestContextMiddleware, configure_logging
+from warmup import Warmup, wait_for
+
+# Configure logging: JSON lines (LOG_FORMAT=text for plain ones), written off the event loop
+configure_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "json") == "json")
 logger = logging.getLogger(__name__)
 
 # Configuration
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "localhost:11434")
+# Comma-separated Ollama URLs (or host:port); generations are spread across them
+OLLAMA_BACKENDS = parse_backend_urls(os.getenv("OLLAMA_BACKENDS", OLLAMA_HOST))
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "deepseek-r1:1.5b")
 API_PORT = int(os.getenv("API_PORT", "8000"))
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "3600"))
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "2"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "32"))
+QUEUE_DEADLINE_SECONDS = float(os.getenv("QUEUE_DEADLINE_SECONDS", "30"))
+# Time a /generate-music request may take in all (X-Request-Timeout can only
+# shorten it) and the longest any single Ollama call may take within it
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "60"))
+OLLAMA_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_TIMEOUT_SECONDS", "60"))
+# Send a duplicate generation to another backend once one has run past the
+# HEDGE_QUANTILE of recent latencies; abandon one running past
+# STUCK_REQUEST_FACTOR x their p99 (0 disables)
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+STUCK_REQUEST_FACTOR = float(os.getenv("STUCK_REQUEST_FACTOR", "3"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "300"))
+MAX_GENERATION_ATTEMPTS = int(os.getenv("MAX_GENERATION_ATTEMPTS", "2"))
+# Ask Ollama for JSON matching STRUDEL_RESPONSE_SCHEMA instead of free text
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "false").lower() == "true"
+# Fraction of requests whose INFO lines are logged; warnings and errors always are
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# gzip (brotli if installed) for responses of at least COMPRESSION_MIN_BYTES
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1000"))
 
 app = FastAPI(
     title="Nala AI Music Generation API",
@@ -41,6 +89,10 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if RESPONSE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+# Request IDs (X-Request-ID) on every log line, and log sampling
+app.add_middleware(RequestContextMiddleware, sample_rate=LOG_SAMPLE_RATE)
 
 # Request/Response Models
 class MusicDNA(BaseModel):
@@ -61,6 +113,8 @@ class MusicRequest(BaseModel):
     musicDNA: Optional[MusicDNA] = Field(default_factory=MusicDNA)
     context: Optional[MusicContext] = Field(default_factory=MusicContext)
     requestPhase: Optional[int] = 3
+    temperature: Optional[float] = Field(0.7, description="Sampling temperature")
+    variation: Optional[bool] = Field(False, description="Serve cached patterns with deterministic variations")
 
 class MusicResponse(BaseModel):
     success: bool
@@ -72,6 +126,24 @@ class MusicResponse(BaseModel):
 
 # Ollama client
 ollama_client = httpx.AsyncClient(timeout=60.0)
+ollama_pool = BackendPool(OLLAMA_BACKENDS, hedge_quantile=HEDGE_QUANTILE, stuck_factor=STUCK_REQUEST_FACTOR)
+
+async def post_ollama(path: str, payload: Dict[str, Any], timeout: float = OLLAMA_TIMEOUT_SECONDS, hedge: bool = False) -> httpx.Response:
+    """POST to an Ollama backend from the pool, within the current request's deadline"""
+    async def send(backend: Backend, attempt_timeout: float) -> httpx.Response:
+        response = await ollama_client.post(f"{backend.url}{path}", json=payload, timeout=attempt_timeout)
+        if response.status_code != 200:
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Ollama API error: {response.text}"
+            )
+        return response
+    
+    return await ollama_pool.request(payload["model"], send, timeout, kind=request_kind(path, payload), hedge=hedge)
+
+# Static instructions shared by every request. Keeping them first, before
+# anything request-specific, lets Ollama reuse their KV cache between requests.
+STRUDEL_PROMPT_PREFIX = STRUDEL_PROMPT.prefix
 
 class NalaMusicGenerator:
     """Core music generation logic using DeepSeek R1"""
@@ -107,6 +179,10 @@ class NalaMusicGenerator:
     
     def create_strudel_prompt(self, user_input: str, music_dna: MusicDNA, context: MusicContext) -> str:
         """Create specialized prompt for Strudel.js music generation"""
+        return STRUDEL_PROMPT_PREFIX + self.create_strudel_prompt_suffix(user_input, music_dna, context)
+    
+    def create_strudel_prompt_suffix(self, user_input: str, music_dna: MusicDNA, context: MusicContext) -> str:
+        """Request-specific part of the prompt, appended after STRUDEL_PROMPT_PREFIX"""
         
         genre = music_dna.primaryGenre or "lo-fi"
         mood = music_dna.preferredMood or "creative"
@@ -115,73 +191,52 @@ class NalaMusicGenerator:
         # Get genre-specific guidance
         genre_info = self.genre_templates.get(genre, self.genre_templates["lo-fi"])
         
-        prompt = f"""You are Nala AI, an expert music generation system specializing in Strudel.js code patterns. 
-
-USER REQUEST: "{user_input}"
-
-MUSICAL CONTEXT:
-- Genre: {genre}
-- Mood: {mood}  
-- Energy Level: {energy}/10
-- Time: {context.timeOfDay}
-- Activity: {context.activity}
-
-STRUDEL.JS REQUIREMENTS:
-1. Generate ONLY valid Strudel.js code using stack(), sound(), note(), and effects
-2. Use appropriate sound sources: bd (kick), sd (snare), hh (hi-hat), 808 (bass)
-3. Include rhythm, melody, and harmonic elements
-4. Apply effects like reverb(), delay(), lpf(), hpf(), gain()
-5. Match the {genre} genre style with {mood} mood
-
-GENRE GUIDANCE for {genre.upper()}:
-- Typical patterns: {', '.join(genre_info['patterns'])}
-- Common effects: {', '.join(genre_info['effects'])}
-- Energy level: {genre_info['energy']}
-
-RESPONSE FORMAT (REQUIRED):
-CODE: [your strudel code here]
-DESCRIPTION: [brief description of the pattern]
-
-EXAMPLE for trap:
-CODE: stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7).delay(0.1),
-  sound("hh*16").gain(0.4).hpf(8000),
-  note("c1 ~ f1 g1").sound("808").lpf(80).gain(0.9)
-)
-DESCRIPTION: Dark trap beat with rolling 808s and crisp hi-hats
-
-Now generate a Strudel.js pattern for: "{user_input}"
-"""
-        return prompt
+        suffix = strudel_prompt_suffix(
+            user_input,
+            genre=genre,
+            mood=mood,
+            energy=energy,
+            time_of_day=context.timeOfDay,
+            activity=context.activity,
+            patterns=genre_info['patterns'],
+            effects=genre_info['effects'],
+            genre_energy=genre_info['energy']
+        )
+        return suffix + (STRUCTURED_OUTPUT_INSTRUCTION if STRUCTURED_OUTPUT else "")
     
-    async def call_ollama(self, prompt: str) -> str:
-        """Call Ollama API for text generation"""
+    async def call_ollama(self, prompt_suffix: str, temperature: float = 0.7) -> str:
+        """Call Ollama API for text generation.
+        
+        Takes the request-specific prompt suffix; the static prefix is sent
+        in front of it, and Ollama reuses the prefix's KV cache.
+        """
         try:
-            response = await ollama_client.post(
-                f"http://{OLLAMA_HOST}/api/generate",
-                json={
-                    "model": OLLAMA_MODEL,
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.7,
-                        "top_p": 0.9,
-                        "max_tokens": 1000
-                    }
-                },
-                timeout=60.0
-            )
+            payload = {
+                "model": OLLAMA_MODEL,
+                "prompt": STRUDEL_PROMPT_PREFIX + prompt_suffix,
+                "stream": False,
+                "keep_alive": OLLAMA_KEEP_ALIVE,
+                "options": {
+                    "temperature": temperature,
+                    "top_p": 0.9,
+                    "max_tokens": 1000
+                }
+            }
             
-            if response.status_code != 200:
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Ollama API error: {response.text}"
-                )
+            if STRUCTURED_OUTPUT:
+                payload["format"] = STRUDEL_RESPONSE_SCHEMA
             
+            start = time.perf_counter()
+            response = await post_ollama("/api/generate", payload, hedge=HEDGE_REQUESTS)
             result = response.json()
+            observe_ollama(result, time.perf_counter() - start)
+            if "prompt_eval_count" in result:
+                # Fewer than the prompt's tokens when Ollama reused the prefix's KV cache
+                logger.info(f"📏 Prompt: ~{estimate_tokens(payload['prompt'])} tokens sent, {result['prompt_eval_count']} prefilled")
             return result.get("response", "")
             
+        except (DeadlineExceeded, StuckRequest):
+            raise
         except httpx.TimeoutException:
             raise HTTPException(status_code=504, detail="Ollama API timeout")
         except Exception as e:
@@ -191,33 +246,34 @@ Now generate a Strudel.js pattern for: "{user_input}"
     def parse_strudel_response(self, ai_text: str, user_input: str, music_dna: MusicDNA) -> MusicResponse:
         """Parse AI response and extract Strudel code"""
         
-        logger.info(f"Parsing AI response: {ai_text[:200]}...")
-        
-        # Extract code and description
-        code_match = re.search(r'CODE:\s*(.*?)(?=DESCRIPTION:|$)', ai_text, re.DOTALL | re.IGNORECASE)
-        desc_match = re.search(r'DESCRIPTION:\s*(.*?)(?:\n|$)', ai_text, re.IGNORECASE)
-        
-        strudel_code = ""
-        description = ""
+        logger.debug("Parsing AI response: %.200s", ai_text)
         
-        if code_match:
-            strudel_code = code_match.group(1).strip()
-            # Clean up the code
-            strudel_code = re.sub(r'```(?:javascript|js)?', '', strudel_code).strip()
-            strudel_code = re.sub(r'```', '', strudel_code).strip()
+        # Structured responses are JSON; fall through to the text format otherwise
+        structured = parse_structured_response(ai_text) if STRUCTURED_OUTPUT else None
         
-        if desc_match:
-            description = desc_match.group(1).strip()
+        # Extract code and description
+        strudel_code, description = structured or parse_code_description(ai_text)
         
         # Fallback if parsing fails
         if not strudel_code or len(strudel_code) < 20:
             logger.warning("AI parsing failed, generating fallback pattern")
-            return self.generate_fallback_pattern(user_input, music_dna)
+            return self.generate_fallback_pattern(user_input, music_dna, reason="parse_failure")
+        
+        # Validate Strudel syntax, repairing near misses before giving up
+        repair = repair_strudel(strudel_code)
+        if repair.fixes:
+            logger.info(f"🔧 Repaired pattern: {'; '.join(repair.fixes)}")
+            strudel_code = repair.code
+        if not repair.was_valid:
+            validation_stats["invalid"] += 1
+            validation_stats["repaired" if repair.valid else "unrepaired"] += 1
+            observe_repair(repair.valid)
         
-        # Validate Strudel syntax
-        if not self.validate_strudel_code(strudel_code):
+        if not repair.valid:
             logger.warning("Invalid Strudel syntax, generating fallback pattern")
-            return self.generate_fallback_pattern(user_input, music_dna)
+            fallback = self.generate_fallback_pattern(user_input, music_dna, reason="validation_failure")
+            fallback.metadata["validation_errors"] = [issue.to_dict() for issue in repair.validation.errors]
+            return fallback
         
         return MusicResponse(
             success=True,
@@ -239,69 +295,35 @@ Now generate a Strudel.js pattern for: "{user_input}"
         )
     
     def validate_strudel_code(self, code: str) -> bool:
-        """Basic validation of Strudel.js code"""
-        required_patterns = [
-            r'(?:stack|sound|note)\s*\(',  # Must have basic Strudel functions
-            r'["\'](?:bd|sd|hh|808|piano|guitar)["\']',  # Must have sound sources
-        ]
-        
-        for pattern in required_patterns:
-            if not re.search(pattern, code, re.IGNORECASE):
-                return False
-        
-        # Check for balanced parentheses
-        open_parens = code.count('(')
-        close_parens = code.count(')')
-        
-        return abs(open_parens - close_parens) <= 1  # Allow minor imbalance
+        """Parse the code as Strudel and log any syntax errors"""
+        validation = validate_strudel(code)
+        for issue in validation.errors:
+            logger.info(f"Strudel {issue.kind} error at {issue.line}:{issue.column}: {issue.message}")
+        return validation.valid
     
-    def generate_fallback_pattern(self, user_input: str, music_dna: MusicDNA) -> MusicResponse:
-        """Generate fallback pattern when AI fails"""
-        
-        genre = music_dna.primaryGenre or "lo-fi"
-        
-        fallback_patterns = {
-            "trap": '''stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4),
-  note("c1 ~ f1 g1").sound("808").lpf(80)
-)''',
-            "house": '''stack(
-  sound("bd*4").gain(0.8),
-  sound("~ ~ sd ~").gain(0.6),
-  sound("hh*8").gain(0.4),
-  note("c3 e3 g3 c4").sound("pluck").delay(0.25)
-)''',
-            "jazz": '''stack(
-  sound("bd ~ ~ bd").gain(0.6),
-  sound("~ sd ~ sd").gain(0.5),
-  sound("hh ~ hh ~").gain(0.3),
-  note("Cmaj7 Am7 Dm7 G7").sound("piano").slow(4)
-)''',
-            "country": '''stack(
-  sound("bd ~ bd ~").gain(0.6),
-  sound("~ sd ~ sd").gain(0.5),
-  sound("hh ~ hh ~").gain(0.3),
-  note("C G Am F").sound("guitar").slow(4)
-)''',
-            "lo-fi": '''stack(
-  sound("bd ~ ~ ~").gain(0.6),
-  sound("~ ~ sd ~").gain(0.5),
-  sound("hh*4").gain(0.3),
-  sound("vinyl").gain(0.1)
-)'''
-        }
+    def create_retry_prompt_suffix(self, prompt_suffix: str, errors: List[Dict[str, Any]]) -> str:
+        """The prompt suffix again, with the errors the previous attempt made"""
+        problems = "\n".join(f"- {error['message']}" for error in errors)
+        return f"""{prompt_suffix}
+Your previous pattern was not valid Strudel:
+{problems}
+Fix these problems and answer in the same format.
+"""
+    
+    def generate_fallback_pattern(self, user_input: str, music_dna: MusicDNA, reason: str = "error") -> MusicResponse:
+        """Generate fallback pattern when AI fails, for the given reason (parse_failure, validation_failure, timeout, error)"""
         
-        code = fallback_patterns.get(genre, fallback_patterns["lo-fi"])
+        pattern = generate_fallback(user_input, music_dna)
         
         return MusicResponse(
             success=True,
-            code=code,
-            description=f"Fallback {genre} pattern based on: \"{user_input}\"",
+            code=pattern.code,
+            description=f"{pattern.description}, based on: \"{user_input}\"",
             metadata={
-                "genre": genre,
+                "genre": pattern.genre,
                 "fallback": True,
+                "fallback_reason": reason,
+                "fallback_seed": pattern.seed,
                 "ai_source": "fallback_generator",
                 "timestamp": datetime.now().isoformat()
             },
@@ -315,6 +337,111 @@ Now generate a Strudel.js pattern for: "{user_input}"
 
 # Initialize generator
 music_generator = NalaMusicGenerator()
+response_cache = ResponseCache(max_entries=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+in_flight = SingleFlight()
+admission = AdmissionController(max_concurrency=MAX_CONCURRENT_GENERATIONS, max_queue=MAX_QUEUE_SIZE)
+warmup = Warmup()
+# Invalid patterns and how they were dealt with: repaired in place (or not),
+# and generations retried after an unrepairable syntax error
+validation_stats = {
+    "invalid": 0,
+    "repaired": 0,
+    "unrepaired": 0,
+    "retries": 0,
+    "recovered": 0,
+    "failed": 0
+}
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    """Tell overloaded clients when to come back instead of letting them time out"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.reason, "retry_after": exc.retry_after_header},
+        headers={"Retry-After": exc.retry_after_header}
+    )
+
+# The MusicContext fields create_strudel_prompt_suffix puts into the prompt;
+# the rest (userAgent, timestamp) differ on every request and would make
+# every key unique
+PROMPT_CONTEXT_FIELDS = {"timeOfDay", "activity"}
+
+def request_cache_key(request: MusicRequest) -> str:
+    """Cache key for a music request: canonical prompt + MusicDNA + temperature + prompt context"""
+    music_dna = request.musicDNA.model_dump() if request.musicDNA else None
+    context = request.context.model_dump(include=PROMPT_CONTEXT_FIELDS) if request.context else None
+    return make_cache_key(request.userInput, music_dna, request.temperature, context)
+
+def serve_cached(cached: MusicResponse, key: str, variation: bool) -> MusicResponse:
+    """Copy a cached response, optionally applying a deterministic variation"""
+    result = cached.model_copy(deep=True)
+    result.metadata.update({
+        "cache_hit": True,
+        "timestamp": datetime.now().isoformat()
+    })
+    
+    if variation:
+        variant = response_cache.hit_count(key)
+        result.code = vary_pattern(result.code, f"{key}:{variant}")
+        result.metadata["variation"] = variant
+    
+    return result
+
+async def backend_is_up(backend: Backend) -> bool:
+    try:
+        response = await ollama_client.get(f"{backend.url}/api/tags", timeout=5.0)
+        return response.status_code == 200
+    except Exception:
+        return False
+
+async def ollama_is_up() -> bool:
+    """Whether any Ollama backend answers, refreshing which models each has loaded"""
+    results = await asyncio.gather(*(backend_is_up(backend) for backend in ollama_pool.backends))
+    await ollama_pool.refresh_models(ollama_client.get)
+    return any(results)
+
+async def load_ollama_model():
+    """Load the model into memory on every backend (a generate call without a prompt only loads it)"""
+    async def load(backend: Backend) -> bool:
+        try:
+            response = await ollama_client.post(
+                f"{backend.url}/api/generate",
+                json={"model": OLLAMA_MODEL, "keep_alive": OLLAMA_KEEP_ALIVE},
+                timeout=WARMUP_TIMEOUT_SECONDS
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"⚠️ Could not load {OLLAMA_MODEL} on {backend.url}: {e}")
+            return False
+        backend.models = (backend.models or set()) | {model_key(OLLAMA_MODEL)}
+        return True
+    
+    loaded = await asyncio.gather(*(load(backend) for backend in ollama_pool.backends))
+    if not any(loaded):
+        raise RuntimeError(f"No Ollama backend could load {OLLAMA_MODEL}")
+    logger.info(f"📌 {OLLAMA_MODEL} loaded on {sum(loaded)}/{len(loaded)} Ollama backend(s)")
+
+async def warm_prompt_prefix():
+    """Run a short synthetic generation so the prompt prefix is already in Ollama's cache"""
+    await post_ollama("/api/generate", {
+        "model": OLLAMA_MODEL,
+        "prompt": music_generator.create_strudel_prompt("create a chill lo-fi beat", MusicDNA(), MusicContext()),
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
+        "options": {"num_predict": 8}
+    }, timeout=WARMUP_TIMEOUT_SECONDS)
+
+@app.on_event("startup")
+async def start_warmup():
+    """Warm Ollama up in the background; /ready reports when it is done"""
+    if not WARMUP_ENABLED:
+        warmup.ready = True
+        return
+    warmup.start([
+        ("ollama", lambda: wait_for(ollama_is_up, WARMUP_TIMEOUT_SECONDS)),
+        ("load", load_ollama_model),
+        ("generate", warm_prompt_prefix),
+    ])
 
 # API Endpoints
 @app.get("/health")
@@ -322,11 +449,16 @@ async def health_check():
     """Health check endpoint"""
     try:
         # Test Ollama connection
-        response = await ollama_client.get(f"http://{OLLAMA_HOST}/api/tags", timeout=5.0)
-        ollama_healthy = response.status_code == 200
+        ollama_healthy = await ollama_is_up()
+        
+        if not warmup.ready:
+            status = "warming_up"
+        else:
+            status = "healthy" if ollama_healthy else "degraded"
         
         return {
-            "status": "healthy" if ollama_healthy else "degraded",
+            "status": status,
+            "ready": warmup.ready,
             "timestamp": datetime.now().isoformat(),
             "services": {
                 "ollama": "online" if ollama_healthy else "offline",
@@ -341,49 +473,138 @@ async def health_check():
             "error": str(e)
         }
 
+@app.get("/ready")
+async def readiness():
+    """Readiness probe: 200 once warmup has finished, 503 until then"""
+    return JSONResponse(
+        status_code=200 if warmup.ready else 503,
+        content={"ready": warmup.ready, "warmup": warmup.stats()}
+    )
+
 @app.post("/generate-music", response_model=MusicResponse)
-async def generate_music(request: MusicRequest) -> MusicResponse:
-    """Generate Strudel.js music pattern using DeepSeek R1"""
+async def generate_music(request: MusicRequest, x_request_timeout: Optional[str] = Header(None)) -> MusicResponse:
+    """Generate Strudel.js music pattern using DeepSeek R1.
     
-    logger.info(f"Music generation request: {request.userInput}")
+    Answers with a fallback pattern rather than keep the caller waiting past
+    REQUEST_DEADLINE_SECONDS, or the X-Request-Timeout it sent if sooner.
+    """
+    
+    logger.info("Music generation request: %.80s", request.userInput)
+    start = time.perf_counter()
+    
+    cache_key = request_cache_key(request)
+    if CACHE_ENABLED:
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+            logger.info("Serving pattern from response cache")
+            result = serve_cached(cached, cache_key, bool(request.variation))
+            observe_request("generate-music", time.perf_counter() - start, cached=True)
+            return result
     
     try:
-        # Create specialized prompt
-        prompt = music_generator.create_strudel_prompt(
-            request.userInput, 
-            request.musicDNA, 
-            request.context
-        )
-        
-        # Call DeepSeek R1 via Ollama
-        ai_response = await music_generator.call_ollama(prompt)
-        
-        # Parse and validate response
-        result = music_generator.parse_strudel_response(
-            ai_response, 
-            request.userInput, 
-            request.musicDNA
-        )
+        # Identical concurrent requests share a single generation
+        with deadline(parse_timeout(x_request_timeout, REQUEST_DEADLINE_SECONDS)):
+            result = await in_flight.do(cache_key, lambda: generate_pattern(request, cache_key))
         
-        logger.info(f"Generated pattern: {result.description}")
+        logger.info("Generated pattern: %.80s", result.description)
+        observe_request("generate-music", time.perf_counter() - start, result.metadata.get("fallback_reason"))
         return result
         
-    except HTTPException:
-        raise
     except Exception as e:
+        reason = fallback_reason(e)
+        if isinstance(e, (HTTPException, AdmissionRejected)) and reason != "timeout":
+            # No pattern at all, but the dashboards still need to see it
+            observe_request("generate-music", time.perf_counter() - start, error=e)
+            raise
+        
+        # Including DeadlineExceeded, stuck Ollama calls and 504s: a fallback
+        # now beats an answer too late
         logger.error(f"Music generation error: {e}")
+        observe_request("generate-music", time.perf_counter() - start, reason)
         
         # Return fallback pattern
         return music_generator.generate_fallback_pattern(
             request.userInput, 
-            request.musicDNA
+            request.musicDNA,
+            reason=reason
         )
 
+async def generate_pattern(request: MusicRequest, cache_key: str) -> MusicResponse:
+    """Prompt, call DeepSeek R1 and parse the result for one request"""
+    
+    # Create specialized prompt (the static prefix is added by call_ollama)
+    with timed("prompt_build"):
+        prompt_suffix = music_generator.create_strudel_prompt_suffix(
+            request.userInput, 
+            request.musicDNA, 
+            request.context
+        )
+    
+    # Call DeepSeek R1 via Ollama once a generation slot is free, asking
+    # again (with the errors) only when the pattern cannot be repaired
+    queued_at = time.perf_counter()
+    async with admission.admit("interactive", budget(QUEUE_DEADLINE_SECONDS)):
+        observe_stage("admission", time.perf_counter() - queued_at)
+        attempt_suffix = prompt_suffix
+        for attempt in range(1, MAX_GENERATION_ATTEMPTS + 1):
+            ai_response = await music_generator.call_ollama(attempt_suffix, request.temperature)
+            
+            # Parse and validate response
+            with timed("parse_validate"):
+                result = music_generator.parse_strudel_response(
+                    ai_response, 
+                    request.userInput, 
+                    request.musicDNA
+                )
+            
+            errors = result.metadata.get("validation_errors")
+            if attempt > 1:
+                validation_stats["recovered" if not result.metadata.get("fallback") else "failed"] += 1
+            if not errors or attempt == MAX_GENERATION_ATTEMPTS:
+                break
+            
+            left = remaining()
+            typical = ollama_pool.latency("/api/generate").percentile(0.5)
+            if left is not None and typical is not None and left < typical:
+                logger.warning(f"⏳ {left:.1f}s left, not enough for another generation")
+                break
+            
+            validation_stats["retries"] += 1
+            logger.warning(f"🔁 Retrying generation after {len(errors)} syntax error(s) (attempt {attempt + 1}/{MAX_GENERATION_ATTEMPTS})")
+            attempt_suffix = music_generator.create_retry_prompt_suffix(prompt_suffix, errors)
+    
+    # Only genuine AI patterns are worth reusing
+    if CACHE_ENABLED and not result.metadata.get("fallback"):
+        response_cache.put(cache_key, result)
+    
+    return result
+
+@app.get("/stats")
+async def stats():
+    """Runtime statistics"""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "cache": response_cache.stats(),
+        "single_flight": in_flight.stats(),
+        "admission": admission.stats(),
+        "warmup": warmup.stats(),
+        "ollama": ollama_pool.stats(),
+        "validation": {
+            **validation_stats,
+            "repair_success_rate": round(validation_stats["repaired"] / validation_stats["invalid"], 3) if validation_stats["invalid"] else None
+        }
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: per-stage latency, Ollama throughput, fallback reasons and pattern repairs"""
+    return metrics_response()
+
 @app.get("/models")
 async def list_models():
     """List available Ollama models"""
     try:
-        response = await ollama_client.get(f"http://{OLLAMA_HOST}/api/tags")
+        response = await ollama_client.get(f"{ollama_pool.pick().url}/api/tags")
         if response.status_code == 200:
             return response.json()
         else:
@@ -401,7 +622,10 @@ async def root():
         "endpoints": {
             "generate": "/generate-music",
             "health": "/health",
+            "ready": "/ready",
             "models": "/models",
+            "stats": "/stats",
+            "metrics": "/metrics",
             "docs": "/docs"
         }
     }
@@ -409,12 +633,17 @@ async def root():
 if __name__ == "__main__":
     logger.info(f"🎵 Starting Nala AI Music API on port {API_PORT}")
     logger.info(f"🤖 Using Ollama model: {OLLAMA_MODEL}")
-    logger.info(f"📡 Ollama host: {OLLAMA_HOST}")
+    logger.info(f"📡 Ollama backends: {', '.join(OLLAMA_BACKENDS)}")
+    
+    # Only needed to serve directly; `uvicorn module:app` imports it itself
+    import uvicorn
     
     uvicorn.run(
         "music_api:app",
         host="0.0.0.0",
         port=API_PORT,
         log_level="info",
-        access_log=True
+        access_log=True,
+        # Leave uvicorn's loggers to configure_logging
+        log_config=None
     )
\ No newline at end of file
@@ -5,8 +5,8 @@ Optimized for Strudel.js pattern generation
 """
 
 import os
+import sys
 import json
-import re
 import asyncio
 import logging
 from typing import Dict, List, Optional, Any
@@ -18,6 +18,13 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 
+# nala_core sits at the repository root: Docker images copy it next to this
+# file, and a checkout run without PYTHONPATH finds it one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nala_core import generate_fallback
+from nala_core.prompts import STRUDEL_PROMPT, parse_code_description, strudel_prompt_suffix
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -83,35 +90,19 @@ class NalaMusicGenerator:
         mood = music_dna.preferredMood or "creative"
         energy = music_dna.energyLevel or 5
         
-        return f"""You are Nala AI, an expert music generation system specializing in Strudel.js code patterns.
-
-USER REQUEST: "{user_input}"
-
-MUSICAL CONTEXT:
-- Genre: {genre}
-- Mood: {mood}
-- Energy Level: {energy}/10
-
-STRUDEL.JS REQUIREMENTS:
-1. Generate ONLY valid Strudel.js code using stack(), sound(), note(), and effects
-2. Use appropriate sound sources: bd (kick), sd (snare), hh (hi-hat), 808 (bass)
-3. Apply effects like reverb(), delay(), lpf(), hpf(), gain()
-4. Match the {genre} genre style with {mood} mood
-
-RESPONSE FORMAT (REQUIRED):
-CODE: [your strudel code here]
-DESCRIPTION: [brief description of the pattern]
-
-EXAMPLE:
-CODE: stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4)
-)
-DESCRIPTION: Energetic trap beat with crisp hi-hats
-
-Now generate a Strudel.js pattern for: "{user_input}"
-"""
+        genre_info = self.genre_templates.get(genre, self.genre_templates["lo-fi"])
+        
+        return STRUDEL_PROMPT.prefix + strudel_prompt_suffix(
+            user_input,
+            genre=genre,
+            mood=mood,
+            energy=energy,
+            time_of_day=context.timeOfDay,
+            activity=context.activity,
+            patterns=genre_info["patterns"],
+            effects=genre_info["effects"],
+            genre_energy=genre_info.get("energy", "medium")
+        )
     
     async def call_ollama(self, prompt: str) -> str:
         try:
@@ -129,17 +120,9 @@ Now generate a Strudel.js pattern for: "{user_input}"
             raise HTTPException(status_code=500, detail=f"Ollama API error: {str(e)}")
     
     def parse_strudel_response(self, ai_text: str, user_input: str, music_dna: MusicDNA) -> MusicResponse:
-        code_match = re.search(r'CODE:\s*(.*?)(?=DESCRIPTION:|$)', ai_text, re.DOTALL | re.IGNORECASE)
-        desc_match = re.search(r'DESCRIPTION:\s*(.*?)(?:\n|$)', ai_text, re.IGNORECASE)
-        
-        if code_match:
-            strudel_code = code_match.group(1).strip()
-            strudel_code = re.sub(r'```(?:javascript|js)?', '', strudel_code).strip()
-            strudel_code = re.sub(r'```', '', strudel_code).strip()
-        else:
-            strudel_code = self.generate_fallback_pattern(music_dna.primaryGenre or "lo-fi")
-        
-        description = desc_match.group(1).strip() if desc_match else f"AI-generated {music_dna.primaryGenre} pattern"
+        strudel_code, description = parse_code_description(ai_text)
+        strudel_code = strudel_code or self.generate_fallback_pattern(user_input, music_dna)
+        description = description or f"AI-generated {music_dna.primaryGenre} pattern"
         
         return MusicResponse(
             success=True,
@@ -149,14 +132,8 @@ Now generate a Strudel.js pattern for: "{user_input}"
             uniqueness=0.9
         )
     
-    def generate_fallback_pattern(self, genre: str) -> str:
-        fallbacks = {
-            "trap": 'stack(sound("bd*2 ~ bd ~").gain(0.8), sound("~ ~ sd ~").gain(0.7), sound("hh*16").gain(0.4))',
-            "house": 'stack(sound("bd*4").gain(0.8), sound("~ ~ sd ~").gain(0.6), sound("hh*8").gain(0.4))',
-            "jazz": 'stack(sound("bd ~ ~ bd").gain(0.6), sound("~ sd ~ sd").gain(0.5), sound("hh ~ hh ~").gain(0.3))',
-            "lo-fi": 'stack(sound("bd ~ ~ ~").gain(0.6), sound("~ ~ sd ~").gain(0.5), sound("hh*4").gain(0.3))'
-        }
-        return fallbacks.get(genre, fallbacks["lo-fi"])
+    def generate_fallback_pattern(self, user_input: str, music_dna: MusicDNA) -> str:
+        return generate_fallback(user_input, music_dna).code
 
 music_generator = NalaMusicGenerator()
 
@@ -180,7 +157,7 @@ async def generate_music(request: MusicRequest) -> MusicResponse:
         return result
     except Exception as e:
         logger.error(f"Music generation error: {e}")
-        return MusicResponse(success=True, code=music_generator.generate_fallback_pattern(request.musicDNA.primaryGenre or "lo-fi"), description=f"Fallback pattern for: {request.userInput}", metadata={"fallback": True, "timestamp": datetime.now().isoformat()}, uniqueness=0.7)
+        return MusicResponse(success=True, code=music_generator.generate_fallback_pattern(request.userInput, request.musicDNA), description=f"Fallback pattern for: {request.userInput}", metadata={"fallback": True, "timestamp": datetime.now().isoformat()}, uniqueness=0.7)
 
 @app.get("/")
 async def root():
@@ -4,32 +4,86 @@ Provides OpenAI-compatible API specifically optimized for music generation
 """
 
 import os
+import sys
 import json
-import re
 import asyncio
-from typing import Optional, Dict, Any, List
+import time
+import weakref
+from contextlib import aclosing
+from typing import Optional, Dict, Any, List, AsyncIterator, Tuple, Union
 from datetime import datetime
 import logging
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, Header, HTTPException, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 import httpx
-import uvicorn
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# nala_core sits at the repository root: Docker images copy it next to this
+# file, and a checkout run without PYTHONPATH finds it one directory up
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, AdmissionRejected, AdmissionTicket
+from compression import CompressionMiddleware
+from backend_pool import Backend, BackendPool, model_key, parse_backend_urls, request_kind
+from deadlines import DeadlineExceeded, budget, deadline, parse_timeout
+from metrics import fallback_reason, metrics_response, observe_ollama, observe_request, observe_stage, timed
+from response_cache import make_cache_key
+from single_flight import SingleFlight
+from structured_logging import RequestContextMiddleware, configure_logging
+from warmup import Warmup, wait_for
+from nala_core import StrudelExtractor, extract_strudel_code, generate_fallback, project_fields
+from nala_core.constrained import STRUCTURED_OUTPUT_INSTRUCTION, STRUDEL_RESPONSE_SCHEMA, parse_structured_response
+from nala_core.prompts import BudgetedPrompt, MUSIC_PROMPT, budget_music_prompt_suffix, estimate_tokens, extract_description
+
+# Configure logging: JSON lines (LOG_FORMAT=text for plain ones), written off the event loop
+configure_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FORMAT", "json") == "json")
 logger = logging.getLogger(__name__)
 
 # Configuration
 OLLAMA_BASE_URL = "http://localhost:11434"
+# Comma-separated Ollama URLs (or host:port); generations are spread across them
+OLLAMA_BACKENDS = parse_backend_urls(os.getenv("OLLAMA_BACKENDS", OLLAMA_BASE_URL))
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-r1:8b")
 API_PORT = int(os.getenv("API_PORT", "8000"))
+MAX_CONCURRENT_GENERATIONS = int(os.getenv("MAX_CONCURRENT_GENERATIONS", "2"))
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "32"))
+# Time a non-streaming request may take in all, queueing included;
+# X-Request-Timeout can only shorten it
+INTERACTIVE_DEADLINE_SECONDS = float(os.getenv("INTERACTIVE_DEADLINE_SECONDS", "30"))
+BULK_DEADLINE_SECONDS = float(os.getenv("BULK_DEADLINE_SECONDS", "120"))
+# The longest any single Ollama call may take
+OLLAMA_TIMEOUT_SECONDS = float(os.getenv("OLLAMA_TIMEOUT_SECONDS", "300"))
+# Send a duplicate non-streaming generation to another backend once one has
+# run past the HEDGE_QUANTILE of recent latencies; abandon one running past
+# STUCK_REQUEST_FACTOR x their p99 (0 disables)
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+STUCK_REQUEST_FACTOR = float(os.getenv("STUCK_REQUEST_FACTOR", "3"))
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+EARLY_STOP = os.getenv("EARLY_STOP", "true").lower() == "true"
+EARLY_STOP_DESCRIPTION_CHARS = int(os.getenv("EARLY_STOP_DESCRIPTION_CHARS", "200"))
+# Non-streaming generations ask Ollama for JSON matching STRUDEL_RESPONSE_SCHEMA
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "false").lower() == "true"
+# Prompt length including the static prefix; low-value MusicDNA/context fields are dropped to fit
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "2048"))
+# Fraction of requests whose INFO lines are logged; warnings and errors always are
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+# gzip (brotli if installed) for responses of at least COMPRESSION_MIN_BYTES; never for streams
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1000"))
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+WARMUP_TIMEOUT_SECONDS = float(os.getenv("WARMUP_TIMEOUT_SECONDS", "300"))
 
 app = FastAPI(
     title="Nala AI Music Generation API",
     description="OpenAI-compatible API for music generation using Ollama + DeepSeek R1",
     version="1.0.0"
 )
+if RESPONSE_COMPRESSION:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+# Request IDs (X-Request-ID) on every log line, and log sampling
+app.add_middleware(RequestContextMiddleware, sample_rate=LOG_SAMPLE_RATE)
 
 # Request/Response Models
 class MusicGenerationRequest(BaseModel):
@@ -39,6 +93,9 @@ class MusicGenerationRequest(BaseModel):
     max_tokens: Optional[int] = Field(800, description="Maximum tokens to generate")
     temperature: Optional[float] = Field(0.8, description="Sampling temperature")
     system_prompt: Optional[str] = Field(None, description="Custom system prompt")
+    stream: Optional[bool] = Field(False, description="Stream the result as server-sent events")
+    fields: Optional[Union[List[str], str]] = Field(None, description="Only return these fields, e.g. [\"code\", \"metadata.genre\"] or \"code,description\"")
+    verbose: Optional[bool] = Field(False, description="Include the raw model output as metadata.raw_response")
 
 class ChatMessage(BaseModel):
     role: str
@@ -57,6 +114,7 @@ class HealthResponse(BaseModel):
     ollama_status: str
     model: str
     api_version: str
+    ready: bool = True
 
 class MusicGenerationResponse(BaseModel):
     success: bool
@@ -67,12 +125,21 @@ class MusicGenerationResponse(BaseModel):
 
 # Ollama client
 class OllamaClient:
-    def __init__(self, base_url: str = OLLAMA_BASE_URL):
-        self.base_url = base_url
-        self.client = httpx.AsyncClient(timeout=300.0)  # 5 minute timeout
+    def __init__(self, backends: List[str] = OLLAMA_BACKENDS):
+        self.pool = BackendPool(backends, hedge_quantile=HEDGE_QUANTILE, stuck_factor=STUCK_REQUEST_FACTOR)
+        self.client = httpx.AsyncClient(timeout=OLLAMA_TIMEOUT_SECONDS)
     
-    async def generate(self, model: str, prompt: str, **kwargs) -> Dict[str, Any]:
-        """Generate text using Ollama"""
+    async def generate(self, model: str, prompt: str, stop_controller: Optional["StrudelStopController"] = None, hedge: bool = False, **kwargs) -> Dict[str, Any]:
+        """Generate text using Ollama.
+        
+        With a stop_controller the generation is streamed and the upstream
+        request is closed as soon as the controller has everything it needs,
+        which makes Ollama abort the rest of the generation. Otherwise, with
+        hedge, a slow generation is duplicated on another backend.
+        """
+        if stop_controller is not None:
+            return await self._generate_until_stopped(model, prompt, stop_controller, **kwargs)
+        
         try:
             payload = {
                 "model": model,
@@ -81,12 +148,11 @@ class OllamaClient:
                 **kwargs
             }
             
-            response = await self.client.post(
-                f"{self.base_url}/api/generate",
-                json=payload
-            )
-            response.raise_for_status()
-            return response.json()
+            start = time.perf_counter()
+            response = await self._post("/api/generate", payload, hedge=hedge)
+            result = response.json()
+            observe_ollama(result, time.perf_counter() - start)
+            return result
             
         except httpx.RequestError as e:
             logger.error(f"Ollama request error: {e}")
@@ -95,6 +161,39 @@ class OllamaClient:
             logger.error(f"Ollama HTTP error: {e}")
             raise HTTPException(status_code=500, detail="Ollama generation failed")
     
+    async def _generate_until_stopped(self, model: str, prompt: str, stop_controller: "StrudelStopController", **kwargs) -> Dict[str, Any]:
+        """Stream a generation, cancelling it once the stop controller is satisfied"""
+        result: Dict[str, Any] = {}
+        
+        async def consume() -> None:
+            nonlocal result
+            chunks = 0
+            # Closing the stream on break cancels the Ollama generation and
+            # frees the backend slot right away, not whenever it is collected
+            async with aclosing(self.generate_stream(model, prompt, **kwargs)) as stream:
+                async for chunk in stream:
+                    result = chunk
+                    chunks += 1
+                    if chunks == 1:
+                        first_chunk_at = time.perf_counter()
+                    if stop_controller.feed(chunk.get("response", "")):
+                        logger.info(f"✂️ Early stop after {len(stop_controller.text)} characters")
+                        result = {**chunk, "done": True, "done_reason": "early_stop"}
+                        # Ollama only reports durations on the final chunk; one
+                        # chunk is one token, so decoding is timed from the first
+                        observe_ollama({"eval_count": chunks - 1, "eval_duration": (time.perf_counter() - first_chunk_at) * 1e9})
+                        break
+        
+        timeout = budget(OLLAMA_TIMEOUT_SECONDS)
+        try:
+            await asyncio.wait_for(consume(), timeout)
+        except asyncio.TimeoutError:
+            if timeout < OLLAMA_TIMEOUT_SECONDS:
+                raise DeadlineExceeded("request deadline passed while streaming from Ollama")
+            raise HTTPException(status_code=504, detail="Ollama generation timed out")
+        
+        return {**result, "response": stop_controller.text}
+    
     async def chat(self, model: str, messages: List[Dict], **kwargs) -> Dict[str, Any]:
         """Chat completion using Ollama"""
         try:
@@ -105,12 +204,11 @@ class OllamaClient:
                 **kwargs
             }
             
-            response = await self.client.post(
-                f"{self.base_url}/api/chat",
-                json=payload
-            )
-            response.raise_for_status()
-            return response.json()
+            start = time.perf_counter()
+            response = await self._post("/api/chat", payload)
+            result = response.json()
+            observe_ollama(result, time.perf_counter() - start)
+            return result
             
         except httpx.RequestError as e:
             logger.error(f"Ollama chat request error: {e}")
@@ -119,10 +217,85 @@ class OllamaClient:
             logger.error(f"Ollama chat HTTP error: {e}")
             raise HTTPException(status_code=500, detail="Ollama chat failed")
     
+    def generate_stream(self, model: str, prompt: str, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """Stream generation chunks from Ollama as they arrive; aclose() cancels the generation"""
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            **kwargs
+        }
+        return self._stream("/api/generate", payload)
+    
+    def chat_stream(self, model: str, messages: List[Dict], **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        """Stream chat completion chunks from Ollama as they arrive; aclose() cancels the generation"""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": True,
+            **kwargs
+        }
+        return self._stream("/api/chat", payload)
+    
+    async def _post(self, path: str, payload: Dict[str, Any], hedge: bool = False) -> httpx.Response:
+        """POST to a backend from the pool, within the current request's deadline"""
+        async def send(backend: Backend, timeout: float) -> httpx.Response:
+            response = await self.client.post(f"{backend.url}{path}", json=payload, timeout=timeout)
+            response.raise_for_status()
+            return response
+        
+        return await self.pool.request(payload["model"], send, OLLAMA_TIMEOUT_SECONDS, kind=request_kind(path, payload), hedge=hedge)
+    
+    async def _stream(self, path: str, payload: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """POST to Ollama and yield each newline-delimited JSON chunk"""
+        try:
+            async with self.pool.acquire(payload["model"]) as backend:
+                start = time.perf_counter()
+                async with self.client.stream("POST", f"{backend.url}{path}", json=payload) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.strip():
+                            continue
+                        chunk = json.loads(line)
+                        if chunk.get("error"):
+                            raise HTTPException(status_code=500, detail=chunk["error"])
+                        if chunk.get("done"):
+                            observe_ollama(chunk, time.perf_counter() - start)
+                            yield chunk
+                            break
+                        yield chunk
+                        
+        except httpx.RequestError as e:
+            logger.error(f"Ollama stream request error: {e}")
+            raise HTTPException(status_code=503, detail="Ollama service unavailable")
+        except httpx.HTTPStatusError as e:
+            logger.error(f"Ollama stream HTTP error: {e}")
+            raise HTTPException(status_code=500, detail="Ollama generation failed")
+    
+    async def load_model(self, model: str) -> None:
+        """Load the model on every backend (a generate call without a prompt only loads it)"""
+        async def load(backend: Backend) -> bool:
+            try:
+                response = await self.client.post(
+                    f"{backend.url}/api/generate",
+                    json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}
+                )
+                response.raise_for_status()
+            except Exception as e:
+                logger.warning(f"⚠️ Could not load {model} on {backend.url}: {e}")
+                return False
+            backend.models = (backend.models or set()) | {model_key(model)}
+            return True
+        
+        loaded = await asyncio.gather(*(load(backend) for backend in self.pool.backends))
+        if not any(loaded):
+            raise RuntimeError(f"No Ollama backend could load {model}")
+        logger.info(f"📌 {model} loaded on {sum(loaded)}/{len(loaded)} Ollama backend(s)")
+    
     async def list_models(self) -> Dict[str, Any]:
         """List available models"""
         try:
-            response = await self.client.get(f"{self.base_url}/api/tags")
+            response = await self.client.get(f"{self.pool.pick().url}/api/tags")
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -130,257 +303,223 @@ class OllamaClient:
             return {"models": []}
     
     async def health_check(self) -> bool:
-        """Check if Ollama is healthy"""
-        try:
-            response = await self.client.get(f"{self.base_url}/api/tags", timeout=5.0)
-            return response.status_code == 200
-        except Exception:
-            return False
+        """Check if any Ollama backend is healthy, refreshing which models each has loaded"""
+        async def healthy(backend: Backend) -> bool:
+            try:
+                response = await self.client.get(f"{backend.url}/api/tags", timeout=5.0)
+                return response.status_code == 200
+            except Exception:
+                return False
+        
+        results = await asyncio.gather(*(healthy(backend) for backend in self.pool.backends))
+        await self.pool.refresh_models(self.client.get)
+        return any(results)
 
 # Initialize Ollama client
 ollama = OllamaClient()
+in_flight = SingleFlight()
+
+# Interactive music generation is served ahead of bulk chat completions
+admission = AdmissionController(max_concurrency=MAX_CONCURRENT_GENERATIONS, max_queue=MAX_QUEUE_SIZE)
+warmup = Warmup()
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    """Tell overloaded clients when to come back instead of letting them time out"""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": exc.reason, "retry_after": exc.retry_after_header},
+        headers={"Retry-After": exc.retry_after_header}
+    )
 
 # Music generation utilities
-def create_music_prompt(user_input: str, music_dna: Optional[Dict] = None, context: Optional[Dict] = None) -> str:
-    """Create a specialized prompt for music generation"""
-    
-    prompt = f"""You are Nala, an expert AI music producer and composer with deep knowledge of electronic music, rhythm programming, and the Strudel live coding language.
-
-User Request: "{user_input}"
-
-Context:
-- Musical DNA: {json.dumps(music_dna, indent=2) if music_dna else 'Not provided'}
-- Context: {json.dumps(context, indent=2) if context else 'Not provided'}
-
-Your task is to generate a unique Strudel pattern that perfectly matches the user's request.
-
-IMPORTANT GUIDELINES:
-1. Analyze the user's musical intent, genre preferences, and emotional context
-2. Use proper Strudel syntax with functions like: stack(), sound(), note(), gain(), lpf(), hpf(), room(), delay(), slow(), fast()
-3. Create rhythmic patterns using drum sounds: "bd" (kick), "sd" (snare), "hh" (hihat), "oh" (open hihat), "cp" (clap)
-4. Use musical notation for melodies: "c4", "d4", "e4", etc., or chord names like "Cmaj7", "Dm"
-5. Apply appropriate effects and filters based on the requested style
-6. Make each pattern unique and creative while staying true to the genre
-7. Consider tempo, energy level, and complexity based on the request
-8. Always wrap your Strudel code in triple backticks with 'strudel' language tag
-
-EXAMPLE STRUDEL PATTERNS:
-
-Trap:
-```strudel
-stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4),
-  sound("808").note("c1 ~ f1 g1").lpf(80)
-)
-```
-
-Lo-Fi:
-```strudel
-stack(
-  sound("bd ~ ~ ~").gain(0.6),
-  sound("~ ~ sd ~").gain(0.5),
-  sound("hh*4").gain(0.3),
-  note("c2 ~ f1 g1").sound("sawtooth").lpf(400),
-  sound("vinyl").gain(0.1)
-)
-```
-
-House:
-```strudel
-stack(
-  sound("bd*4").gain(0.8),
-  sound("~ ~ sd ~").gain(0.6),
-  sound("hh*8").gain(0.4),
-  note("c3 ~ e3 g3").sound("pluck").delay(0.25).lpf(2000)
-)
-```
-
-Now generate a unique Strudel pattern for: "{user_input}"
-
-Respond with:
-1. The Strudel code wrapped in ```strudel and ```
-2. A brief description of what you created and why it fits the request
-3. Any reasoning about musical choices you made
+# Static instructions shared by every request. Keeping them first, before
+# anything request-specific, lets Ollama reuse their KV cache between requests.
+MUSIC_PROMPT_PREFIX = MUSIC_PROMPT.prefix
+# Ollama does not expose its tokenizer, so prompt sizes here are estimates
+MUSIC_PROMPT_PREFIX_TOKENS = estimate_tokens(MUSIC_PROMPT_PREFIX)
+
+def budget_prompt_suffix(user_input: str, music_dna: Optional[Dict] = None, context: Optional[Dict] = None, reserved_tokens: int = 0) -> BudgetedPrompt:
+    """Request-specific part of the prompt, fitted into MAX_PROMPT_TOKENS behind the prefix"""
+    return budget_music_prompt_suffix(
+        user_input, music_dna, context, MAX_PROMPT_TOKENS - MUSIC_PROMPT_PREFIX_TOKENS - reserved_tokens
+    )
 
-Pattern:"""
+def create_music_prompt_suffix(user_input: str, music_dna: Optional[Dict] = None, context: Optional[Dict] = None) -> str:
+    """Request-specific part of the prompt, appended after MUSIC_PROMPT_PREFIX"""
+    return budget_prompt_suffix(user_input, music_dna, context).suffix
 
-    return prompt
+def create_music_prompt(user_input: str, music_dna: Optional[Dict] = None, context: Optional[Dict] = None) -> str:
+    """Create a specialized prompt for music generation"""
+    return MUSIC_PROMPT_PREFIX + create_music_prompt_suffix(user_input, music_dna, context)
 
-def extract_strudel_code(ai_response: str) -> Optional[str]:
-    """Extract Strudel code from AI response"""
-    
-    # Look for code blocks with strudel tag
-    strudel_match = re.search(r'```strudel\n(.*?)\n```', ai_response, re.DOTALL)
-    if strudel_match:
-        return strudel_match.group(1).strip()
-    
-    # Look for any stack() pattern
-    stack_match = re.search(r'(stack\([^}]+\}[^)]*\)(?:\.[^)]+\([^)]*\))*)', ai_response, re.DOTALL)
-    if stack_match:
-        return stack_match.group(1).strip()
-    
-    # Look for code blocks without tag
-    code_match = re.search(r'```\n(.*?)\n```', ai_response, re.DOTALL)
-    if code_match:
-        code = code_match.group(1).strip()
-        if 'stack(' in code:
-            return code
+class StrudelStopController:
+    """Decide when a streamed music generation can be cut short.
     
-    return None
-
-def extract_description(ai_response: str, user_input: str) -> str:
-    """Extract description from AI response"""
+    Everything after the ```strudel block and a short description is
+    discarded by extract_strudel_code/extract_description, so once both are
+    complete there is no reason to keep the GPU busy. The extractor skips a
+    leading <think> preamble, so a draft block inside it does not end
+    generation.
+    """
     
-    # Remove code blocks
-    text = re.sub(r'```.*?```', '', ai_response, flags=re.DOTALL)
+    def __init__(self, description_chars: int = EARLY_STOP_DESCRIPTION_CHARS):
+        self.description_chars = description_chars
+        self.extractor = StrudelExtractor()
     
-    # Look for description patterns
-    desc_patterns = [
-        r'Description:\s*(.*?)(?:\n\n|\n[A-Z]|$)',
-        r'This pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)',
-        r'I created\s*(.*?)(?:\n\n|\n[A-Z]|$)',
-        r'The pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)'
-    ]
+    @property
+    def code(self) -> Optional[str]:
+        return self.extractor.code
     
-    for pattern in desc_patterns:
-        match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-        if match:
-            desc = match.group(1).strip()
-            if len(desc) > 10:  # Ensure it's a meaningful description
-                return desc[:200] + ('...' if len(desc) > 200 else '')
+    @property
+    def text(self) -> str:
+        return self.extractor.text
     
-    # Fallback: use first meaningful sentence
-    sentences = text.split('.')
-    for sentence in sentences:
-        sentence = sentence.strip()
-        if len(sentence) > 20 and any(word in sentence.lower() for word in ['pattern', 'music', 'create', 'generate', 'beat', 'rhythm']):
-            return sentence + '.'
+    def feed(self, chunk: str) -> bool:
+        """Add a chunk of text; returns True once generation should stop"""
+        self.extractor.feed(chunk)
+        if self.extractor.code is None:
+            return False
+        
+        description = self.extractor.text_since_code(self.description_chars + 1).strip()
+        return len(description) >= self.description_chars or "\n\n" in description
     
-    return f"AI-generated musical pattern based on: {user_input}"
+    def finish(self) -> Optional[str]:
+        """The extracted code once the stream has ended"""
+        return self.extractor.finish()
 
-def generate_fallback_pattern(user_input: str) -> Dict[str, Any]:
+def generate_fallback_pattern(user_input: str, music_dna: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """Generate fallback pattern when AI fails"""
-    
-    lower_input = user_input.lower()
-    
-    if 'trap' in lower_input:
-        return {
-            'strudel_code': '''stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4),
-  sound("808").note("c1 ~ f1 g1").lpf(80)
-).slow(1.5)''',
-            'description': 'Aggressive trap pattern with heavy 808s and rapid hi-hats (fallback generation)'
-        }
-    elif 'house' in lower_input or 'edm' in lower_input:
-        return {
-            'strudel_code': '''stack(
-  sound("bd*4").gain(0.8),
-  sound("~ ~ sd ~").gain(0.6),
-  sound("hh*8").gain(0.4),
-  note("c3 ~ e3 g3").sound("pluck").delay(0.25).lpf(2000)
-)''',
-            'description': 'Four-on-the-floor house pattern with melodic plucks (fallback generation)'
-        }
-    elif 'country' in lower_input or 'folk' in lower_input:
-        return {
-            'strudel_code': '''stack(
-  sound("bd ~ bd bd").gain(0.6),
-  sound("~ sd ~ sd").gain(0.5),
-  sound("hh ~ hh ~").gain(0.3),
-  note("C G Am F").sound("guitar").slow(8).gain(0.3)
-).slow(1.8)''',
-            'description': 'Country-style pattern with acoustic guitar (fallback generation)'
-        }
-    else:
-        return {
-            'strudel_code': '''stack(
-  sound("bd ~ ~ ~").gain(0.6),
-  sound("~ ~ sd ~").gain(0.5),
-  sound("hh*4").gain(0.3),
-  note("c2 ~ f1 g1").sound("sawtooth").lpf(400),
-  sound("vinyl").gain(0.1)
-).slow(1.8)''',
-            'description': 'Chill lo-fi pattern with vinyl texture (fallback generation)'
-        }
+    pattern = generate_fallback(user_input, music_dna)
+    return {
+        'strudel_code': pattern.code,
+        'description': f"{pattern.description} (fallback generation)",
+        'genre': pattern.genre,
+        'seed': pattern.seed
+    }
+
+async def warm_prompt_prefix():
+    """Run a short synthetic generation so the prompt prefix is already in Ollama's cache"""
+    await ollama.generate(
+        DEEPSEEK_MODEL,
+        **music_prompt_args(MusicGenerationRequest(userInput="create a chill lo-fi beat")),
+        options={"num_predict": 8}
+    )
 
-# API Routes
-@app.get("/", response_model=HealthResponse)
-async def root():
-    """Root endpoint with health information"""
+@app.on_event("startup")
+async def start_warmup():
+    """Load and pin the model in the background; /ready reports when it is done"""
+    if not WARMUP_ENABLED:
+        warmup.ready = True
+        return
+    warmup.start([
+        ("ollama", lambda: wait_for(ollama.health_check, WARMUP_TIMEOUT_SECONDS)),
+        ("load", lambda: ollama.load_model(DEEPSEEK_MODEL)),
+        ("generate", warm_prompt_prefix),
+    ])
+
+async def service_health() -> HealthResponse:
     ollama_healthy = await ollama.health_check()
+    if not warmup.ready:
+        status = "warming_up"
+    else:
+        status = "healthy" if ollama_healthy else "degraded"
     return HealthResponse(
-        status="healthy" if ollama_healthy else "degraded",
+        status=status,
         timestamp=datetime.now().isoformat(),
         ollama_status="running" if ollama_healthy else "error",
         model=DEEPSEEK_MODEL,
-        api_version="1.0.0"
+        api_version="1.0.0",
+        ready=warmup.ready
     )
 
+# API Routes
+@app.get("/", response_model=HealthResponse)
+async def root():
+    """Root endpoint with health information"""
+    return await service_health()
+
 @app.get("/health", response_model=HealthResponse)
 async def health():
     """Health check endpoint"""
-    ollama_healthy = await ollama.health_check()
-    return HealthResponse(
-        status="healthy" if ollama_healthy else "degraded",
-        timestamp=datetime.now().isoformat(),
-        ollama_status="running" if ollama_healthy else "error",
-        model=DEEPSEEK_MODEL,
-        api_version="1.0.0"
+    return await service_health()
+
+@app.get("/ready")
+async def readiness():
+    """Readiness probe: 200 once warmup has finished, 503 until then"""
+    return JSONResponse(
+        status_code=200 if warmup.ready else 503,
+        content={"ready": warmup.ready, "warmup": warmup.stats()}
     )
 
-@app.post("/api/generate-music", response_model=MusicGenerationResponse)
-async def generate_music(request: MusicGenerationRequest):
-    """Generate music using Ollama + DeepSeek R1"""
+def sse_event(data: Any, event: Optional[str] = None) -> str:
+    """Format a server-sent event"""
+    payload = data if isinstance(data, str) else json.dumps(data)
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {payload}\n\n"
+
+def music_prompt_args(request: MusicGenerationRequest, structured: bool = False) -> Dict[str, Any]:
+    """Prompt arguments for Ollama: the static prefix followed by the request's suffix"""
+    instruction = "\n" + STRUCTURED_OUTPUT_INSTRUCTION if structured else ""
+    with timed("prompt_build"):
+        prompt = budget_prompt_suffix(request.userInput, request.musicDNA, request.context, estimate_tokens(instruction))
+    suffix = prompt.suffix + instruction
+    logger.info(
+        f"📏 Prompt tokens: ~{MUSIC_PROMPT_PREFIX_TOKENS + prompt.tokens + estimate_tokens(instruction)} (estimated)"
+        + (f", dropped {', '.join(prompt.dropped)}" if prompt.dropped else "")
+        + (", request clipped" if prompt.clipped else "")
+    )
     
-    try:
-        logger.info(f"🎵 Music generation request: {request.userInput}")
-        
-        # Create specialized music prompt
-        prompt = create_music_prompt(request.userInput, request.musicDNA, request.context)
-        
-        # Generate with Ollama
-        logger.info(f"🤖 Generating with model: {DEEPSEEK_MODEL}")
-        response = await ollama.generate(
-            model=DEEPSEEK_MODEL,
-            prompt=prompt,
-            options={
-                "temperature": request.temperature,
-                "num_predict": request.max_tokens,
-                "top_p": 0.9,
-                "stop": ["Human:", "User:", "\n\n\n"]
+    args: Dict[str, Any] = {"keep_alive": OLLAMA_KEEP_ALIVE}
+    if structured:
+        args["format"] = STRUDEL_RESPONSE_SCHEMA
+    
+    # Ollama reuses the KV cache for the unchanged static prefix
+    return {**args, "prompt": MUSIC_PROMPT_PREFIX + suffix}
+
+def music_generation_options(request: MusicGenerationRequest) -> Dict[str, Any]:
+    """Ollama sampling options for a music generation request"""
+    return {
+        "temperature": request.temperature,
+        "num_predict": request.max_tokens,
+        "top_p": 0.9,
+        "stop": ["Human:", "User:", "\n\n\n"]
+    }
+
+def build_music_response(ai_text: str, request: MusicGenerationRequest, strudel_code: Optional[str] = None) -> MusicGenerationResponse:
+    """Turn raw model output into a music response, falling back if no code was found.
+    
+    The raw output itself is only included (as metadata.raw_response) for verbose requests.
+    """
+    
+    # Extract Strudel code and description
+    structured = parse_structured_response(ai_text) if STRUCTURED_OUTPUT else None
+    if structured:
+        strudel_code, description = structured
+        description = description or extract_description("", request.userInput)
+    else:
+        strudel_code = strudel_code or extract_strudel_code(ai_text)
+        description = extract_description(ai_text, request.userInput)
+    
+    # Use fallback if no valid code found
+    if not strudel_code:
+        logger.warning("⚠️ No valid Strudel code found, using fallback")
+        fallback = generate_fallback_pattern(request.userInput, request.musicDNA)
+        response = MusicGenerationResponse(
+            success=True,
+            code=fallback['strudel_code'],
+            description=fallback['description'] + " (AI attempted but fallback used)",
+            metadata={
+                "genre": fallback['genre'],
+                "timestamp": datetime.now().isoformat(),
+                "fallback_used": True,
+                "fallback_seed": fallback['seed'],
+                "fallback_reason": "parse_failure"
             }
         )
-        
-        ai_text = response.get("response", "")
-        logger.info(f"✅ Generated {len(ai_text)} characters")
-        
-        # Extract Strudel code and description
-        strudel_code = extract_strudel_code(ai_text)
-        description = extract_description(ai_text, request.userInput)
-        
-        # Use fallback if no valid code found
-        if not strudel_code:
-            logger.warning("⚠️ No valid Strudel code found, using fallback")
-            fallback = generate_fallback_pattern(request.userInput)
-            return MusicGenerationResponse(
-                success=True,
-                code=fallback['strudel_code'],
-                description=fallback['description'] + " (AI attempted but fallback used)",
-                metadata={
-                    "genre": "unknown",
-                    "timestamp": datetime.now().isoformat(),
-                    "fallback_used": True,
-                    "raw_response": ai_text[:500] + "..." if len(ai_text) > 500 else ai_text
-                }
-            )
-        
+    else:
         logger.info("🎼 Successfully extracted Strudel pattern")
-        
-        return MusicGenerationResponse(
+        response = MusicGenerationResponse(
             success=True,
             code=strudel_code,
             description=description,
@@ -389,44 +528,177 @@ async def generate_music(request: MusicGenerationRequest):
                 "timestamp": datetime.now().isoformat(),
                 "model": DEEPSEEK_MODEL,
                 "temperature": request.temperature,
-                "fallback_used": False,
-                "raw_response": ai_text[:500] + "..." if len(ai_text) > 500 else ai_text
+                "fallback_used": False
             }
         )
+    
+    if request.verbose:
+        response.metadata["raw_response"] = ai_text
+    return response
+
+def music_response_content(result: MusicGenerationResponse, request: MusicGenerationRequest) -> Dict[str, Any]:
+    """The response fields the request asked for (all by default); success is always included"""
+    return project_fields(result.model_dump(), request.fields, required=("success",))
+
+def admitted_stream(body: AsyncIterator[str], ticket: AdmissionTicket) -> StreamingResponse:
+    """Server-sent event response that gives its admission slot back when done"""
+    # The body releases the ticket when it finishes; this covers a client
+    # that disconnects before the body is ever iterated
+    weakref.finalize(body, ticket.release)
+    return StreamingResponse(body, media_type="text/event-stream")
+
+def error_fallback_response(request: MusicGenerationRequest, error: Exception) -> MusicGenerationResponse:
+    """Fallback response used when generation raised an error"""
+    fallback = generate_fallback_pattern(request.userInput, request.musicDNA)
+    return MusicGenerationResponse(
+        success=True,
+        code=fallback['strudel_code'],
+        description=fallback['description'] + " (error fallback)",
+        metadata={
+            "genre": fallback['genre'],
+            "timestamp": datetime.now().isoformat(),
+            "error": str(error),
+            "fallback_used": True,
+            "fallback_seed": fallback['seed'],
+            "fallback_reason": fallback_reason(error)
+        }
+    )
+
+@app.post("/api/generate-music", response_model=MusicGenerationResponse)
+async def generate_music(request: MusicGenerationRequest, x_request_timeout: Optional[str] = Header(None)):
+    """Generate music using Ollama + DeepSeek R1.
+    
+    A non-streaming request gets a fallback pattern rather than wait past
+    INTERACTIVE_DEADLINE_SECONDS, or the X-Request-Timeout it sent if sooner.
+    Only the `fields` asked for are returned; `verbose` adds the raw model output.
+    """
+    
+    if request.stream:
+        ticket = await admission.ticket("interactive", INTERACTIVE_DEADLINE_SECONDS)
+        return admitted_stream(stream_music(request, ticket), ticket)
+    
+    start = time.perf_counter()
+    try:
+        logger.info("🎵 Music generation request: %.80s", request.userInput)
+        
+        # Generate with Ollama; identical concurrent requests share one generation
+        key = generation_key(request)
+        with deadline(parse_timeout(x_request_timeout, INTERACTIVE_DEADLINE_SECONDS)):
+            ai_text, strudel_code = await in_flight.do(key, lambda: generate_strudel(request))
+        logger.info(f"✅ Generated {len(ai_text)} characters")
         
+        with timed("parse_validate"):
+            result = build_music_response(ai_text, request, strudel_code)
+        
+    except AdmissionRejected as e:
+        # No pattern at all, but the dashboards still need to see it
+        observe_request("generate-music", time.perf_counter() - start, error=e)
+        raise
     except Exception as e:
         logger.error(f"❌ Error generating music: {e}")
         # Return fallback on any error
-        fallback = generate_fallback_pattern(request.userInput)
-        return MusicGenerationResponse(
-            success=True,
-            code=fallback['strudel_code'],
-            description=fallback['description'] + " (error fallback)",
-            metadata={
-                "genre": "unknown",
-                "timestamp": datetime.now().isoformat(),
-                "error": str(e),
-                "fallback_used": True
-            }
+        result = error_fallback_response(request, e)
+    
+    observe_request("generate-music", time.perf_counter() - start, result.metadata.get("fallback_reason"))
+    return JSONResponse(music_response_content(result, request))
+
+def generation_key(request: MusicGenerationRequest) -> str:
+    """Single-flight key: every request input that shapes the prompt or the sampling"""
+    prompt_inputs = {"context": request.context, "system_prompt": request.system_prompt}
+    key = make_cache_key(request.userInput, request.musicDNA, request.temperature, prompt_inputs)
+    return f"{key}:{request.max_tokens}"
+
+async def generate_strudel(request: MusicGenerationRequest) -> Tuple[str, Optional[str]]:
+    """Run one Ollama generation; returns the raw text and any strudel block found while streaming"""
+    # JSON output has no ```strudel block to stop at
+    stop_controller = StrudelStopController() if EARLY_STOP and not STRUCTURED_OUTPUT else None
+    queued_at = time.perf_counter()
+    async with admission.admit("interactive", budget(INTERACTIVE_DEADLINE_SECONDS)):
+        observe_stage("admission", time.perf_counter() - queued_at)
+        logger.info(f"🤖 Generating with model: {DEEPSEEK_MODEL}")
+        response = await ollama.generate(
+            model=DEEPSEEK_MODEL,
+            stop_controller=stop_controller,
+            hedge=HEDGE_REQUESTS,
+            options=music_generation_options(request),
+            **music_prompt_args(request, structured=STRUCTURED_OUTPUT)
         )
+    if "prompt_eval_count" in response:
+        # Tokens Ollama actually prefilled: fewer than the prompt when its KV cache was reused
+        logger.info(f"📏 Ollama prefilled {response['prompt_eval_count']} prompt tokens")
+    return response.get("response", ""), stop_controller.code if stop_controller else None
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    """OpenAI-compatible chat completions endpoint"""
+async def stream_music(request: MusicGenerationRequest, ticket: AdmissionTicket) -> AsyncIterator[str]:
+    """Stream a music generation as server-sent events.
+    
+    Emits a `code` event as soon as the ```strudel block closes, then a
+    `done` event carrying the full MusicGenerationResponse. The admission
+    ticket acquired by the caller is released when the stream ends.
+    """
     
+    start = time.perf_counter()
     try:
-        # Convert messages to Ollama format
-        messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+        logger.info("🎵 Streaming music generation request: %.80s", request.userInput)
+        controller = StrudelStopController()
+        code_sent = False
         
-        # Generate with Ollama
-        response = await ollama.chat(
+        stream = ollama.generate_stream(
             model=DEEPSEEK_MODEL,
-            messages=messages,
-            options={
-                "temperature": request.temperature,
-                "num_predict": request.max_tokens
-            }
+            options=music_generation_options(request),
+            **music_prompt_args(request)
         )
+        async with aclosing(stream):
+            async for chunk in stream:
+                should_stop = controller.feed(chunk.get("response", ""))
+                if controller.code and not code_sent:
+                    logger.info("🎼 Strudel block closed, sending code early")
+                    yield sse_event({"code": controller.code}, event="code")
+                    code_sent = True
+                if should_stop and EARLY_STOP:
+                    logger.info(f"✂️ Early stop after {len(controller.text)} characters")
+                    break
+        
+        ai_text = controller.text
+        logger.info(f"✅ Streamed {len(ai_text)} characters")
+        with timed("parse_validate"):
+            result = build_music_response(ai_text, request, controller.finish())
+        
+    except Exception as e:
+        logger.error(f"❌ Error streaming music: {e}")
+        result = error_fallback_response(request, e)
+    finally:
+        ticket.release()
+    
+    observe_request("generate-music-stream", time.perf_counter() - start, result.metadata.get("fallback_reason"))
+    yield sse_event(music_response_content(result, request), event="done")
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: ChatCompletionRequest, x_request_timeout: Optional[str] = Header(None)):
+    """OpenAI-compatible chat completions endpoint"""
+    
+    # Convert messages to Ollama format
+    messages = [{"role": msg.role, "content": msg.content} for msg in request.messages]
+    options = {
+        "temperature": request.temperature,
+        "num_predict": request.max_tokens
+    }
+    
+    if request.stream:
+        ticket = await admission.ticket("bulk", BULK_DEADLINE_SECONDS)
+        return admitted_stream(stream_chat_completion(messages, options, ticket), ticket)
+    
+    start = time.perf_counter()
+    try:
+        # Generate with Ollama
+        with deadline(parse_timeout(x_request_timeout, BULK_DEADLINE_SECONDS)):
+            async with admission.admit("bulk", budget(BULK_DEADLINE_SECONDS)):
+                observe_stage("admission", time.perf_counter() - start)
+                response = await ollama.chat(
+                    model=DEEPSEEK_MODEL,
+                    messages=messages,
+                    options=options
+                )
+        observe_request("chat", time.perf_counter() - start)
         
         # Format response in OpenAI style
         return {
@@ -449,10 +721,69 @@ async def chat_completions(request: ChatCompletionRequest):
             }
         }
         
+    except AdmissionRejected:
+        raise
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=str(e))
     except Exception as e:
         logger.error(f"❌ Error in chat completions: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+async def stream_chat_completion(messages: List[Dict], options: Dict[str, Any], ticket: AdmissionTicket) -> AsyncIterator[str]:
+    """Stream an Ollama chat as OpenAI `chat.completion.chunk` server-sent events"""
+    
+    completion_id = f"chatcmpl-{datetime.now().timestamp()}"
+    created = int(datetime.now().timestamp())
+    
+    def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        return sse_event({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": DEEPSEEK_MODEL,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        })
+    
+    yield chunk({"role": "assistant"})
+    
+    try:
+        async with aclosing(ollama.chat_stream(model=DEEPSEEK_MODEL, messages=messages, options=options)) as parts:
+            async for part in parts:
+                content = part.get("message", {}).get("content", "")
+                if content:
+                    yield chunk({"content": content})
+                if part.get("done"):
+                    finish_reason = "length" if part.get("done_reason") == "length" else "stop"
+                    yield chunk({}, finish_reason)
+                
+    except Exception as e:
+        logger.error(f"❌ Error streaming chat completion: {e}")
+        yield sse_event({"error": {"message": str(e), "type": "server_error"}})
+    finally:
+        ticket.release()
+    
+    yield sse_event("[DONE]")
+
+@app.get("/stats")
+async def stats():
+    """Runtime statistics"""
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "single_flight": in_flight.stats(),
+        "admission": admission.stats(),
+        "warmup": warmup.stats(),
+        "ollama": ollama.pool.stats()
+    }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics: per-stage latency, Ollama throughput and fallback reasons"""
+    return metrics_response()
+
 @app.get("/v1/models")
 async def list_models():
     """OpenAI-compatible models endpoint"""
@@ -491,11 +822,16 @@ async def list_models():
 if __name__ == "__main__":
     logger.info(f"🚀 Starting Nala AI Music API on port {API_PORT}")
     logger.info(f"🤖 Using model: {DEEPSEEK_MODEL}")
-    logger.info(f"🔗 Ollama endpoint: {OLLAMA_BASE_URL}")
+    logger.info(f"🔗 Ollama endpoints: {', '.join(OLLAMA_BACKENDS)}")
+    
+    # Only needed to serve directly; `uvicorn module:app` imports it itself
+    import uvicorn
     
     uvicorn.run(
         app,
         host="0.0.0.0",
         port=API_PORT,
-        log_level="info"
+        log_level="info",
+        # Leave uvicorn's loggers to configure_logging
+        log_config=None
     )
\ No newline at end of file
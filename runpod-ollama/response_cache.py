@@ -0,0 +1,142 @@
+"""
+Nala AI - Response cache for music generation
+Bounded LRU + TTL cache keyed on a canonical form of the request
+"""
+
+import hashlib
+import json
+import random
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+# Words that do not change what the user is asking for
+FILLER_WORDS = {
+    "a", "an", "the", "me", "some", "please", "pls", "can", "could", "you",
+    "i", "want", "would", "like", "for", "of", "with", "and",
+    "create", "make", "generate", "give", "produce", "write", "build",
+}
+
+_NON_WORD = re.compile(r"[^a-z0-9#+\-\s]")
+_GAIN_CALL = re.compile(r"\.gain\(\s*([0-9]*\.?[0-9]+)\s*\)")
+_TRAILING_SLOW = re.compile(r"\.slow\(\s*([0-9]*\.?[0-9]+)\s*\)\s*$")
+
+SLOW_FACTORS = [0.9, 1.0, 1.1, 1.25, 1.5]
+
+
+def normalize_prompt(user_input: str) -> str:
+    """Canonical form of a user prompt: lowercase, no punctuation or filler words"""
+    words = _NON_WORD.sub(" ", user_input.lower()).split()
+    kept = [word for word in words if word not in FILLER_WORDS]
+    return " ".join(kept or words)
+
+
+def make_cache_key(
+    user_input: str,
+    music_dna: Optional[Dict[str, Any]] = None,
+    temperature: Optional[float] = None,
+    context: Optional[Dict[str, Any]] = None,
+) -> str:
+    """Stable key for a generation request.
+
+    `context` holds whatever else goes into the prompt (time of day,
+    activity, ...), so requests that differ there never share a pattern.
+    """
+    canonical = json.dumps(
+        [
+            normalize_prompt(user_input),
+            music_dna or {},
+            round(temperature, 2) if temperature is not None else None,
+            context or {},
+        ],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def vary_pattern(code: str, seed: str) -> str:
+    """Deterministically mutate a Strudel pattern.
+
+    Gains are jittered by up to ±15% and the overall tempo is scaled with a
+    slow() factor, so the same seed always yields the same variation.
+    """
+    rng = random.Random(seed)
+
+    def jitter_gain(match: re.Match) -> str:
+        gain = float(match.group(1)) * rng.uniform(0.85, 1.15)
+        return f".gain({min(1.0, max(0.0, gain)):.2f})"
+
+    varied = _GAIN_CALL.sub(jitter_gain, code)
+    factor = rng.choice(SLOW_FACTORS)
+
+    slow_match = _TRAILING_SLOW.search(varied)
+    if slow_match:
+        current = float(slow_match.group(1))
+        return varied[:slow_match.start()] + f".slow({current * factor:.2f})"
+    if factor == 1.0:
+        return varied
+    return varied.rstrip() + f".slow({factor})"
+
+
+class ResponseCache:
+    """LRU cache with a per-entry time-to-live"""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # key -> [expires_at, value, hits]
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value, or None if missing or expired"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry[0] <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        entry[2] += 1
+        self.hits += 1
+        return entry[1]
+
+    def hit_count(self, key: str) -> int:
+        """How many times a key has been served from the cache"""
+        entry = self._entries.get(key)
+        return entry[2] if entry else 0
+
+    def put(self, key: str, value: Any) -> None:
+        """Store a value, evicting the least recently used entries if full"""
+        self._entries[key] = [time.monotonic() + self.ttl_seconds, value, 0]
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
@@ -3,6 +3,22 @@
 # Nala AI - Startup Script for Ollama + DeepSeek R1
 echo "🚀 Starting Nala AI Ollama Service..."
 
+# Keep the model resident: Ollama uses this as its default keep_alive and the
+# music API sends it with every request (negative = never unload)
+export OLLAMA_KEEP_ALIVE="${OLLAMA_KEEP_ALIVE:--1m}"
+WARMUP_TIMEOUT="${WARMUP_TIMEOUT_SECONDS:-300}"
+
+# Cold-start timing, reported per phase once everything is ready
+START_TIME=$(date +%s.%N)
+PHASE_START=$START_TIME
+PHASE_TIMINGS=""
+end_phase() {
+    local now
+    now=$(date +%s.%N)
+    PHASE_TIMINGS="$PHASE_TIMINGS $1=$(awk -v a="$PHASE_START" -v b="$now" 'BEGIN {printf "%.1fs", b - a}')"
+    PHASE_START=$now
+}
+
 # Start Ollama server in background
 echo "🤖 Starting Ollama server..."
 ollama serve &
@@ -21,6 +37,7 @@ while ! curl -s http://localhost:11434/api/tags >/dev/null 2>&1; do
 done
 
 echo "✅ Ollama server ready!"
+end_phase "ollama_start"
 
 # Determine which DeepSeek model to use based on available GPU memory
 if nvidia-smi --query-gpu=memory.total --format=csv,noheader,nounits | awk '{sum+=$1} END {print sum}' | awk '$1 >= 40000 {exit 0} {exit 1}'; then
@@ -45,7 +62,18 @@ if ! ollama pull $MODEL; then
     }
 fi
 
-echo "✅ Model $MODEL ready!"
+end_phase "pull"
+
+# Load the weights now and pin them in memory, instead of on the first request
+echo "📌 Loading and pinning $MODEL..."
+if curl -sf http://localhost:11434/api/generate \
+    -d "{\"model\": \"$MODEL\", \"keep_alive\": -1}" \
+    --max-time "$WARMUP_TIMEOUT" >/dev/null; then
+    echo "✅ Model $MODEL loaded and pinned!"
+else
+    echo "⚠️ Could not preload $MODEL, it will load on the first request"
+fi
+end_phase "load"
 
 # Start the FastAPI music generation service
 echo "🎵 Starting Nala AI Music API..."
@@ -53,19 +81,21 @@ export OLLAMA_MODEL=$MODEL
 python3 music_api.py &
 API_PID=$!
 
-# Wait for API to be ready
-echo "⏳ Waiting for Music API to start..."
-timeout=30
-while ! curl -s http://localhost:8000/health >/dev/null 2>&1; do
+# Wait for API to be ready; /ready only succeeds once its warmup generation is done
+echo "⏳ Waiting for Music API to start and warm up..."
+timeout=$WARMUP_TIMEOUT
+while ! curl -sf http://localhost:8000/ready >/dev/null 2>&1; do
     sleep 2
     timeout=$((timeout - 2))
     if [ $timeout -le 0 ]; then
-        echo "❌ Timeout waiting for Music API to start"
+        echo "❌ Timeout waiting for Music API to warm up"
         exit 1
     fi
 done
+end_phase "api_warmup"
 
 echo "🎵 Nala AI Music API ready!"
+echo "⏱️ Cold start:$PHASE_TIMINGS total=$(awk -v a="$START_TIME" -v b="$(date +%s.%N)" 'BEGIN {printf "%.1fs", b - a}')"
 echo "🚀 All services running successfully!"
 echo "📊 Ollama: http://localhost:11434"
 echo "🎵 Music API: http://localhost:8000"
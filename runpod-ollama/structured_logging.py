@@ -0,0 +1,120 @@
+"""
+Nala AI - Structured logging for the music APIs
+JSON log lines tagged with the request ID, written from a background thread
+so the event loop never blocks on stdout, with the INFO lines of only a
+sample of requests kept
+"""
+
+import atexit
+import copy
+import logging
+import queue
+import random
+import sys
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Optional
+
+from pythonjsonlogger import jsonlogger
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+# Whether the current request's INFO lines are kept; None outside a request
+_sampled: ContextVar[Optional[bool]] = ContextVar("log_sampled", default=None)
+
+
+class RequestContextFilter(logging.Filter):
+    """Tag records with the request ID, and drop INFO and below for requests left out of the sample"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return record.levelno >= logging.WARNING or _sampled.get() is not False
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the listener thread; only merge the message
+        # args here, while they still hold what they held at the call
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def configure_logging(level: str = "INFO", json_format: bool = True) -> None:
+    """Send every log record through a queue to a stdout handler on its own thread.
+
+    Run uvicorn with log_config=None so its loggers propagate here too.
+    Calling it again does nothing.
+    """
+    root = logging.getLogger()
+    if any(isinstance(handler, _QueueHandler) for handler in root.handlers):
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    if json_format:
+        output.setFormatter(jsonlogger.JsonFormatter(
+            "%(asctime)s %(levelname)s %(name)s %(message)s %(request_id)s",
+            rename_fields={"asctime": "time", "levelname": "level", "name": "logger"},
+            json_ensure_ascii=False,
+        ))
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    handler.addFilter(RequestContextFilter())
+    listener = QueueListener(records, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    # One INFO line per Ollama call repeats what the APIs log already
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def request_id() -> Optional[str]:
+    """ID of the request being handled, or None outside of one"""
+    return _request_id.get()
+
+
+class RequestContextMiddleware:
+    """ASGI middleware giving each HTTP request an ID and a log sampling decision.
+
+    The ID is the caller's X-Request-ID if it sent one; either way it is
+    returned in the response's X-Request-ID header. The INFO and DEBUG lines
+    of a sample_rate fraction of requests are kept; warnings and errors, and
+    anything logged outside a request, always are. Plain ASGI rather than
+    BaseHTTPMiddleware, so the context also holds while a streaming body is sent.
+    """
+
+    def __init__(self, app: Callable[..., Any], sample_rate: float = 1.0):
+        self.app = app
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        header = REQUEST_ID_HEADER.lower().encode()
+        incoming = next((value.decode("latin-1") for name, value in scope["headers"] if name == header), None)
+        rid = (incoming or uuid.uuid4().hex[:16])[:64]
+        id_token = _request_id.set(rid)
+        sampled_token = _sampled.set(self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+        async def send_with_id(message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (header, rid.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            _request_id.reset(id_token)
+            _sampled.reset(sampled_token)
@@ -0,0 +1,64 @@
+"""
+Nala AI - Startup warmup for the Ollama-backed APIs
+Runs the warmup phases once at startup, times each one and only reports the
+service ready when they have finished
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """Phase-by-phase startup warmup with a readiness flag.
+
+    A failing phase is logged and ends the warmup early; the service still
+    becomes ready (and reports the error) so it can serve fallbacks rather
+    than stay out of rotation forever.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.phases: Dict[str, float] = {}
+        self.error: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, phases: List[Tuple[str, Callable[[], Awaitable[Any]]]]) -> None:
+        """Run the phases in the background on the running loop"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run(phases))
+
+    async def run(self, phases: List[Tuple[str, Callable[[], Awaitable[Any]]]]) -> None:
+        start = time.perf_counter()
+        for name, step in phases:
+            phase_start = time.perf_counter()
+            try:
+                await step()
+            except Exception as e:
+                self.error = f"{name}: {e}"
+                logger.warning(f"⚠️ Warmup phase {name} failed: {e}")
+                break
+            finally:
+                self.phases[name] = time.perf_counter() - phase_start
+        self.phases["total"] = time.perf_counter() - start
+        self.ready = True
+        logger.info("⏱️ Warmup finished: " + ", ".join(f"{name}={seconds:.2f}s" for name, seconds in self.phases.items()))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "phases": {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            "error": self.error,
+        }
+
+
+async def wait_for(check: Callable[[], Awaitable[bool]], timeout: float, interval: float = 2.0) -> None:
+    """Poll check() until it returns True, raising TimeoutError after timeout seconds"""
+    deadline = time.monotonic() + timeout
+    while not await check():
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"not ready after {timeout:.0f}s")
+        await asyncio.sleep(interval)
@@ -5,7 +5,7 @@
 echo "🚀 Deploying Nala AI to RunPod..."
 
 # Build and push Docker image (if using custom container)
-# docker build -t nala-ai-deepseek .
+# docker build -f Dockerfile -t nala-ai-deepseek ..  # context: repository root, for nala_core
 # docker tag nala-ai-deepseek:latest your-registry/nala-ai-deepseek:latest
 # docker push your-registry/nala-ai-deepseek:latest
 
@@ -3,41 +3,116 @@ Nala AI - DeepSeek R1 Music Generation Handler for RunPod
 Generates unique Strudel patterns using DeepSeek R1 reasoning capabilities
 """
 
-import runpod
+import os
+import sys
 import json
-import re
+import time
+import copy
+import dataclasses
+import asyncio
+import threading
 import traceback
-from transformers import AutoTokenizer, AutoModelForCausalLM
-import torch
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# nala_core sits at the repository root: Docker images copy it next to this
+# file, and a checkout run without PYTHONPATH finds it one directory up
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+
+from nala_core import StrudelExtractor, extract_strudel_code, generate_fallback, project_fields, validate_strudel
+from nala_core.constrained import CODE_BLOCK_OPENING, StrudelGrammar
+from nala_core.prompts import MUSIC_PROMPT, budget_music_prompt_suffix, estimate_tokens, extract_description
+
+# torch and transformers take seconds to import; they are only imported when
+# the model is loaded, so fallback and validation jobs are answered at once
+torch = None
+transformers = None
+
+# Configuration
+MODEL_NAME = os.getenv("MODEL_NAME", "deepseek-ai/DeepSeek-R1")
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "50"))
+# Prompt length including the static prefix: MusicDNA and context fields are
+# dropped to fit, so the request and the closing instruction always make it in
+MAX_PROMPT_TOKENS = int(os.getenv("MAX_PROMPT_TOKENS", "2048"))
+PREFIX_KV_CACHE = os.getenv("PREFIX_KV_CACHE", "true").lower() == "true"
+# Register the generator handler so clients can poll /stream for partial output
+STREAMING = os.getenv("STREAMING", "false").lower() == "true"
+# Load the model and run a synthetic generation before accepting jobs
+WARMUP = os.getenv("WARMUP", "true").lower() == "true"
+WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", "16"))
+# Accept jobs immediately and warm up in the background: fallback and
+# validation jobs are answered straight away, generation jobs wait for the load
+FAST_START = os.getenv("FAST_START", "false").lower() == "true"
+# Start generations inside a ```strudel block and mask tokens that would
+# leave the Strudel grammar; the top CONSTRAINED_TOP_K tokens are checked per step
+CONSTRAINED_DECODING = os.getenv("CONSTRAINED_DECODING", "false").lower() == "true"
+CONSTRAINED_TOP_K = int(os.getenv("CONSTRAINED_TOP_K", "32"))
 
 # Global model variables
 model = None
 tokenizer = None
+model_lock = threading.Lock()
+
+# Seconds spent in each cold-start phase
+startup_timings = {}
+
+def import_model_libraries():
+    """Import torch and transformers on first use"""
+    global torch, transformers
+    
+    if torch is None:
+        phase_start = time.perf_counter()
+        import torch
+        import transformers
+        startup_timings["imports"] = time.perf_counter() - phase_start
 
 def load_model():
     """Load DeepSeek R1 model with optimizations"""
     global model, tokenizer
     
     try:
-        print("🤖 Loading DeepSeek R1 model...")
-        model_name = "deepseek-ai/DeepSeek-R1"
+        import_model_libraries()
+        print(f"🤖 Loading {MODEL_NAME}...")
+        phase_start = time.perf_counter()
         
-        # Load tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
+        # Load tokenizer; batches are left-padded so every prompt ends where generation starts
+        tokenizer = transformers.AutoTokenizer.from_pretrained(
+            MODEL_NAME,
             trust_remote_code=True
         )
+        tokenizer.padding_side = "left"
+        # If a prompt is ever cut, lose its start rather than the instruction at the end
+        tokenizer.truncation_side = "left"
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        startup_timings["tokenizer"] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
         
         # Load model with optimizations
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16,
-            device_map="auto",
-            trust_remote_code=True,
-            load_in_8bit=True  # Memory optimization
-        )
+        if torch.cuda.is_available():
+            model = transformers.AutoModelForCausalLM.from_pretrained(
+                MODEL_NAME,
+                torch_dtype=torch.float16,
+                device_map="auto",
+                trust_remote_code=True,
+                load_in_8bit=True  # Memory optimization
+            )
+        else:
+            # CPU (e.g. testing with a tiny model)
+            model = transformers.AutoModelForCausalLM.from_pretrained(
+                MODEL_NAME,
+                trust_remote_code=True
+            )
+        model.eval()
+        startup_timings["weights"] = time.perf_counter() - phase_start
+        phase_start = time.perf_counter()
         
-        print("✅ DeepSeek R1 model loaded successfully")
+        prefix_cache.build()
+        startup_timings["prefix"] = time.perf_counter() - phase_start
+        
+        print(f"✅ {MODEL_NAME} loaded successfully")
         return True
         
     except Exception as e:
@@ -45,167 +120,480 @@ def load_model():
         traceback.print_exc()
         return False
 
-def create_music_prompt(user_input, music_dna=None, context=None):
-    """Create a detailed prompt for music generation"""
+def load_model_once():
+    """Load the model unless it is loaded already, whichever thread gets here first"""
+    with model_lock:
+        if model is not None and tokenizer is not None:
+            return True
+        return load_model()
+
+async def ensure_model_loaded():
+    """Load the model once, off the event loop, however many jobs ask at the same time"""
+    if model is not None and tokenizer is not None:
+        return True
+    return await asyncio.get_running_loop().run_in_executor(None, load_model_once)
+
+def warm_up():
+    """Load the model and run one synthetic generation before accepting jobs.
+    
+    The generation compiles kernels and allocates the KV cache, so the first
+    real job after a cold start costs the same as any other.
+    """
+    start = time.perf_counter()
+    if not load_model_once():
+        print("⚠️ Warmup could not load the model; jobs will retry the load")
+        return False
+    
+    phase_start = time.perf_counter()
+    try:
+        # On the batcher's thread, in case jobs are already being served
+        batching_engine.executor.submit(batching_engine._generate_batch, [{
+            "prompt": create_music_prompt_suffix("create a chill lo-fi beat"),
+            "max_new_tokens": WARMUP_TOKENS,
+            "temperature": 0.8,
+            "top_p": 0.9
+        }]).result()
+    except Exception as e:
+        print(f"⚠️ Warmup generation failed: {e}")
+    startup_timings["generate"] = time.perf_counter() - phase_start
+    startup_timings["total"] = time.perf_counter() - start
     
-    prompt = f"""You are Nala, an expert AI music producer and composer with deep knowledge of electronic music, rhythm programming, and the Strudel live coding language.
-
-User Request: "{user_input}"
-
-Context:
-- Musical DNA: {json.dumps(music_dna, indent=2) if music_dna else 'Not provided'}
-- Context: {json.dumps(context, indent=2) if context else 'Not provided'}
-
-Your task is to generate a unique Strudel pattern that perfectly matches the user's request. 
-
-IMPORTANT GUIDELINES:
-1. Analyze the user's musical intent, genre preferences, and emotional context
-2. Use proper Strudel syntax with functions like: stack(), sound(), note(), gain(), lpf(), room(), delay(), slow()
-3. Create rhythmic patterns using drum sounds: "bd" (kick), "sd" (snare), "hh" (hihat), "oh" (open hihat)
-4. Use musical notation for melodies: "c4", "d4", "e4", etc.
-5. Apply appropriate effects and filters based on the requested style
-6. Make each pattern unique and creative while staying true to the genre
-7. Consider tempo, energy level, and complexity based on the request
-
-EXAMPLE STRUDEL PATTERNS:
-
-Trap:
-```strudel
-stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4),
-  sound("808").note("c1 ~ f1 g1").lpf(80)
-)
-```
-
-Lo-Fi:
-```strudel
-stack(
-  sound("bd ~ ~ ~").gain(0.6),
-  sound("~ ~ sd ~").gain(0.5),
-  sound("hh*4").gain(0.3),
-  note("c2 ~ f1 g1").sound("sawtooth").lpf(400),
-  sound("vinyl").gain(0.1)
-)
-```
-
-Now generate a unique Strudel pattern for: "{user_input}"
-
-Respond with:
-1. The Strudel code wrapped in ```strudel and ```
-2. A brief description of what you created and why it fits the request
-3. Any reasoning about musical choices you made
-
-Pattern:"""
+    print("⏱️ Cold start: " + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in startup_timings.items()))
+    return True
 
-    return prompt
+class PrefixCache:
+    """Tokens and KV cache of the static prompt prefix.
+    
+    The prefix is prefilled once at load time; each batch gets a copy of its
+    past_key_values so only the request-specific suffix has to be prefilled.
+    """
+    
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.input_ids = None
+        self.past_key_values = None
+    
+    def build(self):
+        self.input_ids = tokenizer(self.prefix, return_tensors="pt").input_ids.to(model.device)
+        self.past_key_values = None
+        if not PREFIX_KV_CACHE:
+            return
+        
+        start = time.perf_counter()
+        with torch.no_grad():
+            cache = model(self.input_ids, use_cache=True).past_key_values
+        if isinstance(cache, tuple):
+            cache = transformers.DynamicCache.from_legacy_cache(cache)
+        self.past_key_values = cache
+        print(f"🗂️ Prefilled {self.input_ids.shape[1]}-token prompt prefix in {time.perf_counter() - start:.2f}s")
+    
+    def for_batch(self, batch_size):
+        """A private copy of the prefix cache, one row per batch entry"""
+        if self.past_key_values is None:
+            return None
+        cache = copy.deepcopy(self.past_key_values)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
 
-def extract_strudel_code(ai_response):
-    """Extract Strudel code from AI response"""
+class StopSignal:
+    """Stops generate() on the next token once set from another thread.
     
-    # Look for code blocks with strudel tag
-    strudel_match = re.search(r'```strudel\n(.*?)\n```', ai_response, re.DOTALL)
-    if strudel_match:
-        return strudel_match.group(1).strip()
+    A duck-typed transformers StoppingCriteria, so that defining it does not
+    need transformers to be imported.
+    """
     
-    # Look for any stack() pattern
-    stack_match = re.search(r'(stack\([^)]+\)(?:\.[^)]+\([^)]*\))*)', ai_response, re.DOTALL)
-    if stack_match:
-        return stack_match.group(1).strip()
+    def __init__(self):
+        self.event = threading.Event()
     
-    # Look for code blocks without tag
-    code_match = re.search(r'```\n(.*?)\n```', ai_response, re.DOTALL)
-    if code_match:
-        code = code_match.group(1).strip()
-        if 'stack(' in code:
-            return code
+    def set(self):
+        self.event.set()
     
-    return None
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+# Decoded text of each token id, filled in as the grammar checks tokens
+token_texts = {}
+
+def token_text(token_id):
+    text = token_texts.get(token_id)
+    if text is None:
+        text = token_texts[token_id] = tokenizer.decode([token_id], skip_special_tokens=True)
+    return text
+
+class StrudelLogitsProcessor:
+    """Keeps every row of a generate() call on the Strudel grammar.
+    
+    At each step the top_k most likely tokens are checked against the row's
+    StrudelGrammar and every other token is masked out. Once the code is
+    complete (its closing fence accepted) only EOS is allowed; if no
+    candidate fits, the row ends early and repair or the fallback take over.
+    A duck-typed transformers LogitsProcessor, like StopSignal.
+    """
+    
+    def __init__(self, prompt_length, top_k=CONSTRAINED_TOP_K):
+        self.prompt_length = prompt_length
+        self.top_k = top_k
+        self.grammars = None
+    
+    def __call__(self, input_ids, scores):
+        eos = tokenizer.eos_token_id
+        if self.grammars is None:
+            self.grammars = [StrudelGrammar() for _ in range(input_ids.shape[0])]
+        
+        candidates = torch.topk(scores, min(self.top_k, scores.shape[-1]), dim=-1).indices.tolist()
+        allowed = torch.zeros_like(scores, dtype=torch.bool)
+        for row, grammar in enumerate(self.grammars):
+            if input_ids.shape[1] > self.prompt_length:
+                grammar.feed(token_text(input_ids[row, -1].item()))
+            if grammar.complete:
+                allowed[row, eos] = True
+                continue
+            fitting = [
+                token_id for token_id in candidates[row]
+                if token_id != eos and token_text(token_id) and grammar.accepts(token_text(token_id))
+            ]
+            allowed[row, fitting or [eos]] = True
+        
+        return scores.masked_fill(~allowed, float("-inf"))
+
+def logits_processors(prompt_length):
+    """Extra logits processors for a generate() call, or None"""
+    if not CONSTRAINED_DECODING:
+        return None
+    return transformers.LogitsProcessorList([StrudelLogitsProcessor(prompt_length)])
 
-def extract_description(ai_response, user_input):
-    """Extract description from AI response"""
+class BatchingEngine:
+    """Dynamic micro-batching for model.generate.
     
-    # Remove code blocks
-    text = re.sub(r'```.*?```', '', ai_response, flags=re.DOTALL)
+    Jobs submitted within max_wait_ms of the first one (up to max_batch_size)
+    are tokenized together and generated in a single call on a dedicated
+    worker thread, so the GPU works on several patterns at once while the
+    event loop keeps accepting jobs.
+    """
     
-    # Look for description patterns
-    desc_patterns = [
-        r'Description:\s*(.*?)(?:\n\n|\n[A-Z]|$)',
-        r'This pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)',
-        r'I created\s*(.*?)(?:\n\n|\n[A-Z]|$)',
-        r'The pattern\s*(.*?)(?:\n\n|\n[A-Z]|$)'
-    ]
+    def __init__(self, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = None
+        self.worker = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+        
+        self.batches = 0
+        self.patterns = 0
+        self.streams = 0
+        self.generate_seconds = 0.0
+    
+    async def submit(self, prompt, max_new_tokens=800, temperature=0.8, top_p=0.9):
+        """Queue a prompt suffix for the next batch and wait for its completion text"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put({
+            "prompt": prompt,
+            "max_new_tokens": max_new_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "future": future
+        })
+        return await future
+    
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self.worker is None or self.worker.done() or self.worker.get_loop() is not loop:
+            self.queue = asyncio.Queue()
+            self.worker = loop.create_task(self._run())
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Sampling parameters are per generate() call, so group by them
+            groups = {}
+            for job in batch:
+                if not job["future"].cancelled():
+                    groups.setdefault((job["temperature"], job["top_p"]), []).append(job)
+            
+            for group in groups.values():
+                try:
+                    texts = await loop.run_in_executor(self.executor, self._generate_batch, group)
+                    for job, text in zip(group, texts):
+                        if not job["future"].done():
+                            job["future"].set_result(text)
+                except Exception as e:
+                    for job in group:
+                        if not job["future"].done():
+                            job["future"].set_exception(e)
+    
+    async def stream(self, prompt, max_new_tokens=800, temperature=0.8, top_p=0.9, stop_when=None):
+        """Generate a single prompt suffix outside the batch queue, yielding text as it is decoded.
+        
+        stop_when is called with the text so far after every chunk; once it
+        returns True generation stops at the next token. The generate() call
+        still runs on the batcher's worker thread, so it takes turns with
+        batches instead of competing with them for the GPU.
+        """
+        loop = asyncio.get_running_loop()
+        streamer = transformers.TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop = StopSignal()
+        generation = loop.run_in_executor(
+            self.executor, self._generate_stream, prompt, max_new_tokens, temperature, top_p, streamer, stop
+        )
+        
+        text = ""
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, streamer, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                text += chunk
+                yield chunk
+                if stop_when is not None and stop_when(text):
+                    stop.set()
+            await generation
+        finally:
+            # Also reached when the client goes away mid-stream
+            stop.set()
+    
+    def _generate_stream(self, prompt, max_new_tokens, temperature, top_p, streamer, stop):
+        start = time.perf_counter()
+        try:
+            input_ids, attention_mask, past_key_values = self._prepare_inputs([prompt])
+            with torch.no_grad():
+                outputs = model.generate(
+                    input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    past_key_values=past_key_values,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    do_sample=True,
+                    pad_token_id=tokenizer.pad_token_id,
+                    eos_token_id=tokenizer.eos_token_id,
+                    streamer=streamer,
+                    stopping_criteria=transformers.StoppingCriteriaList([stop]),
+                    logits_processor=logits_processors(input_ids.shape[1])
+                )
+        except Exception:
+            # Unblock the consumer; the exception surfaces through the future
+            streamer.end()
+            raise
+        
+        elapsed = time.perf_counter() - start
+        new_tokens = outputs.shape[1] - input_ids.shape[1]
+        self.streams += 1
+        print(f"🌊 Streamed {new_tokens} tokens in {elapsed:.2f}s{' (stopped early)' if stop.event.is_set() else ''}")
+    
+    def _prepare_inputs(self, prompts):
+        """Tokenize prompt suffixes behind the shared prefix.
+        
+        Rows are laid out as [prefix][padding][suffix]: the padding is masked
+        out, so positions continue straight from the shared prefix cache.
+        """
+        prefix_ids = prefix_cache.input_ids
+        suffixes = tokenizer(
+            prompts,
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=MAX_PROMPT_TOKENS - prefix_ids.shape[1],
+            add_special_tokens=False
+        ).to(model.device)
+        
+        batch_size = len(prompts)
+        input_ids = torch.cat([prefix_ids.expand(batch_size, -1), suffixes["input_ids"]], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids).expand(batch_size, -1), suffixes["attention_mask"]], dim=1)
+        return input_ids, attention_mask, prefix_cache.for_batch(batch_size)
+    
+    def _generate_batch(self, jobs):
+        """Run one left-padded generate() call and split the new tokens back per job"""
+        start = time.perf_counter()
+        
+        input_ids, attention_mask, past_key_values = self._prepare_inputs([job["prompt"] for job in jobs])
+        
+        with torch.no_grad():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                max_new_tokens=max(job["max_new_tokens"] for job in jobs),
+                temperature=jobs[0]["temperature"],
+                top_p=jobs[0]["top_p"],
+                do_sample=True,
+                pad_token_id=tokenizer.pad_token_id,
+                eos_token_id=tokenizer.eos_token_id,
+                logits_processor=logits_processors(input_ids.shape[1])
+            )
+        
+        # Decode only the generated continuation of each row
+        new_tokens = outputs[:, input_ids.shape[1]:]
+        texts = [
+            tokenizer.decode(tokens[:job["max_new_tokens"]], skip_special_tokens=True).strip()
+            for job, tokens in zip(jobs, new_tokens)
+        ]
+        
+        elapsed = time.perf_counter() - start
+        self.batches += 1
+        self.patterns += len(jobs)
+        self.generate_seconds += elapsed
+        print(f"🧮 Batch of {len(jobs)} in {elapsed:.2f}s ({len(jobs) / elapsed:.2f} patterns/s, {self.throughput():.2f} overall)")
+        
+        return texts
     
-    for pattern in desc_patterns:
-        match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
-        if match:
-            desc = match.group(1).strip()
-            if len(desc) > 10:  # Ensure it's a meaningful description
-                return desc[:200] + ('...' if len(desc) > 200 else '')
+    def throughput(self):
+        """Patterns per second of generation time"""
+        return self.patterns / self.generate_seconds if self.generate_seconds else 0.0
     
-    # Fallback: use first meaningful sentence
-    sentences = text.split('.')
-    for sentence in sentences:
-        if len(sentence.strip()) > 20 and any(word in sentence.lower() for word in ['pattern', 'music', 'create', 'generate']):
-            return sentence.strip() + '.'
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "patterns": self.patterns,
+            "avg_batch_size": round(self.patterns / self.batches, 2) if self.batches else 0.0,
+            "patterns_per_second": round(self.throughput(), 3),
+            "streams": self.streams
+        }
+
+batching_engine = BatchingEngine()
+
+# Static instructions shared by every request. Keeping them first, before
+# anything request-specific, lets their KV cache be computed once and reused.
+MUSIC_PROMPT_PREFIX = MUSIC_PROMPT.prefix
+
+def count_prompt_tokens(text):
+    """Tokens text takes behind the prefix (estimated until the tokenizer is loaded)"""
+    if tokenizer is None:
+        return estimate_tokens(text)
+    return len(tokenizer(text, add_special_tokens=False).input_ids)
+
+def prefix_tokens():
+    if prefix_cache.input_ids is not None:
+        return prefix_cache.input_ids.shape[1]
+    return count_prompt_tokens(MUSIC_PROMPT_PREFIX)
+
+def budget_prompt_suffix(user_input, music_dna=None, context=None):
+    """Request-specific part of the prompt, fitted into MAX_PROMPT_TOKENS behind the prefix"""
+    
+    # Constrained generations start inside the code block
+    opening = "\n" + CODE_BLOCK_OPENING if CONSTRAINED_DECODING else ""
+    opening_tokens = count_prompt_tokens(opening) if opening else 0
     
-    return f"AI-generated musical pattern based on: {user_input}"
+    prompt = budget_music_prompt_suffix(
+        user_input, music_dna, context,
+        MAX_PROMPT_TOKENS - prefix_tokens() - opening_tokens,
+        count_tokens=count_prompt_tokens
+    )
+    if opening:
+        prompt = dataclasses.replace(prompt, suffix=prompt.suffix + opening, tokens=prompt.tokens + opening_tokens)
+    return prompt
+
+def create_music_prompt_suffix(user_input, music_dna=None, context=None):
+    """Request-specific part of the prompt, appended after MUSIC_PROMPT_PREFIX"""
+    return budget_prompt_suffix(user_input, music_dna, context).suffix
+
+def log_prompt_tokens(prompt):
+    print(
+        f"📏 Prompt tokens: {prefix_tokens() + prompt.tokens} (prefix {prefix_tokens()} cached, suffix {prompt.tokens})"
+        + (f", dropped {', '.join(prompt.dropped)}" if prompt.dropped else "")
+        + (", request clipped" if prompt.clipped else "")
+    )
+
+def create_music_prompt(user_input, music_dna=None, context=None):
+    """Create a detailed prompt for music generation"""
+    return MUSIC_PROMPT_PREFIX + create_music_prompt_suffix(user_input, music_dna, context)
 
-def generate_fallback_pattern(user_input):
+prefix_cache = PrefixCache(MUSIC_PROMPT_PREFIX)
+
+def generate_fallback_pattern(user_input, music_dna=None, seed=None):
     """Generate fallback pattern when AI fails"""
+    pattern = generate_fallback(user_input, music_dna, seed)
+    return {
+        'strudel_code': pattern.code,
+        'description': f"{pattern.description} (fallback generation)",
+        'genre': pattern.genre,
+        'seed': pattern.seed,
+        'source': 'fallback'
+    }
+
+def fast_path(job_input, user_input):
+    """Output for jobs that never need the model, or None.
     
-    lower_input = user_input.lower()
+    mode "validate" checks the job's strudel_code, mode "fallback" returns a
+    fallback pattern (the same one again for the same seed), and jobs
+    without user input get the default fallback.
+    """
+    mode = job_input.get('mode')
     
-    if 'trap' in lower_input:
+    if mode == 'validate':
+        code = job_input.get('strudel_code', job_input.get('code', ''))
         return {
-            'strudel_code': '''stack(
-  sound("bd*2 ~ bd ~").gain(0.8),
-  sound("~ ~ sd ~").gain(0.7),
-  sound("hh*16").gain(0.4),
-  sound("808").note("c1 ~ f1 g1").lpf(80)
-).slow(1.5)''',
-            'description': 'Aggressive trap pattern with heavy 808s and rapid hi-hats (fallback generation)',
-            'source': 'fallback'
+            "output": {
+                "strudel_code": code,
+                **validate_strudel(code).to_dict()
+            }
         }
-    elif 'country' in lower_input or 'folk' in lower_input:
+    
+    if mode == 'fallback':
+        return {"output": generate_fallback_pattern(user_input or "create music", job_input.get('musicDNA'), job_input.get('seed'))}
+    
+    if not user_input:
         return {
-            'strudel_code': '''stack(
-  sound("bd ~ bd bd").gain(0.6),
-  sound("~ sd ~ sd").gain(0.5),
-  sound("hh ~ hh ~").gain(0.3),
-  note("c2 g1 c2 g1").sound("sawtooth").lpf(600),
-  note("C G Am F").sound("guitar").slow(8).gain(0.3)
-).slow(1.8)''',
-            'description': 'Country-style pattern with walking bass and acoustic guitar (fallback generation)',
-            'source': 'fallback'
+            "error": "No user input provided",
+            "output": generate_fallback_pattern("create lo-fi music", job_input.get('musicDNA'))
         }
-    elif 'dark' in lower_input or 'minor' in lower_input:
-        return {
-            'strudel_code': '''stack(
-  sound("bd ~ ~ bd").gain(0.7),
-  sound("~ ~ sd ~").gain(0.6),
-  sound("hh*8").gain(0.2),
-  note("c2 ~ eb2 f2").sound("sawtooth").lpf(300),
-  sound("pad").note("cm gm abmaj7").slow(16).room(0.8).gain(0.2)
-).slow(2.0)''',
-            'description': 'Dark atmospheric pattern in minor key with ambient pads (fallback generation)',
-            'source': 'fallback'
+    
+    return None
+
+def build_output(ai_response, user_input, prompt=None, verbose=False, fields=None):
+    """Turn the model's completion into the job output, falling back if it has no usable code.
+    
+    The completion itself is only included (as raw_ai_response) when verbose;
+    fields (a list or comma-separated names) limits the output to those keys.
+    """
+    
+    if CONSTRAINED_DECODING:
+        # The opening of the code block was part of the prompt
+        ai_response = CODE_BLOCK_OPENING + ai_response
+    
+    # Extract Strudel code and description
+    strudel_code = extract_strudel_code(ai_response)
+    description = extract_description(ai_response, user_input)
+    
+    if not strudel_code:
+        print("⚠️ No valid Strudel code found, using fallback")
+        fallback = generate_fallback_pattern(user_input)
+        output = {
+            "strudel_code": fallback['strudel_code'],
+            "description": fallback['description'],
+            "source": "ai_fallback"
         }
     else:
-        return {
-            'strudel_code': '''stack(
-  sound("bd ~ ~ ~").gain(0.6),
-  sound("~ ~ sd ~").gain(0.5),
-  sound("hh*4").gain(0.3),
-  note("c2 ~ f1 g1").sound("sawtooth").lpf(400),
-  sound("vinyl").gain(0.1)
-).slow(1.8)''',
-            'description': 'Chill lo-fi pattern with vinyl texture (fallback generation)',
-            'source': 'fallback'
+        print("🎼 Successfully extracted Strudel pattern")
+        output = {
+            "strudel_code": strudel_code,
+            "description": description,
+            "source": "deepseek_r1"
         }
+    
+    if verbose:
+        output["raw_ai_response"] = ai_response
+    if prompt is not None:
+        output["prompt_tokens"] = prefix_tokens() + prompt.tokens
+    return {"output": project_fields(output, fields)}
 
-def handler(job):
+async def handler(job):
     """Main RunPod handler function"""
     
     try:
@@ -219,82 +607,121 @@ def handler(job):
         
         print(f"📝 User input: {user_input}")
         
-        # Validate input
-        if not user_input:
-            return {
-                "error": "No user input provided",
-                "output": generate_fallback_pattern("create lo-fi music")
-            }
+        # Validation, explicit fallbacks and empty input need no model
+        quick = fast_path(job_input, user_input)
+        if quick is not None:
+            return quick
         
         # Load model if not already loaded
-        if model is None or tokenizer is None:
-            if not load_model():
-                print("⚠️ Model loading failed, using fallback")
-                return {
-                    "output": generate_fallback_pattern(user_input)
-                }
+        if not await ensure_model_loaded():
+            print("⚠️ Model loading failed, using fallback")
+            return {
+                "output": generate_fallback_pattern(user_input, music_dna)
+            }
         
         # Create prompt
-        prompt = create_music_prompt(user_input, music_dna, context)
-        print(f"🤖 Generated prompt length: {len(prompt)} characters")
+        # The static prefix is already in the batcher's KV cache
+        prompt = budget_prompt_suffix(user_input, music_dna, context)
+        log_prompt_tokens(prompt)
         
-        # Generate with DeepSeek R1
+        # Generate with DeepSeek R1, batched with any concurrent jobs
         print("🧠 Generating with DeepSeek R1...")
-        inputs = tokenizer.encode(prompt, return_tensors="pt", max_length=2048, truncation=True)
-        
-        with torch.no_grad():
-            outputs = model.generate(
-                inputs,
-                max_new_tokens=job_input.get('max_tokens', 800),
-                temperature=job_input.get('temperature', 0.8),
-                top_p=job_input.get('top_p', 0.9),
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-                eos_token_id=tokenizer.eos_token_id
-            )
-        
-        # Decode response
-        full_response = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        ai_response = full_response[len(prompt):].strip()
+        ai_response = await batching_engine.submit(
+            prompt.suffix,
+            max_new_tokens=job_input.get('max_tokens', 800),
+            temperature=job_input.get('temperature', 0.8),
+            top_p=job_input.get('top_p', 0.9)
+        )
         
         print(f"✅ AI generated {len(ai_response)} characters")
         
-        # Extract Strudel code and description
-        strudel_code = extract_strudel_code(ai_response)
-        description = extract_description(ai_response, user_input)
+        return build_output(ai_response, user_input, prompt, job_input.get('verbose', False), job_input.get('fields'))
         
-        if not strudel_code:
-            print("⚠️ No valid Strudel code found, using fallback")
-            fallback = generate_fallback_pattern(user_input)
-            return {
-                "output": {
-                    "text": ai_response,
-                    "strudel_code": fallback['strudel_code'],
-                    "description": fallback['description'],
-                    "source": "ai_fallback",
-                    "raw_ai_response": ai_response
-                }
-            }
-        
-        print("🎼 Successfully extracted Strudel pattern")
+    except Exception as e:
+        print(f"❌ Error in handler: {e}")
+        traceback.print_exc()
         
+        # Return fallback on any error
+        fallback = generate_fallback_pattern(user_input if 'user_input' in locals() else "create music")
         return {
+            "error": str(e),
             "output": {
-                "text": ai_response,
-                "strudel_code": strudel_code,
-                "description": description,
-                "source": "deepseek_r1",
-                "raw_ai_response": ai_response
+                **fallback,
+                "source": "error_fallback"
             }
         }
+
+async def stream_handler(job):
+    """Streaming RunPod handler: yields the completion as it is generated.
+    
+    Chunks are {"delta": text}; a {"strudel_code": code} chunk is yielded as
+    soon as the Strudel block closes, and the last chunk is {"done": True,
+    "output": {...}} with the same output as the non-streaming handler.
+    Generation stops at the closing fence unless stop_at_code is false.
+    """
+    
+    try:
+        print("🌊 Processing streaming music generation request...")
+        
+        job_input = job.get('input', {})
+        user_input = job_input.get('userInput', job_input.get('prompt', ''))
+        music_dna = job_input.get('musicDNA', {})
+        context = job_input.get('context', {})
+        
+        quick = fast_path(job_input, user_input)
+        if quick is not None:
+            yield {"done": True, **quick}
+            return
+        
+        if not await ensure_model_loaded():
+            print("⚠️ Model loading failed, using fallback")
+            yield {"done": True, "output": generate_fallback_pattern(user_input, music_dna)}
+            return
+        
+        prompt = budget_prompt_suffix(user_input, music_dna, context)
+        log_prompt_tokens(prompt)
+        
+        # Callers that do not want partial output still share the batcher
+        if not job_input.get('stream', True):
+            ai_response = await batching_engine.submit(
+                prompt.suffix,
+                max_new_tokens=job_input.get('max_tokens', 800),
+                temperature=job_input.get('temperature', 0.8),
+                top_p=job_input.get('top_p', 0.9)
+            )
+            yield {"done": True, **build_output(ai_response, user_input, prompt, job_input.get('verbose', False), job_input.get('fields'))}
+            return
+        
+        stop_at_code = job_input.get('stop_at_code', True)
+        extractor = StrudelExtractor()
+        if CONSTRAINED_DECODING:
+            extractor.feed(CODE_BLOCK_OPENING)
+        ai_response = ""
+        
+        async for chunk in batching_engine.stream(
+            prompt.suffix,
+            max_new_tokens=job_input.get('max_tokens', 800),
+            temperature=job_input.get('temperature', 0.8),
+            top_p=job_input.get('top_p', 0.9),
+            stop_when=lambda _text: stop_at_code and extractor.code is not None
+        ):
+            ai_response += chunk
+            yield {"delta": chunk}
+            
+            strudel_code = extractor.feed(chunk)
+            if strudel_code:
+                yield {"strudel_code": strudel_code}
+        
+        print(f"✅ AI streamed {len(ai_response)} characters")
+        yield {"done": True, **build_output(ai_response.strip(), user_input, prompt, job_input.get('verbose', False), job_input.get('fields'))}
         
     except Exception as e:
-        print(f"❌ Error in handler: {e}")
+        print(f"❌ Error in stream handler: {e}")
         traceback.print_exc()
         
-        # Return fallback on any error
         fallback = generate_fallback_pattern(user_input if 'user_input' in locals() else "create music")
-        return {
+        yield {
+            "done": True,
             "error": str(e),
             "output": {
                 **fallback,
@@ -302,7 +729,96 @@ def handler(job):
             }
         }
 
+def concurrency_modifier(current_concurrency):
+    """Take enough concurrent jobs to fill a batch"""
+    return BATCH_MAX_SIZE
+
+async def benchmark(num_jobs):
+    """Push synthetic jobs through the batcher and report throughput"""
+    prompts = ["create a dark trap beat", "chill lo-fi for studying", "upbeat house groove", "country folk song"]
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        handler({"input": {"userInput": prompts[i % len(prompts)], "max_tokens": 64}})
+        for i in range(num_jobs)
+    ])
+    elapsed = time.perf_counter() - start
+    print(f"📈 {num_jobs} patterns in {elapsed:.2f}s ({num_jobs / elapsed:.2f} patterns/s end to end)")
+    print(f"📈 Batching stats: {json.dumps(batching_engine.stats())}")
+
+def diagnostics():
+    """Report import and fast-path timings (python handler.py --diagnostics)"""
+    
+    # python -X importtime output: "import time: self | cumulative | name",
+    # with the name indented two spaces per nesting level
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import sys, handler; print('torch' in sys.modules)"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))},
+        capture_output=True,
+        text=True
+    )
+    total_us = 0
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth == 0 and name == "handler":
+            total_us = int(parts[1])
+        elif depth == 1:
+            imports.append((int(parts[1]), name))
+    
+    print(f"📦 import handler: {total_us / 1000:.1f}ms (torch imported: {result.stdout.strip() or 'unknown'})")
+    for microseconds, name in sorted(imports, reverse=True)[:10]:
+        print(f"   {microseconds / 1000:8.1f}ms  {name}")
+    
+    jobs = {
+        "validation job": {"mode": "validate", "strudel_code": 'stack(sound("bd ~ sd ~"), sound("hh*8"))'},
+        "fallback job": {"mode": "fallback", "userInput": "dark trap beat"},
+        "empty input job": {}
+    }
+    for label, job_input in jobs.items():
+        start = time.perf_counter()
+        asyncio.run(handler({"input": job_input}))
+        print(f"⚡ {label}: {(time.perf_counter() - start) * 1000:.2f}ms")
+    
+    import_model_libraries()
+    print(f"🔥 torch + transformers import (deferred until model load): {startup_timings['imports'] * 1000:.0f}ms")
+
 # Start the RunPod serverless handler
 if __name__ == "__main__":
+    if "--diagnostics" in sys.argv:
+        diagnostics()
+        sys.exit(0)
+    
+    if "--bench" in sys.argv:
+        # e.g. MODEL_NAME=sshleifer/tiny-gpt2 python handler.py --bench 32
+        index = sys.argv.index("--bench")
+        num_jobs = int(sys.argv[index + 1]) if len(sys.argv) > index + 1 else 32
+        asyncio.run(benchmark(num_jobs))
+        sys.exit(0)
+    
     print("🚀 Starting Nala AI - DeepSeek R1 Music Generation Service")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    print(f"🧮 Batching up to {BATCH_MAX_SIZE} jobs within {BATCH_MAX_WAIT_MS:.0f}ms")
+    # Only the serverless worker needs the RunPod SDK, which is slow to import
+    import runpod
+    
+    if WARMUP and FAST_START:
+        threading.Thread(target=warm_up, name="warmup", daemon=True).start()
+    elif WARMUP:
+        warm_up()
+    
+    if STREAMING:
+        print("🌊 Streaming partial output to /stream")
+        runpod.serverless.start({
+            "handler": stream_handler,
+            "concurrency_modifier": concurrency_modifier,
+            "return_aggregate_stream": True
+        })
+    else:
+        runpod.serverless.start({
+            "handler": handler,
+            "concurrency_modifier": concurrency_modifier
+        })
\ No newline at end of file
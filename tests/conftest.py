@@ -0,0 +1,9 @@
+"""
+Shared test setup: the API modules live in runpod-ollama/, which is not a package
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "runpod-ollama")]
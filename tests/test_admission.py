@@ -0,0 +1,123 @@
+"""
+Tests for admission control in front of Ollama
+"""
+
+import asyncio
+import gc
+
+import pytest
+from fastapi.testclient import TestClient
+
+import music_api
+import music_api_wrapper
+from admission import AdmissionController, AdmissionRejected
+
+
+def test_interactive_lane_is_served_before_bulk():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1)
+        order = []
+
+        async def wait(lane, name):
+            await controller.acquire(lane)
+            order.append(name)
+
+        granted_at = await controller.acquire("interactive")
+        waiters = [
+            asyncio.ensure_future(wait("bulk", "bulk 1")),
+            asyncio.ensure_future(wait("bulk", "bulk 2")),
+            asyncio.ensure_future(wait("interactive", "interactive")),
+        ]
+        await asyncio.sleep(0)
+        assert controller.stats()["lane_depth"] == {"interactive": 1, "bulk": 2}
+
+        controller.release(granted_at)
+        for _ in range(3):
+            await asyncio.sleep(0)
+            controller.release()
+        await asyncio.gather(*waiters)
+        assert order == ["interactive", "bulk 1", "bulk 2"]
+
+    asyncio.run(scenario())
+
+
+def test_rejects_when_the_wait_would_exceed_the_deadline():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, initial_service_time=10.0)
+        await controller.acquire()
+        with pytest.raises(AdmissionRejected) as rejected:
+            await controller.acquire(deadline=5.0)
+        assert rejected.value.retry_after_header == "10"
+        assert controller.stats()["rejected"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_a_waiter_giving_up_leaves_the_queue():
+    async def scenario():
+        controller = AdmissionController(max_concurrency=1, initial_service_time=0.01)
+        granted_at = await controller.acquire()
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire(deadline=0.05)
+        assert controller.stats()["queue_depth"] == 0
+        controller.release(granted_at)
+        assert controller.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_answers_429_with_retry_after(monkeypatch):
+    controller = AdmissionController(max_concurrency=1, max_queue=0, initial_service_time=7.5)
+    controller.active = 1
+    monkeypatch.setattr(music_api, "admission", controller)
+    monkeypatch.setattr(music_api, "CACHE_ENABLED", False)
+
+    response = TestClient(music_api.app).post("/generate-music", json={"userInput": "a chill lo-fi beat"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "8"
+    assert response.json()["detail"] == "Generation queue is full"
+
+
+def stream_with_ticket(monkeypatch, controller):
+    """A streaming music generation holding a slot from controller, over a fake Ollama stream"""
+    async def generate_stream(model, prompt, **kwargs):
+        for text in ["Here:\n```strudel\n", 'sound("bd*4")\n', "```\n", "A steady kick. " * 50]:
+            yield {"response": text}
+
+    monkeypatch.setattr(music_api_wrapper.ollama, "generate_stream", generate_stream)
+    request = music_api_wrapper.MusicGenerationRequest(userInput="a chill lo-fi beat", stream=True)
+
+    async def start():
+        ticket = await controller.ticket()
+        return music_api_wrapper.admitted_stream(music_api_wrapper.stream_music(request, ticket), ticket)
+
+    return start
+
+
+def test_stream_dropped_before_it_starts_releases_its_slot(monkeypatch):
+    controller = AdmissionController(max_concurrency=1)
+
+    async def scenario():
+        response = await stream_with_ticket(monkeypatch, controller)()
+        assert controller.active == 1
+        # The client went away before the body was ever iterated
+        del response
+        gc.collect()
+        assert controller.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_stream_dropped_midway_releases_its_slot(monkeypatch):
+    controller = AdmissionController(max_concurrency=1)
+
+    async def scenario():
+        response = await stream_with_ticket(monkeypatch, controller)()
+        body = response.body_iterator
+        first = await body.__anext__()
+        assert first.startswith("event: code")
+        assert controller.active == 1
+        await body.aclose()
+        assert controller.active == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,227 @@
+"""
+Tests for routing, ejection and hedging across Ollama backends
+"""
+
+import asyncio
+import random
+import time
+from contextlib import aclosing
+
+import httpx
+import pytest
+
+from backend_pool import BackendPool, StuckRequest, request_kind
+from deadlines import DeadlineExceeded, deadline
+
+
+def make_pool(count=2, **options):
+    return BackendPool([f"http://ollama-{index}:11434" for index in range(count)], rng=random.Random(0), **options)
+
+
+async def fail_on(pool, backend, error=RuntimeError("connection reset")):
+    with pytest.raises(type(error)):
+        async with pool.acquire(exclude=[other for other in pool.backends if other is not backend]):
+            raise error
+
+
+def test_failures_eject_a_backend_with_doubling_backoff():
+    pool = make_pool(failure_threshold=3, ejection_seconds=30, max_ejection_seconds=100)
+    backend = pool.backends[0]
+
+    async def scenario():
+        for _ in range(3):
+            await fail_on(pool, backend)
+        assert backend.ejected_until - time.monotonic() == pytest.approx(30, abs=1)
+        assert pool.pick() is pool.backends[1]
+
+        # Back from ejection, one more failure is enough, for twice as long, up to the cap
+        for expected in (60, 100):
+            backend.ejected_until = 0.0
+            await fail_on(pool, backend)
+            assert backend.ejected_until - time.monotonic() == pytest.approx(expected, abs=1)
+
+        # Serving a request clears the slate
+        backend.ejected_until = 0.0
+        async with pool.acquire(exclude=[pool.backends[1]]):
+            pass
+        assert (backend.failures, backend.ejections) == (0, 0)
+
+    asyncio.run(scenario())
+
+
+def test_client_errors_do_not_count_against_the_backend():
+    class NotFound(Exception):
+        status_code = 404
+
+    pool = make_pool(failure_threshold=1)
+
+    async def scenario():
+        await fail_on(pool, pool.backends[0], NotFound())
+
+    asyncio.run(scenario())
+    assert pool.backends[0].failures == 0
+    assert pool.backends[0].ejected_until == 0.0
+
+
+def test_every_backend_ejected_uses_the_one_back_soonest():
+    pool = make_pool(3)
+    now = time.monotonic()
+    for backend, seconds in zip(pool.backends, (60, 10, 30)):
+        backend.ejected_until = now + seconds
+    assert pool.pick() is pool.backends[1]
+
+
+def test_power_of_two_choices_takes_the_less_loaded_backend():
+    pool = make_pool(2)
+    busy, idle = pool.backends
+    busy.in_flight = 4
+    idle.latency = 3.0  # (0 + 1) * 3.0 < (4 + 1) * 1.0
+    assert all(pool.pick() is idle for _ in range(20))
+
+    idle.latency = 6.0
+    assert all(pool.pick() is busy for _ in range(20))
+
+
+def test_power_of_two_choices_never_picks_the_most_loaded_of_three():
+    pool = make_pool(3)
+    for backend, in_flight in zip(pool.backends, (0, 1, 9)):
+        backend.in_flight = in_flight
+    picks = {pool.pick().url for _ in range(200)}
+    assert pool.backends[2].url not in picks
+    assert picks == {pool.backends[0].url, pool.backends[1].url}
+
+
+def test_models_already_loaded_are_preferred():
+    pool = make_pool(2)
+    pool.backends[0].models = {"other:latest"}
+    pool.backends[1].models = {"deepseek-r1:1.5b"}
+    pool.backends[1].in_flight = 3
+    assert all(pool.pick("deepseek-r1:1.5b") is pool.backends[1] for _ in range(20))
+
+
+@pytest.mark.parametrize("interrupt", ["closed", "stuck"])
+def test_early_closed_and_stuck_requests_leave_latency_and_failures_alone(interrupt):
+    pool = make_pool(1, failure_threshold=1)
+    backend = pool.backends[0]
+
+    async def stream():
+        async with pool.acquire():
+            for chunk in range(100):
+                await asyncio.sleep(0.01)
+                yield chunk
+
+    async def scenario():
+        if interrupt == "closed":
+            async with aclosing(stream()) as chunks:
+                async for chunk in chunks:
+                    if chunk == 2:
+                        break
+        else:
+            with pytest.raises(StuckRequest):
+                async with pool.acquire():
+                    await asyncio.sleep(0.01)
+                    raise StuckRequest("no response after 0.01s")
+
+    asyncio.run(scenario())
+    assert backend.in_flight == 0
+    assert backend.latency == 1.0
+    assert (backend.failures, backend.errors, backend.ejected_until) == (0, 0, 0.0)
+
+
+@pytest.mark.parametrize("payload, kind", [
+    ({"model": "m"}, "/api/generate"),
+    ({"options": {"temperature": 0.7}}, "/api/generate"),
+    ({"options": {"num_predict": 8}}, "/api/generate:8"),
+    ({"options": {"num_predict": 800}}, "/api/generate:1024"),
+    ({"options": {"num_predict": 1024}}, "/api/generate:1024"),
+    ({"options": {"num_predict": -1}}, "/api/generate"),
+])
+def test_request_kind_buckets_by_num_predict(payload, kind):
+    assert request_kind("/api/generate", payload) == kind
+
+
+def fill(pool, kind, seconds, count=20):
+    for _ in range(count):
+        pool.latency(kind).observe(seconds)
+
+
+def test_latency_windows_are_kept_per_kind():
+    pool = make_pool(stuck_factor=3.0, min_samples=20)
+    fill(pool, "/api/generate:8", 0.5)
+    assert pool.attempt_timeout("/api/generate:8", 60.0) == pytest.approx(1.5)
+    # Fast warmups say nothing about how long a full generation may take
+    assert pool.attempt_timeout("/api/generate:1024", 60.0) == 60.0
+    assert pool.hedge_delay("/api/generate:1024") is None
+    fill(pool, "/api/generate:1024", 10.0, count=19)
+    assert pool.attempt_timeout("/api/generate:1024", 60.0) == 60.0
+    fill(pool, "/api/generate:1024", 10.0, count=1)
+    assert pool.attempt_timeout("/api/generate:1024", 60.0) == pytest.approx(30.0)
+
+
+def test_hedge_on_another_backend_wins_and_the_slow_attempt_is_cancelled():
+    pool = make_pool(2, hedge_quantile=0.95)
+    fill(pool, "generate", 0.05)
+    slow, fast = pool.backends
+    fast.in_flight = 10  # so the first attempt goes to the slow one
+    cancelled = []
+
+    async def send(backend, timeout):
+        if backend is slow:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(backend.url)
+                raise
+        return backend.url
+
+    result = asyncio.run(pool.request("m", send, 60.0, kind="generate", hedge=True))
+    assert result == fast.url
+    assert cancelled == [slow.url]
+    assert (pool.hedged, pool.hedge_wins) == (1, 1)
+    assert slow.in_flight == 0
+
+
+def test_no_hedge_before_enough_samples():
+    pool = make_pool(2)
+    fill(pool, "generate", 0.01, count=5)
+
+    async def send(backend, timeout):
+        await asyncio.sleep(0.05)
+        return backend.url
+
+    asyncio.run(pool.request("m", send, 60.0, kind="generate", hedge=True))
+    assert pool.hedged == 0
+
+
+def test_attempt_far_past_p99_is_abandoned_as_stuck():
+    pool = make_pool(1, stuck_factor=3.0, failure_threshold=1)
+    fill(pool, "generate", 0.01)
+
+    async def send(backend, timeout):
+        # What httpx does when the attempt's timeout runs out
+        await asyncio.sleep(timeout)
+        raise httpx.ReadTimeout("timed out")
+
+    with pytest.raises(StuckRequest):
+        asyncio.run(pool.request("m", send, 60.0, kind="generate"))
+    assert pool.backends[0].failures == 0
+    assert pool.backends[0].ejected_until == 0.0
+
+
+def test_request_deadline_is_passed_on_to_the_attempt():
+    pool = make_pool(1)
+    timeouts = []
+
+    async def send(backend, timeout):
+        timeouts.append(timeout)
+        await asyncio.sleep(timeout)
+        raise httpx.ReadTimeout("timed out")
+
+    async def scenario():
+        with deadline(0.05):
+            await pool.request("m", send, 60.0, kind="generate")
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(scenario())
+    assert timeouts[0] <= 0.05
+    assert pool.deadlines_exceeded == 1
@@ -0,0 +1,50 @@
+"""
+Tests for request deadlines and the time budgets derived from them
+"""
+
+import time
+
+import pytest
+
+from deadlines import DeadlineExceeded, budget, deadline, parse_timeout, remaining
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("15", 15.0),
+    (2.5, 2.5),
+    ("120", 60.0),  # never longer than the default
+    ("0", 60.0),
+    ("-3", 60.0),
+    ("soon", 60.0),
+    (None, 60.0),
+])
+def test_parse_timeout(value, expected):
+    assert parse_timeout(value, 60.0) == expected
+
+
+def test_budget_outside_a_deadline_is_the_timeout():
+    assert remaining() is None
+    assert budget(30.0) == 30.0
+
+
+def test_budget_is_cut_to_the_time_left():
+    with deadline(5.0):
+        assert 4.5 < budget(30.0) <= 5.0
+        assert budget(1.0) == 1.0
+    assert remaining() is None
+
+
+def test_nested_deadlines_keep_the_sooner_one():
+    with deadline(5.0):
+        with deadline(60.0):
+            assert remaining() <= 5.0
+        with deadline(1.0):
+            assert remaining() <= 1.0
+        assert 1.0 < remaining() <= 5.0
+
+
+def test_budget_after_the_deadline_raises():
+    with deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(DeadlineExceeded):
+            budget(30.0)
@@ -0,0 +1,47 @@
+"""
+Regression tests for /generate-music answering slow Ollama calls with fallbacks
+"""
+
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import music_api
+from backend_pool import StuckRequest
+
+
+@pytest.fixture
+def ollama_fails(monkeypatch):
+    """Make every Ollama call raise the given error instead of reaching a backend"""
+    monkeypatch.setattr(music_api, "CACHE_ENABLED", False)
+
+    def fail_with(error):
+        async def post_ollama(path, payload, **kwargs):
+            raise error
+        monkeypatch.setattr(music_api, "post_ollama", post_ollama)
+
+    return fail_with
+
+
+def generate(user_input):
+    return asyncio.run(music_api.generate_music(music_api.MusicRequest(userInput=user_input), None))
+
+
+@pytest.mark.parametrize("error", [
+    StuckRequest("Abandoned after 3.0s"),
+    httpx.ReadTimeout("timed out"),
+], ids=["stuck", "timeout"])
+def test_slow_ollama_gets_a_timeout_fallback(ollama_fails, error):
+    ollama_fails(error)
+    result = generate("a chill lo-fi beat")
+    assert result.metadata["fallback"]
+    assert result.metadata["fallback_reason"] == "timeout"
+
+
+def test_other_ollama_errors_are_raised(ollama_fails):
+    ollama_fails(httpx.ConnectError("connection refused"))
+    with pytest.raises(HTTPException) as raised:
+        generate("a chill lo-fi beat")
+    assert raised.value.status_code == 500
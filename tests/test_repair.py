@@ -0,0 +1,29 @@
+"""
+Regression tests for Strudel repair
+"""
+
+from nala_core import repair_strudel
+
+
+def test_deeply_nested_code_is_returned_unchanged():
+    for code in ["(" * 1500 + 'sound("bd")' + ")" * 1500, "stack(" * 800 + 'sound("bd")']:
+        result = repair_strudel(code)
+        assert result.code == code
+        assert not result.valid
+        assert result.fixes == ()
+
+
+def test_valid_code_is_never_rewritten():
+    # Sample names we do not know may be the user's own or loaded ones
+    for code in ['s("mykick bd").gain(0.5)', 'sound("kick snare")', 'sound("bd").gain(3)']:
+        result = repair_strudel(code)
+        assert result.code == code
+        assert result.was_valid and result.valid
+        assert result.fixes == ()
+
+
+def test_invalid_code_gets_sounds_mapped_and_brackets_closed():
+    result = repair_strudel('sound("kick snare"')
+    assert not result.was_valid
+    assert result.valid
+    assert result.code == 'sound("bd sd")'
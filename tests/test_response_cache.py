@@ -0,0 +1,112 @@
+"""
+Tests for the music response cache and its keys
+"""
+
+import re
+
+import pytest
+
+import music_api
+import response_cache
+from nala_core import validate_strudel
+from response_cache import ResponseCache, make_cache_key, vary_pattern
+
+
+def request(**context):
+    return music_api.MusicRequest(userInput="a chill lo-fi beat", context=context)
+
+
+def test_key_includes_the_context_the_prompt_uses():
+    morning = request(timeOfDay="morning", activity="studying")
+    night = request(timeOfDay="night", activity="party")
+    assert music_api.request_cache_key(morning) != music_api.request_cache_key(night)
+
+
+def test_key_ignores_context_the_prompt_does_not_use():
+    first = request(timeOfDay="night", userAgent="Firefox", timestamp="2026-01-01T00:00:00")
+    second = request(timeOfDay="night", userAgent="Safari", timestamp="2026-01-01T00:00:05")
+    assert music_api.request_cache_key(first) == music_api.request_cache_key(second)
+
+
+def test_key_is_canonical():
+    assert make_cache_key("Please make me a chill beat!", {"genre": "lo-fi"}, 0.7, {"a": 1, "b": 2}) == \
+        make_cache_key("chill beat", {"genre": "lo-fi"}, 0.701, {"b": 2, "a": 1})
+    assert make_cache_key("chill beat", context={}) == make_cache_key("chill beat")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(response_cache.time, "monotonic", clock)
+    return clock
+
+
+def test_entries_expire_after_their_ttl(clock):
+    cache = ResponseCache(ttl_seconds=60)
+    cache.put("key", "pattern")
+    clock.now += 59
+    assert cache.get("key") == "pattern"
+    clock.now += 1
+    assert cache.get("key") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put("first", 1)
+    cache.put("second", 2)
+    assert cache.get("first") == 1  # now "second" is the least recently used
+    cache.put("third", 3)
+    assert cache.get("second") is None
+    assert (cache.get("first"), cache.get("third")) == (1, 3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_hits_are_counted_per_key():
+    cache = ResponseCache()
+    cache.put("key", "pattern")
+    cache.get("key")
+    cache.get("key")
+    cache.get("missing")
+    assert cache.hit_count("key") == 2
+    assert cache.hit_count("missing") == 0
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (2, 1)
+
+
+def test_variations_are_deterministic_and_in_range():
+    code = 'stack(sound("bd*4").gain(0.9), sound("hh*8").gain(0.4)).slow(2)'
+    assert vary_pattern(code, "key:1") == vary_pattern(code, "key:1")
+    variations = {vary_pattern(code, f"key:{variant}") for variant in range(10)}
+    assert len(variations) > 1
+    for varied in variations:
+        assert validate_strudel(varied).valid
+        assert varied.count(".slow(") == 1
+        gains = [float(gain) for gain in re.findall(r"\.gain\(([0-9.]+)\)", varied)]
+        assert 0.76 <= gains[0] <= 1.0 and 0.34 <= gains[1] <= 0.46
+
+
+def test_cached_responses_are_served_as_copies_with_variations(monkeypatch):
+    cache = ResponseCache()
+    monkeypatch.setattr(music_api, "response_cache", cache)
+    original = music_api.MusicResponse(
+        success=True, code='sound("bd*4").gain(0.8)', description="four on the floor", metadata={}
+    )
+    cache.put("key", original)
+
+    plain = music_api.serve_cached(cache.get("key"), "key", variation=False)
+    assert plain.code == original.code and plain.metadata["cache_hit"]
+    assert original.metadata == {}
+
+    first = music_api.serve_cached(cache.get("key"), "key", variation=True)
+    second = music_api.serve_cached(cache.get("key"), "key", variation=True)
+    assert (first.metadata["variation"], second.metadata["variation"]) == (2, 3)
+    assert first.code == vary_pattern(original.code, "key:2")
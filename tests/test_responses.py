@@ -0,0 +1,18 @@
+"""
+Regression tests for response field projection
+"""
+
+from nala_core.responses import project_fields
+
+RESPONSE = {"code": 'sound("bd")', "metadata": {"genre": "house", "bpm": 124}}
+
+
+def test_nested_field_is_projected():
+    assert project_fields(RESPONSE, "code,metadata.genre") == {
+        "code": 'sound("bd")',
+        "metadata": {"genre": "house"},
+    }
+
+
+def test_missing_nested_field_leaves_no_empty_parent():
+    assert project_fields(RESPONSE, "code,metadata.key,extra.field.deep") == {"code": 'sound("bd")'}
@@ -0,0 +1,76 @@
+"""
+Tests for single-flight coalescing of identical generations
+"""
+
+import asyncio
+
+import music_api_wrapper
+from single_flight import SingleFlight
+
+
+async def run_concurrently(flight, keys):
+    """Call flight.do once per key at the same time; returns the results and how many calls ran"""
+    started = []
+    release = asyncio.Event()
+
+    async def generate(key):
+        started.append(key)
+        await release.wait()
+        return f"pattern {len(started)}"
+
+    calls = [asyncio.ensure_future(flight.do(key, lambda key=key: generate(key))) for key in keys]
+    await asyncio.sleep(0)
+    release.set()
+    return await asyncio.gather(*calls), len(started)
+
+
+def request(**fields):
+    return music_api_wrapper.MusicGenerationRequest(userInput="a chill lo-fi beat", **fields)
+
+
+def test_identical_requests_share_one_generation():
+    flight = SingleFlight()
+    key = music_api_wrapper.generation_key(request(context={"timeOfDay": "night"}))
+    results, generations = asyncio.run(run_concurrently(flight, [key, key, key]))
+    assert generations == 1
+    assert results == ["pattern 1"] * 3
+    assert flight.stats() == {"in_flight": 0, "leaders": 1, "shared": 2}
+
+
+def test_different_prompt_inputs_do_not_coalesce():
+    keys = [music_api_wrapper.generation_key(request(**fields)) for fields in (
+        {"context": {"timeOfDay": "morning", "activity": "studying"}},
+        {"context": {"timeOfDay": "night", "activity": "party"}},
+        {"system_prompt": "Only write drum patterns"},
+        {},
+    )]
+    _results, generations = asyncio.run(run_concurrently(SingleFlight(), keys))
+    assert generations == len(keys)
+
+
+def test_last_waiter_cancelling_stops_the_shared_work():
+    async def scenario():
+        flight = SingleFlight()
+        generation_cancelled = asyncio.Event()
+
+        async def generate():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                generation_cancelled.set()
+                raise
+
+        first = asyncio.ensure_future(flight.do("key", generate))
+        second = asyncio.ensure_future(flight.do("key", generate))
+        await asyncio.sleep(0)
+
+        # Another caller is still waiting: the generation keeps going
+        first.cancel()
+        await asyncio.sleep(0)
+        assert not generation_cancelled.is_set()
+
+        second.cancel()
+        await asyncio.wait_for(generation_cancelled.wait(), 1)
+        assert flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,33 @@
+"""
+Regression tests for Strudel validation on pathological input
+"""
+
+import pytest
+
+from nala_core import validate_strudel
+from nala_core.syntax import MAX_NESTING
+
+DEEP = 1500
+
+
+@pytest.mark.parametrize("code", [
+    "(" * DEEP + 'sound("bd")' + ")" * DEEP,
+    'sound("' + "[" * DEEP + "bd" + "]" * DEEP + '")',
+    "-" * (2 * DEEP) + 'sound("bd")',
+    "stack(" * 800 + 'sound("bd")' + ")" * 800,
+], ids=["parentheses", "mini-notation", "unary", "stack"])
+def test_deep_nesting_is_an_issue_not_a_crash(code):
+    result = validate_strudel(code)
+    assert not result.valid
+    assert "Nesting too deep" in result.errors[0].message
+
+
+def test_nesting_within_the_limit_is_valid():
+    depth = MAX_NESTING // 2
+    assert validate_strudel("stack(" * depth + 'sound("bd")' + ")" * depth).valid
+
+
+def test_adjacent_expressions_need_a_separator():
+    assert not validate_strudel('sound("bd") sound("sd")').valid
+    assert validate_strudel('sound("bd"); sound("sd")').valid
+    assert validate_strudel('sound("bd")\nsound("sd")').valid